@@ -0,0 +1,219 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Glycemic statistics over downloaded results
+
+Analytics keeps running sums (count, sum, sum of squares and range
+counts) overall, per day, per hour of day and per meal flag, so results
+can be added batch by batch and the statistics read at any time. The
+batches are reduced with NumPy; control results, results without a
+value and results without a time are left out.
+"""
+
+import lazy
+import store
+import readinglog
+
+numpy = lazy.optional('numpy')
+
+# mg/dL per mmol/L of glucose
+MGDL_PER_MMOL = 18.0
+
+# Unit codes, as in store.ResultStore and readinglog
+MGDL, MMOL = 0, 1
+
+BEFORE = store.FLAGBITS['B']
+AFTER = store.FLAGBITS['A']
+for _f in store.FLAGS:
+    if _f.startswith('Z'):
+        AFTER |= store.FLAGBITS[_f]
+del _f
+
+MEALS = ('before', 'after', 'other')
+
+class Stats(object):
+    "Count, mean, standard deviation and coefficient of variation"
+
+    __slots__ = ('n', 'total', 'squares')
+
+    def __init__(self, n=0, total=0.0, squares=0.0):
+        self.n = n
+        self.total = total
+        self.squares = squares
+
+    def add(self, n, total, squares):
+        self.n += n
+        self.total += total
+        self.squares += squares
+
+    @property
+    def mean(self):
+        return self.total / self.n if self.n else None
+
+    @property
+    def sd(self):
+        "Sample standard deviation"
+        if self.n < 2:
+            return None
+        var = (self.squares - self.total * self.total / self.n) / (self.n - 1)
+        return max(var, 0.0) ** 0.5
+
+    @property
+    def cv(self):
+        "Coefficient of variation, in percent"
+        sd = self.sd
+        return None if sd is None else 100.0 * sd / self.mean
+
+    def __repr__(self):
+        return '<Stats n=%d mean=%r sd=%r>' % (self.n, self.mean, self.sd)
+
+def _sums(index, values, size):
+    return (numpy.bincount(index, minlength=size),
+            numpy.bincount(index, values, minlength=size),
+            numpy.bincount(index, values * values, minlength=size))
+
+class Analytics(object):
+    """
+    Running glycemic statistics
+
+    Values are kept in mg/dL. low and high bound the target range
+    (inclusive), utcoffset is added to the epoch times before they are
+    split into days and hours.
+    """
+    def __init__(self, low=70.0, high=180.0, utcoffset=0):
+        if numpy is None:
+            raise ImportError("NumPy is needed for analytics")
+        self.low = low
+        self.high = high
+        self.utcoffset = utcoffset
+        self.overall = Stats()
+        self.below = self.inrange = self.above = 0
+        self.days = {}
+        self.hours = [Stats() for i in range(24)]
+        self.meals = dict((m, Stats()) for m in MEALS)
+        self._pending = ([], [], [], [], [])
+
+    def add(self, time, value, unit=None, flags=None, control=None):
+        """
+        Add a batch of results given as arrays
+
+        unit holds unit codes (MGDL or MMOL) and defaults to mg/dL,
+        flags the store.FLAGBITS bitmasks and control is true for
+        control solution results.
+        """
+        time = numpy.asarray(time, 'i8')
+        value = numpy.asarray(value, 'f8')
+        keep = (time != store.NOTIME) & ~numpy.isnan(value)
+        if control is not None:
+            keep &= ~numpy.asarray(control, bool)
+        time, value = time[keep], value[keep]
+        if unit is not None:
+            unit = numpy.asarray(unit)[keep]
+            value = numpy.where(unit == MMOL, value * MGDL_PER_MMOL, value)
+        if flags is None:
+            flags = numpy.zeros(len(value), 'u4')
+        else:
+            flags = numpy.asarray(flags, 'u4')[keep]
+        if not len(value):
+            return
+
+        self.overall.add(len(value), value.sum(), numpy.dot(value, value))
+        below = int((value < self.low).sum())
+        above = int((value > self.high).sum())
+        self.below += below
+        self.above += above
+        self.inrange += len(value) - below - above
+
+        local = time + self.utcoffset
+        days, index = numpy.unique(local // 86400, return_inverse=True)
+        for day, n, total, squares in zip(days, *_sums(index, value,
+                                                        len(days))):
+            self.days.setdefault(int(day) * 86400, Stats()).add(n, total,
+                                                                squares)
+
+        hours = (local % 86400) // 3600
+        for stats, n, total, squares in zip(self.hours,
+                                            *_sums(hours, value, 24)):
+            stats.add(n, total, squares)
+
+        meal = numpy.where(flags & BEFORE, 0, numpy.where(flags & AFTER, 1, 2))
+        for name, n, total, squares in zip(MEALS, *_sums(meal, value, 3)):
+            self.meals[name].add(n, total, squares)
+
+    def add_store(self, results):
+        "Add the results of a store.ResultStore"
+        cols = results.to_numpy()
+        self.add(cols['time'], cols['value'], cols['unit'], cols['flags'],
+                 cols['control'])
+
+    def add_log(self, records):
+        "Add a structured array from readinglog.ReadingLog.to_numpy()"
+        flags = records['flags']
+        self.add(records['minute'].astype('i8') * 60, records['value'],
+                 records['unit'], flags & ~readinglog.CONTROL,
+                 flags & readinglog.CONTROL)
+
+    def add_result(self, result):
+        """
+        Add one Result, say as a ContourUSB on_result callback
+
+        Results are collected and added as a batch when the statistics
+        are next read, or on flush().
+        """
+        time, value, unit, flags, control = self._pending
+        time.append(store.NOTIME if result.time is None else result.time)
+        value.append(float('nan') if result.value is None else result.value)
+        unit.append(MMOL if result.unit == 'mmol/L' else MGDL)
+        flags.append(result.flags)
+        control.append(result.is_control)
+
+    def flush(self):
+        pending, self._pending = self._pending, ([], [], [], [], [])
+        if pending[0]:
+            self.add(*pending)
+
+    def stats(self):
+        "Return the overall Stats"
+        self.flush()
+        return self.overall
+
+    def daily(self):
+        "Return [(day, Stats)] in day order, day as the epoch of its start"
+        self.flush()
+        return sorted(self.days.items())
+
+    def hourly(self):
+        "Return the Stats of each hour of the day"
+        self.flush()
+        return list(self.hours)
+
+    def meal(self):
+        "Return the Stats of before food, after food and other results"
+        self.flush()
+        return dict(self.meals)
+
+    def time_in_range(self):
+        "Return the fractions of results below, in and above the range"
+        self.flush()
+        n = float(self.overall.n)
+        if not n:
+            return None
+        return {'below': self.below / n, 'in': self.inrange / n,
+                'above': self.above / n}
+
+    def a1c(self):
+        "Estimated A1c in percent from the mean glucose (ADAG)"
+        mean = self.stats().mean
+        return None if mean is None else (mean + 46.7) / 28.7
@@ -0,0 +1,144 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""SQLite archive of meter results
+
+Results of any number of meters are kept in one table, deduplicated on
+(meter_serial, recno, time) and indexed on (meter_serial, time) so a
+time window of one meter is a range scan.
+"""
+
+import math
+import sqlite3
+
+import store
+import contourusb
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS result (
+    meter_serial TEXT NOT NULL,
+    recno INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    value REAL,
+    unit TEXT,
+    reference TEXT,
+    meastype TEXT,
+    flags INTEGER NOT NULL,
+    control INTEGER NOT NULL,
+    UNIQUE (meter_serial, recno, time)
+);
+CREATE INDEX IF NOT EXISTS result_serial_time ON result (meter_serial, time);
+"""
+
+_COLUMNS = 'meter_serial, recno, time, value, unit, reference, meastype, ' \
+           'flags, control'
+
+class Reading(store.ResultFields):
+    "A result read back from the archive"
+    __slots__ = ('meter_serial', 'recno', 'time', 'value', 'unit',
+                 'reference', 'meastype', 'flags', 'is_control')
+
+    flagmap = contourusb.resultflagmap
+    methodmap = contourusb.referencemap
+
+    def __init__(self, row):
+        (self.meter_serial, self.recno, self.time, self.value, self.unit,
+         self.reference, self.meastype, self.flags, control) = row
+        self.is_control = bool(control)
+
+    def asdict(self):
+        d = store.ResultFields.asdict(self)
+        d['meter_serial'] = self.meter_serial
+        return d
+
+def _reading(result):
+    "Has result a value and a time? A ResultStore has NaN and NOTIME"
+    value, t = result.value, result.time
+    return value is not None and not math.isnan(value) and \
+        t is not None and t != store.NOTIME
+
+class Archive(object):
+    """
+    Results of many meters in an SQLite database
+
+    path is anything sqlite3.connect() takes, ':memory:' included.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, serial, results):
+        """
+        Store results of the meter serial, in one transaction
+
+        Results already in the archive are left alone, and so are
+        results without a reading (an O record whose R never came).
+        Returns the number of new rows.
+        """
+        rows = ((serial, r.recno, r.time, r.value, r.unit, r.reference,
+                 r.meastype, r.flags, int(bool(r.is_control)))
+                for r in results if _reading(r))
+        before = self.db.total_changes
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO result (%s) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+                                % _COLUMNS, rows)
+        return self.db.total_changes - before
+
+    def ingest(self, cu):
+        "Store the results of a synced ContourUSB"
+        return self.add(cu.meter_serial, cu.result.values())
+
+    def readings(self, serial=None, start=None, end=None):
+        """
+        Iterate over the readings in [start, end), oldest first
+
+        start and end are epoch times, either may be None for an open
+        end. Rows are fetched as the iterator is consumed.
+        """
+        where, args = [], []
+        if serial is not None:
+            where.append('meter_serial = ?')
+            args.append(serial)
+        if start is not None:
+            where.append('time >= ?')
+            args.append(start)
+        if end is not None:
+            where.append('time < ?')
+            args.append(end)
+        sql = 'SELECT %s FROM result' % _COLUMNS
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY time, meter_serial, recno'
+        for row in self.db.execute(sql, args):
+            yield Reading(row)
+
+    def serials(self):
+        return [row[0] for row in self.db.execute(
+            'SELECT DISTINCT meter_serial FROM result ORDER BY meter_serial')]
+
+    def newest(self, serial):
+        "Return (recno, time) of the newest reading of serial, or None"
+        row = self.db.execute('SELECT recno, time FROM result '
+                              'WHERE meter_serial = ? '
+                              'ORDER BY time DESC, recno DESC LIMIT 1',
+                              (serial,)).fetchone()
+        return None if row is None else tuple(row)
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM result').fetchone()[0]
@@ -0,0 +1,245 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""ASTM E1394 records
+
+Decoder turns record texts into Record objects through a table keyed
+on the record type. A record keeps its text and splits it only when a
+field is first asked for; the named fields of each type are properties
+that decode just that field. Record types without a class here come
+back as a plain Record rather than raising.
+
+Field numbers are indices into the text split on the field separator,
+so 0 is the record type, as in ContourUSB.
+"""
+
+import store
+
+RECORD_TYPES = {
+    'H': 'header',
+    'P': 'patient',
+    'O': 'order',
+    'R': 'result',
+    'C': 'comment',
+    'M': 'manufacturer',
+    'Q': 'request',
+    'L': 'terminator',
+    'S': 'scientific',
+    }
+
+class Separators(object):
+    "Field, repeat, component and escape separators"
+    __slots__ = ('field', 'repeat', 'component', 'escape')
+
+    def __init__(self, field='|', repeat='\\', component='^', escape='&'):
+        self.field = field
+        self.repeat = repeat
+        self.component = component
+        self.escape = escape
+
+    @classmethod
+    def from_header(cls, text):
+        "The separators an H record declares"
+        return cls(*text[1:5])
+
+def field(index, decode=None, doc=None):
+    "A record property for field index, decoded by decode(record, raw)"
+    if decode is None:
+        def get(self):
+            return self.field(index)
+    else:
+        def get(self):
+            return decode(self, self.field(index))
+    return property(get, doc=doc)
+
+def _int(record, raw):
+    return int(raw) if raw else None
+
+def _component(n):
+    def decode(record, raw):
+        parts = raw.split(record.seps.component)
+        return parts[n] if n < len(parts) else None
+    return decode
+
+class Record(object):
+    "A record of unknown type"
+    __slots__ = ('text', 'seps', '_fields')
+
+    rectype = None
+
+    def __init__(self, text, seps):
+        self.text = text
+        self.seps = seps
+        self._fields = None
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = self.text.split(self.seps.field)
+        return self._fields
+
+    def field(self, index):
+        "The raw text of a field, '' if the record is shorter"
+        fields = self.fields
+        return fields[index] if index < len(fields) else ''
+
+    def components(self, index):
+        return self.field(index).split(self.seps.component)
+
+    def repeats(self, index):
+        return self.field(index).split(self.seps.repeat)
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.text)
+
+class HeaderRecord(Record):
+    __slots__ = ()
+    rectype = 'H'
+
+    password = field(3)
+    product = field(4, _component(0))
+    serial = field(4, _component(2))
+    sku = field(4, _component(3))
+    result_count = field(6, _int)
+    processing_id = field(11)
+    spec_version = field(12)
+    datetime = field(13)
+
+    @property
+    def versions(self):
+        versions = _component(1)(self, self.field(4))
+        return versions.split(self.seps.repeat) if versions else []
+
+    @property
+    def device_info(self):
+        return dict(i.split('=', 1) for i in self.components(5) if i)
+
+    @property
+    def time(self):
+        raw = self.datetime
+        return store.parsetime(raw) if raw else None
+
+class PatientRecord(Record):
+    __slots__ = ()
+    rectype = 'P'
+
+    seq = field(1, _int)
+
+class OrderRecord(Record):
+    __slots__ = ()
+    rectype = 'O'
+
+    seq = field(1, _int)
+    action = field(11, doc="Action code, Q for quality control")
+
+    @property
+    def is_control(self):
+        return self.action == 'Q'
+
+class ResultRecord(Record):
+    __slots__ = ()
+    rectype = 'R'
+
+    recno = field(1, _int)
+    meastype = field(2, _component(3))
+    value = field(3, lambda self, raw: float(raw) if raw else None)
+    unit = field(4, _component(0))
+    reference = field(4, _component(1))
+    testtime = field(8)
+
+    @property
+    def flagcodes(self):
+        # The meter separates the flags with '/', not the repeat separator
+        return [f for f in self.field(6).split('/') if f]
+
+    @property
+    def flags(self):
+        return store.flagbits(self.flagcodes)
+
+    @property
+    def time(self):
+        raw = self.testtime
+        return store.parsetime(raw) if raw else None
+
+class CommentRecord(Record):
+    __slots__ = ()
+    rectype = 'C'
+
+    seq = field(1, _int)
+    source = field(2)
+    comment = field(3)
+    kind = field(4)
+
+class ManufacturerRecord(Record):
+    __slots__ = ()
+    rectype = 'M'
+
+    seq = field(1, _int)
+
+class RequestRecord(Record):
+    __slots__ = ()
+    rectype = 'Q'
+
+    seq = field(1, _int)
+    start = field(2)
+    end = field(3)
+
+class TerminatorRecord(Record):
+    __slots__ = ()
+    rectype = 'L'
+
+    seq = field(1, _int)
+    code = field(3, doc="Termination code, N for normal")
+
+class ScientificRecord(Record):
+    __slots__ = ()
+    rectype = 'S'
+
+    seq = field(1, _int)
+
+class Decoder(object):
+    """
+    Decode record texts into Records
+
+    An H record changes the separators used for the records after it.
+    """
+    types = dict((cls.rectype, cls) for cls in (
+        HeaderRecord, PatientRecord, OrderRecord, ResultRecord,
+        CommentRecord, ManufacturerRecord, RequestRecord,
+        TerminatorRecord, ScientificRecord))
+
+    def __init__(self, seps=None):
+        self.seps = seps or Separators()
+
+    def decode(self, text):
+        rectype = text[:1]
+        if rectype == 'H':
+            self.seps = Separators.from_header(text)
+        return self.types.get(rectype, Record)(text, self.seps)
+
+    def records(self, texts, types=None):
+        """
+        Iterate over the decoded records of texts
+
+        With types (a string of record types) only those are returned,
+        the others are skipped without building a record.
+        """
+        decode = self.decode
+        for text in texts:
+            rectype = text[:1]
+            if types is None or rectype in types:
+                yield decode(text)
+            elif rectype == 'H':
+                self.seps = Separators.from_header(text)
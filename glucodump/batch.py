@@ -0,0 +1,192 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Decode directories of meter dumps on all cores
+
+Each file, a capture or a raw byte log, is decoded by a worker process
+of a multiprocessing pool. Results come back as Chunks holding the
+ResultStore columns as packed strings, a few thousand results at a
+time, rather than as pickled Result objects. Workers send each Chunk
+as soon as it fills, so a big file is never held whole. A file that
+fails to decode gives a Chunk with error set and the batch goes on.
+
+usage: python -m glucodump.batch [--archive PATH] FILE-OR-DIR ...
+"""
+
+import array
+import os
+import sys
+import multiprocessing
+
+import capture
+import contourusb
+import decode
+import store
+
+class Chunk(object):
+    """
+    Decoded results of (part of) one file
+
+    columns maps store.ResultStore column names to packed arrays, units
+    and meastypes are the names of the codes in them. errors are the
+    (offset, message) of frames that were dropped; error is set, and
+    columns empty, when the file could not be decoded at all.
+    """
+    def __init__(self, path, serial=None, columns=None, units=(),
+                 meastypes=(), errors=(), error=None):
+        self.path = path
+        self.serial = serial
+        self.columns = columns or {}
+        self.units = list(units)
+        self.meastypes = list(meastypes)
+        self.errors = list(errors)
+        self.error = error
+
+    def __len__(self):
+        recno = self.columns.get('recno')
+        return len(recno) // array.array('i').itemsize if recno else 0
+
+    def store(self):
+        "Return the results as a store.ResultStore"
+        return store.ResultStore.fromstrings(
+            self.columns, self.units, self.meastypes,
+            flagmap=contourusb.resultflagmap,
+            methodmap=contourusb.referencemap)
+
+def frames(path, fd):
+    "Yield the frame texts of a capture or raw log file, decoded by fd"
+    with open(path, 'rb') as f:
+        if f.read(len(capture.MAGIC)) == capture.MAGIC:
+            chunks = (data for delay, data in
+                      capture.ReplayDevice.messages(path))
+        else:
+            f.seek(0)
+            chunks = iter(lambda: f.read(1 << 20), '')
+        for text in fd.decode(chunks):
+            yield text
+
+def _store():
+    return store.ResultStore(flagmap=contourusb.resultflagmap,
+                             methodmap=contourusb.referencemap)
+
+def _chunk(path, cu, results, errors):
+    columns = dict((name, getattr(results, name).tostring())
+                   for name, typecode in results.columns)
+    return Chunk(path, getattr(cu, 'meter_serial', None), columns,
+                 results.units.names, results.meastypes.names, errors)
+
+def decode_path(path, chunksize=10000):
+    """
+    Decode one file, yielding a Chunk each time chunksize results are in
+
+    Each Chunk has the frame errors since the one before. There is
+    always at least one Chunk, and a failure ends the file with a Chunk
+    with error set.
+    """
+    fd = decode.FrameDecoder()
+    cu = contourusb.ContourUSB(keep=False)
+    results = _store()
+    sent = reported = 0
+    try:
+        for result in cu.iterresults(frames(path, fd)):
+            results.add(result)
+            if len(results) == chunksize:
+                yield _chunk(path, cu, results, fd.errors[reported:])
+                sent += 1
+                reported = len(fd.errors)
+                results = _store()
+    except Exception, e:
+        yield Chunk(path, error='%s: %s' % (e.__class__.__name__, e))
+        return
+    if len(results) or not sent or len(fd.errors) > reported:
+        yield _chunk(path, cu, results, fd.errors[reported:])
+
+def paths(args):
+    "Expand directories to the files in them, recursively"
+    for arg in args:
+        if not os.path.isdir(arg):
+            yield arg
+            continue
+        for dirpath, dirnames, filenames in os.walk(arg):
+            dirnames.sort()
+            for name in sorted(filenames):
+                yield os.path.join(dirpath, name)
+
+def decode_files(files, processes=None, chunksize=10000):
+    """
+    Decode files on a process pool, yielding Chunks as they are done
+
+    Chunks of one file come in order, files in whatever order they
+    finish. Workers hand each Chunk over a queue as soon as it is
+    decoded, and wait while the queue is full.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    queue = multiprocessing.Queue(4 * processes)
+    pool = multiprocessing.Pool(processes, _init, (queue,))
+    try:
+        pending = 0
+        for path in files:
+            pool.apply_async(_decode_path, (path, chunksize))
+            pending += 1
+        while pending:
+            chunk = queue.get()
+            if chunk is None:
+                # a file is done
+                pending -= 1
+                continue
+            yield chunk
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+_queue = None
+
+def _init(queue):
+    global _queue
+    _queue = queue
+
+def _decode_path(path, chunksize):
+    try:
+        for chunk in decode_path(path, chunksize):
+            _queue.put(chunk)
+    finally:
+        _queue.put(None)
+
+def main(argv):
+    args = argv[1:]
+    db = None
+    if '--archive' in args[:-1]:
+        i = args.index('--archive')
+        import archive
+        db = archive.Archive(args[i + 1])
+        del args[i:i+2]
+    failed = 0
+    for chunk in decode_files(paths(args)):
+        if chunk.error is not None:
+            failed += 1
+            print >>sys.stderr, '%s: %s' % (chunk.path, chunk.error)
+            continue
+        for offset, msg in chunk.errors:
+            print >>sys.stderr, '%s@%d: %s' % (chunk.path, offset, msg)
+        print '%s: %s %d results' % (chunk.path, chunk.serial, len(chunk))
+        if db is not None and len(chunk):
+            db.add(chunk.serial, chunk.store().values())
+    if db is not None:
+        db.close()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
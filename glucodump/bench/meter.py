@@ -0,0 +1,126 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"Synthetic Contour USB transfers for benchmarks and tests"
+
+import random
+import time
+import StringIO
+
+from .. import capture, contourusb
+
+HEADER = 'H|\\^&||uvmjq4|Bayer7390^01.20\\01.04\\04.02.19^%s^7396-|' \
+    'A=1^C=63^G=1^I=0200^R=0^S=1^U=1^V=10600^X=070070070099180135180248' \
+    '^Y=360126090050099050300089^Z=1|%d||||||1|%s'
+
+FLAGS = ['', '', '', 'B', 'A', 'A/Z2', 'A/Z8', 'D', 'I/B', 'X']
+
+def records(results, serial='7390-1163170', start=1293840000, seed=0):
+    """
+    Return the record texts a meter with the given number of results
+    would send, oldest reading first
+    """
+    rnd = random.Random(seed)
+    when = start + 60 * 60 * 4 * results
+    recs = [HEADER % (serial, results,
+                      time.strftime('%Y%m%d%H%M', time.gmtime(when))),
+            'P|1']
+    for recno in range(1, results + 1):
+        testtime = time.strftime('%Y%m%d%H%M',
+                                 time.gmtime(start + 60 * 60 * 4 * recno))
+        value = rnd.randint(40, 400)
+        if rnd.random() < 0.02:
+            recs.append('O|%d||||||||||Q' % recno)
+        recs.append('R|%d|^^^Glucose|%d|mg/dL^P||%s||%s' %
+                    (recno, value, rnd.choice(FLAGS), testtime))
+    recs.append('L|1||N')
+    return recs
+
+def checksum(text):
+    return '%02X' % (sum(bytearray(text)) % 256)
+
+def frames(recs):
+    "Wrap record texts in ASTM frames"
+    result = []
+    for i, text in enumerate(recs):
+        check = '%d%s\x0d\x17' % ((i + 1) % 8, text)
+        result.append('\x02%s%s\x0d\x0a' % (check, checksum(check)))
+    return result
+
+def reports(data, prefix='ABC', pad=True):
+    "Split data into HID reports the way the meter sends them"
+    result = []
+    size = capture.ReplayDevice.blocksize - 4
+    pos = 0
+    while True:
+        now = data[pos:pos+size]
+        pos += size
+        report = prefix + chr(len(now)) + now
+        if pad:
+            report += '\0' * (size - len(now))
+        result.append(report)
+        if len(now) != size:
+            break
+    return result
+
+def transfer(recs):
+    """
+    Return the (direction, message) exchange of a complete data transfer
+    """
+    exchange = [(capture.WRITE, '\x04'), (capture.READ, '\x04\x05')]
+    for frame in frames(recs):
+        exchange.append((capture.WRITE, '\x06'))
+        exchange.append((capture.READ, frame))
+    exchange.append((capture.WRITE, '\x06'))
+    exchange.append((capture.READ, '\x04'))
+    return exchange
+
+def write_capture(f, recs, start=0.0, latency=0.002, perreport=0.001):
+    """
+    Write a capture of a transfer of recs to f, as USBComm would have
+    """
+    writer = capture.CaptureWriter(f)
+    now = start
+    for direction, data in transfer(recs):
+        if direction == capture.WRITE:
+            for report in reports(data, prefix='\0\0\0', pad=False):
+                writer.report(direction, report, now)
+            now += latency
+        else:
+            for report in reports(data):
+                writer.report(direction, report, now)
+                now += perreport
+    writer.close()
+
+def capture_data(recs, **kw):
+    "Return a capture of a transfer of recs as a string, see write_capture"
+    f = StringIO.StringIO()
+    write_capture(f, recs, **kw)
+    return f.getvalue()
+
+def replay(recs, **kw):
+    "Return a capture.ReplayDevice playing a transfer of recs"
+    return capture.ReplayDevice(StringIO.StringIO(capture_data(recs, **kw)))
+
+def synced(results, serial='7390-1163170', start=1293840000, **kw):
+    """
+    Return a contourusb.ContourUSB that has parsed the records of a meter
+    with the given number of results; kw goes to ContourUSB
+    """
+    cu = contourusb.ContourUSB(**kw)
+    for text in records(results, serial=serial, start=start):
+        cu.record(text)
+    cu.flush()
+    return cu
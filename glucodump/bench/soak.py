@@ -0,0 +1,233 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Soak stream.Stream with a simulated meter and many clients
+
+A simulated Contour sends result frames at a steady rate in place of
+the USB device. N clients connect to the stream, some of them slow
+readers, and every client notes when each frame arrives. Reported are
+the p50/p99 latency from the meter read to the client recv for the
+normal clients, the frames delivered per second, the growth of the
+resident set size over the run, and whether the stream survived.
+
+usage: python -m glucodump.bench.soak [clients [slow [seconds [rate]]]]
+"""
+
+import errno
+import re
+import resource
+import socket
+import sys
+import threading
+import time
+
+from .. import stream
+from .. import usbcomm
+from . import meter
+
+_recno = re.compile(r'\x02[0-7]R\|(\d+)\|')
+
+def rss():
+    "Resident set size of this process in KiB"
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except IOError:
+        return None
+    return pages * resource.getpagesize() // 1024
+
+class SimulatedContour(object):
+    """
+    Stands in for USBComm, sending one R frame every 1/rate seconds
+
+    Frames are numbered by recno and sent[recno] is the time read()
+    returned it. Nothing is sent until the started event is set.
+    """
+    def __init__(self, rate=200.0, results=None):
+        self.rate = float(rate)
+        self.frames = meter.frames(
+            [text for text in meter.records(results or 100000)
+             if text[0] == 'R'])
+        self.sent = {}
+        self.next = 0
+        self.start = None
+        self.lock = threading.Lock()
+        self.started = threading.Event()
+
+    def read(self, timeout=None):
+        if not self.started.is_set():
+            self.started.wait(None if timeout is None else timeout / 1000.0)
+            if not self.started.is_set():
+                raise usbcomm.usb.core.USBError('timeout', errno=errno.ETIMEDOUT)
+        now = time.time()
+        if self.start is None:
+            self.start = now
+        due = self.start + self.next / self.rate
+        if due > now:
+            wait = due - now
+            if timeout is not None and wait > timeout / 1000.0:
+                time.sleep(timeout / 1000.0)
+                raise usbcomm.usb.core.USBError('timeout', errno=errno.ETIMEDOUT)
+            time.sleep(wait)
+        if self.next >= len(self.frames):
+            raise usbcomm.usb.core.USBError('no more frames', errno=errno.EIO)
+        frame = self.frames[self.next]
+        self.next += 1
+        with self.lock:
+            self.sent[self.next] = time.time()
+        return frame
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+class Client(threading.Thread):
+    """
+    Read from the stream, noting the arrival time of each frame
+
+    A slow client reads bufsize bytes every delay seconds.
+    """
+    def __init__(self, port, bufsize=65536, delay=0.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.create_connection(('localhost', port))
+        self.bufsize = bufsize
+        self.delay = delay
+        self.arrived = {}
+        self.bytes = 0
+        self.stopped = False
+
+    def run(self):
+        self.sock.settimeout(0.1)
+        pending = ''
+        while not self.stopped:
+            try:
+                data = self.sock.recv(self.bufsize)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            if not data:
+                break
+            now = time.time()
+            self.bytes += len(data)
+            pending += data
+            end = 0
+            for match in _recno.finditer(pending):
+                self.arrived[int(match.group(1))] = now
+                end = match.end()
+            pending = pending[max(end, len(pending) - 64):]
+            if self.delay:
+                time.sleep(self.delay)
+        self.sock.close()
+
+    def stop(self):
+        self.stopped = True
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def soak(clients=8, slow=1, seconds=10.0, rate=200.0, port=None):
+    """
+    Run a stream with clients clients, slow of them slow, for seconds
+
+    Returns a dict of the measurements.
+    """
+    if port is None:
+        port = stream._default_port
+    dev = SimulatedContour(rate, results=int(seconds * rate) + 1000)
+    s = stream.Stream(port=port, device=dev)
+    s.start()
+    port = s.server.getsockname()[1]
+    error = []
+
+    def serve():
+        try:
+            while not done.is_set():
+                s.run_once(100)
+        except Exception, e:
+            error.append(e)
+
+    done = threading.Event()
+    server = threading.Thread(target=serve)
+    server.daemon = True
+    server.start()
+
+    readers = [Client(port, 256, 0.05) for i in range(slow)] + \
+              [Client(port) for i in range(clients - slow)]
+    while len(s.clients) < len(readers) and not error:
+        time.sleep(0.01)
+    for c in readers:
+        c.start()
+    dev.started.set()
+
+    rss0 = rss()
+    start = time.time()
+    while time.time() - start < seconds and not error:
+        time.sleep(0.1)
+    done.set()
+    s.reader.stop()
+    elapsed = time.time() - start
+    rss1 = rss()
+    for c in readers:
+        c.stop()
+    server.join(1)
+    for c in readers:
+        c.join(1)
+    s.close()
+
+    latencies = []
+    delivered = 0
+    with dev.lock:
+        sent = dict(dev.sent)
+    for c in readers[slow:]:
+        delivered += len(c.arrived)
+        latencies.extend(c.arrived[recno] - sent[recno]
+                         for recno in c.arrived if recno in sent)
+    return {
+        'clients': clients,
+        'slow': slow,
+        'seconds': elapsed,
+        'frames': len(sent),
+        'delivered': delivered,
+        'per_second': delivered / elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'rss_growth': None if rss0 is None else rss1 - rss0,
+        'slow_frames': [len(c.arrived) for c in readers[:slow]],
+        'error': repr(error[0]) if error else None,
+        }
+
+def main(argv):
+    args = [float(a) for a in argv[1:]]
+    clients, slow, seconds, rate = (args + [8, 1, 10, 200][len(args):])[:4]
+    r = soak(int(clients), int(slow), seconds, rate)
+    ms = lambda t: '-' if t is None else '%.2fms' % (t * 1000)
+    print '%d clients (%d slow), %.1fs, %d frames sent' % (
+        r['clients'], r['slow'], r['seconds'], r['frames'])
+    print 'latency p50 %s p99 %s' % (ms(r['p50']), ms(r['p99']))
+    print '%.0f frames/s delivered to normal clients' % r['per_second']
+    print 'slow clients got %s frames' % r['slow_frames']
+    print 'rss growth %s KiB' % r['rss_growth']
+    if r['error'] is not None:
+        print 'stream failed: %s' % r['error']
+
+if __name__ == '__main__':
+    main(sys.argv)
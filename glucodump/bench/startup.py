@@ -0,0 +1,81 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Time interpreter startup for short lived glucodump commands
+
+Each case runs in a fresh interpreter; the best and median wall times
+over the runs are reported, together with the heavy modules (pyusb,
+NumPy, sqlite3) the case ended up importing.
+
+usage: python -m glucodump.bench.startup [runs]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import meter
+
+HEAVY = ['usb', 'numpy', 'sqlite3']
+
+def cases(capture):
+    decode = 'from glucodump import main; main.main(["glucodump", ' \
+        '"decode", %r])' % capture
+    return [
+        ('python', 'pass'),
+        ('import glucodump.contourusb', 'import glucodump.contourusb'),
+        ('import glucodump.decode', 'import glucodump.decode'),
+        ('import glucodump.main', 'import glucodump.main'),
+        ('import usbcomm + usb.core', 'import glucodump.usbcomm as u; u.usb.core'),
+        ('main decode', decode),
+        ]
+
+def run(code, runs):
+    "Return the sorted wall times and the heavy modules code imports"
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            t0 = time.time()
+            subprocess.check_call([sys.executable, '-c', code],
+                                  stdout=devnull)
+            times.append(time.time() - t0)
+        probe = code + '\nimport sys\nsys.stdout = sys.__stdout__\n' \
+            'sys.stdout.write(" ".join(m for m in %r if m in sys.modules))' \
+            % HEAVY
+        out = subprocess.Popen([sys.executable, '-c', probe],
+                               stdout=subprocess.PIPE).communicate()[0]
+    return sorted(times), out.split('\n')[-1].split()
+
+def main(argv):
+    runs = int(argv[1]) if len(argv) > 1 else 10
+    tmp = tempfile.mkdtemp()
+    try:
+        capture = os.path.join(tmp, 'meter.cap')
+        with open(capture, 'wb') as f:
+            meter.write_capture(f, meter.records(100))
+        print '%-30s %9s %9s  %s' % ('case', 'best', 'median', 'loaded')
+        for name, code in cases(capture):
+            times, loaded = run(code, runs)
+            print '%-30s %7.1fms %7.1fms  %s' % (
+                name, times[0] * 1000, times[len(times) // 2] * 1000,
+                ' '.join(loaded) or '-')
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main(sys.argv)
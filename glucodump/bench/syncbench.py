@@ -0,0 +1,88 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Time BayerCOMM.sync() and ContourUSB.record() on replayed transfers
+
+The protocol column times BayerProtocol alone on the same messages,
+with no device in between.
+
+usage: python -m glucodump.bench.syncbench [results ...]
+"""
+
+import sys
+import time
+import StringIO
+
+from .. import capture, contourusb
+from . import meter
+
+SIZES = [100, 1000, 10000, 100000]
+
+def make_capture(results):
+    f = StringIO.StringIO()
+    meter.write_capture(f, meter.records(results))
+    return StringIO.StringIO(f.getvalue())
+
+def bench(results, repeat=3):
+    """
+    Return the best (sync, record, total) times over repeat runs
+    """
+    dev = capture.ReplayDevice(make_capture(results))
+    best = None
+    for i in range(repeat):
+        dev.rewind()
+        bc = contourusb.BayerCOMM(dev)
+        cu = contourusb.ContourUSB()
+        t0 = time.time()
+        frames = list(bc.sync())
+        t1 = time.time()
+        for text in frames:
+            cu.record(text)
+        t2 = time.time()
+        assert len(cu.result) == results
+        times = (t1 - t0, t2 - t1, t2 - t0)
+        if best is None or times[2] < best[2]:
+            best = times
+    return best
+
+def bench_protocol(results, repeat=3):
+    "Return the best time to run the link protocol over a transfer"
+    messages = [data for delay, data in
+                capture.ReplayDevice.messages(make_capture(results))]
+    best = None
+    for i in range(repeat):
+        bp = contourusb.BayerProtocol()
+        t0 = time.time()
+        bp.initiate()
+        for data in messages:
+            bp.receive(data)
+        t = time.time() - t0
+        if best is None or t < best:
+            best = t
+    return best
+
+def main(argv):
+    sizes = [int(a) for a in argv[1:]] or SIZES
+    print '%10s %10s %10s %10s %12s %10s' % ('results', 'sync', 'record',
+                                             'total', 'results/s', 'protocol')
+    for results in sizes:
+        repeat = 1 if results > 10000 else 3
+        sync, record, total = bench(results, repeat)
+        protocol = bench_protocol(results, repeat)
+        print '%10d %9.3fs %9.3fs %9.3fs %12.0f %9.3fs' % (
+            results, sync, record, total, results / total, protocol)
+
+if __name__ == '__main__':
+    main(sys.argv)
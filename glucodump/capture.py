@@ -0,0 +1,167 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"Capture and replay of HID reports exchanged with the meter"
+
+import struct
+import time
+
+MAGIC = 'GDCAP\x01'
+
+# Direction of a report, as seen from the host
+READ = '<'
+WRITE = '>'
+
+# timestamp, direction, report length
+_header = struct.Struct('<dcB')
+
+class CaptureError(Exception):
+    pass
+
+class ReplayExhausted(CaptureError):
+    pass
+
+def _open(f, mode):
+    if isinstance(f, basestring):
+        return open(f, mode), True
+    return f, False
+
+class CaptureWriter(object):
+    """
+    Write HID reports to a capture file
+
+    Each report is stored as a small fixed header (timestamp, direction
+    and length) followed by the raw report bytes.
+    """
+    def __init__(self, f, clock=time.time):
+        self.file, self._owned = _open(f, 'wb')
+        self.clock = clock
+        self.file.write(MAGIC)
+
+    def report(self, direction, data, timestamp=None):
+        if timestamp is None:
+            timestamp = self.clock()
+        data = str(data)
+        self.file.write(_header.pack(timestamp, direction, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        if self._owned:
+            self.file.close()
+        else:
+            self.file.flush()
+
+class CaptureReader(object):
+    "Iterate over (timestamp, direction, report) in a capture file"
+
+    def __init__(self, f):
+        self.file, self._owned = _open(f, 'rb')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise CaptureError("Not a capture file", f)
+
+    def __iter__(self):
+        read = self.file.read
+        size = _header.size
+        unpack = _header.unpack
+        while True:
+            header = read(size)
+            if not header:
+                break
+            if len(header) != size:
+                raise CaptureError("Truncated capture file")
+            timestamp, direction, length = unpack(header)
+            data = read(length)
+            if len(data) != length:
+                raise CaptureError("Truncated capture file")
+            yield timestamp, direction, data
+
+    def close(self):
+        if self._owned:
+            self.file.close()
+
+class ReplayDevice(object):
+    """
+    Play back a capture in place of USBComm
+
+    read() returns the same messages USBComm.read() returned when the
+    capture was made; write() just collects what the host sends. With
+    realtime=True each read is delayed by the time the meter originally
+    took to answer the preceding write, otherwise the capture is replayed
+    as fast as possible.
+    """
+    blocksize = 64
+
+    def __init__(self, f, realtime=False, sleep=time.sleep, clock=time.time):
+        self.realtime = realtime
+        self.sleep = sleep
+        self.clock = clock
+        self.written = []
+        self._messages = self.messages(f)
+        self._pos = 0
+        self._lastwrite = None
+
+    @classmethod
+    def messages(cls, f):
+        """
+        Reassemble the read reports of a capture into messages
+
+        Returns a list of (delay, message) where delay is the time between
+        the last host write and the first report of the message.
+        """
+        reader = CaptureReader(f)
+        messages = []
+        parts = []
+        start = last = None
+        try:
+            for timestamp, direction, data in reader:
+                if direction == WRITE:
+                    last = timestamp
+                    continue
+                if not parts:
+                    start = timestamp
+                length = ord(data[3])
+                parts.append(data[4:length+4])
+                if length != cls.blocksize-4:
+                    delay = 0.0 if last is None else max(0.0, start - last)
+                    messages.append((delay, ''.join(parts)))
+                    parts = []
+        finally:
+            reader.close()
+        return messages
+
+    def rewind(self):
+        self._pos = 0
+        self._lastwrite = None
+        self.written = []
+
+    def read(self, timeout=None):
+        "Return the next message; timeout is accepted as by USBComm.read()"
+        if self._pos >= len(self._messages):
+            raise ReplayExhausted("No more data in capture")
+        delay, data = self._messages[self._pos]
+        self._pos += 1
+        if self.realtime and self._lastwrite is not None:
+            remain = delay - (self.clock() - self._lastwrite)
+            if remain > 0:
+                self.sleep(remain)
+        return data
+
+    def write(self, data):
+        self.written.append(data)
+        if self.realtime:
+            self._lastwrite = self.clock()
+
+    def close(self):
+        pass
@@ -16,32 +16,55 @@
 "Communication with Bayer Contour USB meter"
 
 import usbcomm
+import collections
+import errno
 import re
+import sys
+import threading
 import time
+import Queue
+from loop import Return
+import store
+import astm
+import tracing
 
 class FrameError(Exception):
     pass
 
-class BayerCOMM(object):
-    "Framing for Bayer meters"
+class BayerProtocol(object):
+    """
+    Link layer of the Bayer meters, without any I/O
+
+    Feed whatever the meter sent to receive() and write back what it
+    returns. Nothing in here touches the device, so it can be driven
+    by blocking calls (BayerCOMM), an event loop (AsyncBayerCOMM) or
+    canned data.
+    """
 
     framere = re.compile('\x02(?P<check>(?P<recno>[0-7])(?P<text>[^\x0d]*)'
                          '\x0d(?P<end>[\x03\x17]))'
                          '(?P<checksum>[0-9A-F][0-9A-F])\x0d\x0a')
 
-    mode_establish = object
+    mode_establish = None
     mode_data = object()
     mode_precommand = object()
     mode_command = object()
 
-    def __init__(self, dev):
-        self.dev = dev
+    def __init__(self, trace=None, wakeup=None, probe_timeout=None):
         self.currecno = None
         self.state = self.mode_establish
+        self.probe = 0
+        self.probes = 0
+        self.wakeup = wakeup
+        self.wakeup_used = None
+        self.established = False
+        self._lastprobe = None
+        self.probe_timeout = probe_timeout
+        self.interrupted = False
+        self.trace = trace or tracing.null
 
     def checksum(self, text):
-        checksum = hex(sum(ord(c) for c in text) % 256).upper().split('X')[1]
-        return ('00' + checksum)[-2:]
+        return '%02X' % (sum(bytearray(text)) % 256)
 
     def checkframe(self, frame):
         match = self.framere.match(frame)
@@ -53,6 +76,8 @@ class BayerCOMM(object):
             self.currecno = recno
         
         if recno + 1 == self.currecno:
+            if self.trace.enabled:
+                self.trace.count('protocol.retransmit')
             return None
         
         if recno != self.currecno:
@@ -68,55 +93,262 @@ class BayerCOMM(object):
 
         self.currecno = (self.currecno + 1) % 8
 
-        print 'text: %r' % match.group('text')
+        if self.trace.enabled:
+            self.trace.log('text: %r' % match.group('text'))
         return match.group('text')
-        
-    def sync(self):
+
+    def initiate(self):
+        "Start a data transfer, returns what to send to the meter"
+        self.probe = 0
+        self.probes = 0
+        self.wakeup_used = None
+        self.established = False
+        self._lastprobe = None
+        self.interrupted = False
+        return '\x04'
+
+    def nextprobe(self):
         """
-        Sync with meter and yield received data frames
+        Return the next byte to wake the meter with
+
+        wakeup, the byte that got the meter going last time, is tried
+        first, then every byte in turn.
         """
-        tometer = '\x04'
+        if self.probes == 0 and self.wakeup is not None:
+            tometer = self.wakeup
+        else:
+            tometer = chr(self.probe)
+            self.probe = (self.probe + 1) % 256
+            if tometer == self.wakeup:
+                return self.nextprobe()
+        self.probes += 1
+        self._lastprobe = tometer
+        return tometer
+
+    def readtimeout(self):
+        "Timeout for the next read: probe_timeout during the handshake"
+        if self.established:
+            return None
+        return self.probe_timeout
+
+    def timedout(self, e):
+        "Whether exception e is a read timing out while probing"
+        return self.probe_timeout is not None and not self.established \
+            and getattr(e, 'errno', None) == errno.ETIMEDOUT
+
+    def interrupt(self):
+        """
+        Ask the meter to end the transfer early
+
+        Frames after this are answered with <EOT> instead of <ACK>, the
+        receiver interrupt of ASTM E1381. The meter may ignore it and
+        keep sending; those frames are still checked but not returned.
+        """
+        self.interrupted = True
+
+    def receive(self, data):
+        """
+        Handle data read from the meter
+
+        Returns (tometer, frame). tometer is what to send next, or None
+        when the transfer is complete. frame is the text of a new data
+        frame, to be handed on after tometer has been sent, or None.
+        """
+        if self.state == self.mode_establish:
+            if data[-1] == '\x15':
+                # got a <NAK>, probe on
+                return self.nextprobe(), None
+            if data[-1] == '\x05':
+                # got an <ENQ>, send <ACK>
+                self.currecno = None
+                if not self.established:
+                    self.established = True
+                    self.wakeup_used = self._lastprobe
+                    if self._lastprobe is not None:
+                        self.wakeup = self._lastprobe
+                    if self.trace.enabled:
+                        self.trace.count('protocol.probes', self.probes)
+                return '\x06', None
+        if self.state == self.mode_data:
+            if data[-1] == '\x04':
+                # got an <EOT>, done
+                self.state = self.mode_precommand
+                return None, None
+        stx = data.find('\x02')
+        if stx != -1:
+            # got <STX>, parse frame
+            try:
+                result = self.checkframe(data[stx:])
+                self.state = self.mode_data
+                if self.interrupted:
+                    return '\x04', None
+                return '\x06', result
+            except FrameError, e:
+                if self.trace.enabled:
+                    self.trace.count('protocol.nak')
+                    self.trace.log(e)
+                return '\x15', None # Couldn't parse, <NAK>
+        else:
+            # Got something we don't understand, <NAK> it
+            if self.trace.enabled:
+                self.trace.count('protocol.nak')
+                self.trace.log('no STX')
+            return '\x15', None
+
+class BayerCOMM(BayerProtocol):
+    """
+    Framing for Bayer meters
+
+    With probe_timeout (in milliseconds) reads during the handshake
+    give up after that long, and silence counts as a <NAK>. wakeup is
+    the probe byte to try first, see BayerProtocol.nextprobe().
+    handshake_time and first_frame_time are the seconds from the start
+    of the last sync() to the <ENQ> and to the first data frame.
+    """
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, dev, trace=None, wakeup=None, probe_timeout=None):
+        BayerProtocol.__init__(self, trace, wakeup, probe_timeout)
+        self.dev = dev
+        self.handshake_time = None
+        self.first_frame_time = None
+        self.handshake_bytes = 0
+
+    def _read(self):
+        "Read from the meter, silence while probing counts as <NAK>"
+        timeout = self.readtimeout()
+        if timeout is None:
+            return self.dev.read()
+        try:
+            return self.dev.read(timeout)
+        except Exception, e:
+            if not self.timedout(e):
+                raise
+            return '\x15'
+
+    def _handshake(self, clock, start):
+        """
+        Wake the meter and read up to its first data frame
+
+        Returns (tometer, frame) like receive(), with frame the first
+        data frame (or None if the meter had nothing), and sets
+        handshake_time, first_frame_time and handshake_bytes.
+        """
+        trace = self.trace
+        self.handshake_time = self.first_frame_time = None
+        self.handshake_bytes = 0
+        tometer = self.initiate()
         result = None
-        foo = 0
-        while True:
-            print '>>>', repr(tometer)
+        while result is None and tometer is not None:
+            if trace.enabled:
+                trace.log('>>>', repr(tometer))
+            self.dev.write(tometer)
+            sent = clock()
+            data = self._read()
+            now = clock()
+            self.handshake_bytes += len(data)
+            if trace.enabled:
+                trace.log('***', repr(data))
+            tometer, result = self.receive(data)
+            if self.established and self.handshake_time is None:
+                self.handshake_time = now - start
+                if trace.enabled:
+                    trace.observe('sync.handshake', self.handshake_time)
+        if result is not None:
+            self.first_frame_time = now - start
+            if trace.enabled:
+                trace.count('sync.frames')
+                trace.observe('sync.frame_latency', now - sent)
+                trace.observe('sync.first_frame', self.first_frame_time)
+        return tometer, result
+
+    def sync(self, pipeline=0):
+        """
+        Sync with meter and yield received data frames
+
+        With pipeline the link runs on a thread of its own and frames
+        are handed over through a queue of at most that many, so the
+        meter is not kept waiting while the caller works on a frame.
+        """
+        if pipeline:
+            return self._pipelined(pipeline)
+        return self._sync()
+
+    def _sync(self):
+        trace = self.trace
+        clock = self.clock
+        start = clock()
+        tometer, result = self._handshake(clock, start)
+        received = self.handshake_bytes
+        while tometer is not None:
+            if trace.enabled:
+                trace.log('>>>', repr(tometer))
             self.dev.write(tometer)
-            if result is not None and self.state == self.mode_data:
+            if result is not None:
                 yield result
-            result = None
+            if trace.enabled:
+                sent = clock()
             data = self.dev.read()
-            print '***', repr(data)
-            if self.state == self.mode_establish:
-                if data[-1] == '\x15':
-                    # got a <NAK>, send <EOT>
-                    tometer = chr(foo)
-                    foo += 1
-                    foo %= 256
-                    continue
-                if data[-1] == '\x05':
-                    # got an <ENQ>, send <ACK>
-                    tometer = '\x06'
-                    self.currecno = None
-                    continue
-            if self.state == self.mode_data:
-                if data[-1] == '\x04':
-                    # got an <EOT>, done
-                    self.state = self.mode_precommand
-                    break
-            stx = data.find('\x02')
-            if stx != -1:
-                # got <STX>, parse frame
+            if trace.enabled:
+                now = clock()
+                received += len(data)
+                trace.log('***', repr(data))
+            tometer, result = self.receive(data)
+            if trace.enabled and result is not None:
+                trace.count('sync.frames')
+                trace.observe('sync.frame_latency', now - sent)
+
+        if trace.enabled:
+            duration = clock() - start
+            trace.count('sync.bytes', received)
+            trace.observe('sync.duration', duration)
+            if duration > 0:
+                trace.observe('sync.bytes_per_second', received / duration)
+
+    def _pipelined(self, maxsize):
+        "sync() with the link on a producer thread"
+        frames = Queue.Queue(maxsize)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
                 try:
-                    result = self.checkframe(data[stx:])
-                    tometer = '\x06'
-                    self.state = self.mode_data
-                except FrameError, e:
-                    print e
-                    tometer = '\x15' # Couldn't parse, <NAK>
+                    frames.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for frame in self._sync():
+                    if not put((frame, None)) and not self.interrupted:
+                        # the consumer is gone, end the transfer with
+                        # <EOT>s and read out what the meter still sends
+                        self.interrupt()
+            except Exception:
+                put((None, sys.exc_info()))
             else:
-                # Got something we don't understand, <NAK> it
-                print 'no STX'
-                tometer = '\x15'
+                put((None, None))
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+        try:
+            while True:
+                frame, exc = frames.get()
+                if frame is not None:
+                    yield frame
+                elif exc is not None:
+                    raise exc[0], exc[1], exc[2]
+                else:
+                    break
+        finally:
+            # If the caller gave up the producer ends the transfer; wait
+            # for it, so the link is idle when the caller closes dev
+            stop.set()
+            producer.join()
 
     def ensurecommand(self):
         if self.state == self.mode_command:
@@ -145,102 +377,387 @@ class BayerCOMM(object):
 
         Enter remote command mode if needed
         """
+        return self.commands([data])[0]
+
+    def commands(self, commands):
+        """Send several commands to the meter
+
+        Enters remote command mode once, then sends each command in turn.
+        Returns the list of replies, None for a command that wasn't ACKed.
+        """
         self.ensurecommand()
 
-        self.dev.write(data)
-        data = self.dev.read()
-        if data[-1] != '\x06':
-            return None
-        return data[:-1]
+        replies = []
+        for data in commands:
+            self.dev.write(data)
+            data = self.dev.read()
+            if data[-1] != '\x06':
+                replies.append(None)
+            else:
+                replies.append(data[:-1])
+        return replies
 
-class Result(object):
-    is_control = False
+class AsyncBayerCOMM(BayerProtocol):
+    """
+    Framing for Bayer meters, driven from a loop.EventLoop
 
-class ContourUSB(object):
-    "Class that knows how to parse data from Countour USB meter"
-
-    referencemap = { 'B' : 'whole blood', 'P' : 'plasma', 'C' : 'capillary',
-                     'D' : 'deproteinized whole blood' }
-    resultflagmap = {
-        '<' : 'result low', '>' : 'result high', 'C' : 'control',
-        'B' : 'before food', 'A' : 'after food', 'D' : "don't feel right",
-        'I' : 'sick', 'S' : 'stress', 'X' : 'activity',
-        'Z1' : '0.25 hours after food',
-        'Z2' : '0.50 hours after food',
-        'Z3' : '0.75 hours after food',
-        'Z4' : '1.00 hours after food',
-        'Z5' : '1.25 hours after food',
-        'Z6' : '1.50 hours after food',
-        'Z7' : '1.75 hours after food',
-        'Z8' : '2.00 hours after food',
-        'Z9' : '2.25 hours after food',
-        'ZA' : '2.50 hours after food',
-        'ZB' : '2.75 hours after food',
-        'ZC' : '3.00 hours after food',
-        }
-
-    def __init__(self):
-        self.field_sep = '|'
-        self.repeat_sep = '\\'
-        self.comp_sep = '^'
-        self.escape_sep = '&'
-
-        self.result = {}
-        self.results = False
+    The blocking dev.read() and dev.write() calls run in the loop's
+    executor so one loop can serve several meters. wakeup and
+    probe_timeout are as for BayerCOMM.
+    """
 
-    def record(self, text):
-        rectype = text[0]
-        fn = getattr(self, 'record_' + rectype)
-        if fn:
-            fn(text)
-
-    def record_H(self, text):
-        self.field_sep = text[1]
-        self.repeat_sep = text[2]
-        self.comp_sep = text[3]
-        self.escape_sep = text[4]
-        
-        fields = text[6:].split(self.field_sep)
+    def __init__(self, dev, loop, trace=None, wakeup=None,
+                 probe_timeout=None):
+        BayerProtocol.__init__(self, trace, wakeup, probe_timeout)
+        self.dev = dev
+        self.loop = loop
 
-        self.password = fields[1]
+    def sync(self, callback=None):
+        """
+        Sync with meter, returns a task
 
-        (self.meter_product, versions,
-         self.meter_serial, self.meter_sku) = fields[2].split(self.comp_sep)
-        self.meter_version = versions.split(self.repeat_sep)
+        Each received data frame is passed to callback, without one the
+        task result is the list of frames.
+        """
+        return self.loop.create_task(self._sync(callback))
 
-        self.device_info = dict(i.split('=') for i in fields[3].split(self.comp_sep))
-        self.result_count = int(fields[4])
-        self.processing_id = fields[9]
-        self.spec_version = fields[10]
-        self.header_datetime = fields[11]
-        
-    def record_P(self, text):
-        self.patient_info = int(text.split(self.field_sep)[1])
-
-    def record_O(self, text):
-        res = text.split(self.field_sep)
-        recno = int(res[1])
-        if recno not in self.result:
-            self.result[recno] = Result()
-
-        if len(res) >= 12:
-            if res[11] == 'Q':
-                self.result[recno].is_control = True
-
-    def record_R(self, text):
-        res = text.split(self.field_sep)
-        recno = int(res[1])
-        result = self.result.setdefault(recno, Result())
-
-        result.meastype = res[2].split(self.comp_sep)[3]
-        result.value = float(res[3])
-        result.unit, result.method = res[4].split(self.comp_sep)
-        result.method = self.referencemap[result.method]
-        # XXX bug in meter? should probably use '\' as repeat separator
-        result.resultflags = [self.resultflagmap[x] for x in res[6].split('/') if x]
-        result.testtime = res[8]
-
-    def record_L(self, text):
-        res = text.split(self.field_sep)
-        if res[3] == 'N':
+    def _sync(self, callback):
+        frames = []
+        if callback is None:
+            callback = frames.append
+        tometer = self.initiate()
+        result = None
+        while tometer is not None:
+            yield self.loop.run_in_executor(self.dev.write, tometer)
+            if result is not None:
+                callback(result)
+            timeout = self.readtimeout()
+            if timeout is None:
+                data = yield self.loop.run_in_executor(self.dev.read)
+            else:
+                try:
+                    data = yield self.loop.run_in_executor(self.dev.read,
+                                                           timeout)
+                except Exception, e:
+                    if not self.timedout(e):
+                        raise
+                    data = '\x15'
+            tometer, result = self.receive(data)
+        raise Return(frames)
+
+referencemap = { 'B' : 'whole blood', 'P' : 'plasma', 'C' : 'capillary',
+                 'D' : 'deproteinized whole blood' }
+resultflagmap = {
+    '<' : 'result low', '>' : 'result high', 'C' : 'control',
+    'B' : 'before food', 'A' : 'after food', 'D' : "don't feel right",
+    'I' : 'sick', 'S' : 'stress', 'X' : 'activity',
+    'Z1' : '0.25 hours after food',
+    'Z2' : '0.50 hours after food',
+    'Z3' : '0.75 hours after food',
+    'Z4' : '1.00 hours after food',
+    'Z5' : '1.25 hours after food',
+    'Z6' : '1.50 hours after food',
+    'Z7' : '1.75 hours after food',
+    'Z8' : '2.00 hours after food',
+    'Z9' : '2.25 hours after food',
+    'ZA' : '2.50 hours after food',
+    'ZB' : '2.75 hours after food',
+    'ZC' : '3.00 hours after food',
+    }
+
+class Result(store.ResultFields):
+    __slots__ = ('recno', 'meastype', 'value', 'unit', 'reference', 'flags',
+                 'time', 'is_control')
+
+    flagmap = resultflagmap
+    methodmap = referencemap
+
+    def __init__(self, recno, is_control=False):
+        self.recno = recno
+        self.is_control = is_control
+        self.meastype = self.value = self.unit = self.reference = None
+        self.time = None
+        self.flags = 0
+
+class Results(object):
+    """
+    The results of a ContourUSB, the one in flight included
+
+    Looking up the result in flight does not complete it, so a later O
+    record can still mark it a control. Anything else is the
+    store.ResultStore of complete results.
+    """
+    def __init__(self, cu):
+        self._cu = cu
+
+    def _pending(self):
+        cu = self._cu
+        return cu._pending if cu.keep else None
+
+    def __getattr__(self, name):
+        return getattr(self._cu._result, name)
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __getitem__(self, recno):
+        pending = self._pending()
+        if pending is not None and pending.recno == recno:
+            return pending
+        return self._cu._result[recno]
+
+    def __contains__(self, recno):
+        pending = self._pending()
+        return pending is not None and pending.recno == recno or \
+            recno in self._cu._result
+
+    def get(self, recno, default=None):
+        try:
+            return self[recno]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        keys = self._cu._result.keys()
+        pending = self._pending()
+        if pending is not None and pending.recno not in self._cu._result:
+            keys.append(pending.recno)
+        return keys
+
+    def values(self):
+        return [self[recno] for recno in self.keys()]
+
+    def items(self):
+        return [(recno, self[recno]) for recno in self.keys()]
+
+class ContourUSB(object):
+    """
+    Class that knows how to parse data from Countour USB meter
+
+    A result is complete once the record after its R (and any O record
+    for it) has been parsed. Complete results are kept in result, unless
+    keep is false, and passed to on_result; iterresults() yields them
+    as they complete.
+
+    known maps meter_serial to the (recno, testtime) of the newest
+    result already downloaded from that meter, testtime as read from the
+    meter clock. R records up to it are skipped without being parsed,
+    and caught_up is set once the rest of the transfer can only hold
+    known results: at the first known result when the meter sends the
+    newest first, at its last result when it sends the oldest first.
+    newest is the mark of this transfer, for the next one.
+
+    With a clock (like time.time) the meter clock is compared to it
+    when the H record arrives, and result times are corrected by the
+    difference, in whole minutes.
+
+    Record texts are decoded by an astm.Decoder, so only the fields a
+    record_X method looks at are decoded.
+    """
+
+    referencemap = referencemap
+    resultflagmap = resultflagmap
+
+    def __init__(self, on_result=None, keep=True, trace=None, known=None,
+                 clock=None):
+        self.trace = trace or tracing.null
+        self.decoder = astm.Decoder()
+        seps = self.decoder.seps
+        self.field_sep = seps.field
+        self.repeat_sep = seps.repeat
+        self.comp_sep = seps.component
+        self.escape_sep = seps.escape
+
+        self.on_result = on_result
+        self.keep = keep
+        self._result = store.ResultStore(flagmap=self.resultflagmap,
+                                         methodmap=self.referencemap)
+        self._pending = None
+        self._results = Results(self)
+        self._outbox = None
+        self.results = False
+
+        # record_X(astm record) for each ASTM record type, None for the
+        # ignored ones
+        self._dispatch = dict((rectype, getattr(self, 'record_' + rectype,
+                                                None))
+                              for rectype in astm.RECORD_TYPES)
+
+        self.clock = clock
+        self.header_time = None
+        self.clock_offset = 0
+
+        self.known = known
+        self.since = None
+        self.caught_up = False
+        self.skipped = 0
+        self.newest = None
+        self.newest_first = None
+        self._lastrecno = None
+        self._skippedrecno = None
+
+    @property
+    def result(self):
+        "The results so far, see Results"
+        return self._results
+
+    def flush(self):
+        "Complete the result in flight, if any"
+        result, self._pending = self._pending, None
+        if result is None:
+            return
+        if self.keep:
+            self._result.add(result)
+        # An O record without its R is kept, but not handed on
+        if result.value is not None:
+            newest = self.newest
+            # keep the meter's own time, the offset may change
+            mark = (result.recno, result.time - self.clock_offset)
+            if newest is None or (mark[1], mark[0]) >= (newest[1],
+                                                        newest[0]):
+                self.newest = mark
+            if self.on_result is not None:
+                self.on_result(result)
+            if self._outbox is not None:
+                self._outbox.append(result)
+
+    def _start(self, recno):
+        "Return the in flight result for recno"
+        pending = self._pending
+        if pending is None or pending.recno != recno:
+            self.flush()
+            pending = self._pending = Result(recno)
+        return pending
+
+    def iterresults(self, frames):
+        "Parse frames, yielding each Result as soon as it is complete"
+        self._outbox = outbox = collections.deque()
+        try:
+            for text in frames:
+                self.record(text)
+                while outbox:
+                    yield outbox.popleft()
+            self.flush()
+            while outbox:
+                yield outbox.popleft()
+        finally:
+            self._outbox = None
+
+    def record(self, text):
+        if self.trace.enabled:
+            with self.trace.timer('parse.record'):
+                return self._record(text)
+        return self._record(text)
+
+    def _record(self, text):
+        rectype = text[:1]
+        if rectype not in 'OR':
+            self.flush()
+        try:
+            fn = self._dispatch[rectype]
+        except KeyError:
+            if self.trace.enabled:
+                self.trace.count('parse.unknown')
+                self.trace.log('unknown record: %r' % text)
+            return
+        if fn is not None:
+            fn(self.decoder.decode(text))
+
+    def record_H(self, rec):
+        seps = rec.seps
+        self.field_sep = seps.field
+        self.repeat_sep = seps.repeat
+        self.comp_sep = seps.component
+        self.escape_sep = seps.escape
+
+        self.password = rec.password
+        self.meter_product = rec.product
+        self.meter_version = rec.versions
+        self.meter_serial = rec.serial
+        self.meter_sku = rec.sku
+
+        self.device_info = rec.device_info
+        self.result_count = rec.result_count
+        self.processing_id = rec.processing_id
+        self.spec_version = rec.spec_version
+        self.header_datetime = rec.datetime
+        if self.header_datetime:
+            self.header_time = store.parsetime(self.header_datetime)
+            if self.clock is not None:
+                self.clock_offset = 60 * int(round(
+                    (self.clock() - self.header_time) / 60.0))
+
+        if self.known is not None:
+            self.since = self.known.get(self.meter_serial)
+            if self.since is not None:
+                self.newest = tuple(self.since)
+                self._sincetime = store.formattime(self.since[1])
+
+    def header(self):
+        "Return the meter identification from the H record as a dict"
+        return {
+            'meter_serial': self.meter_serial,
+            'meter_product': self.meter_product,
+            'meter_version': self.meter_version,
+            'result_count': self.result_count,
+            'header_datetime': self.header_datetime,
+            'header_time': self.header_time,
+            'clock_offset': self.clock_offset,
+            }
+
+    def record_P(self, rec):
+        self.patient_info = rec.seq
+
+    def record_O(self, rec):
+        if rec.seq == self._skippedrecno:
+            # goes with a known result, that was skipped
+            return
+        result = self._start(rec.seq)
+        if rec.is_control:
+            result.is_control = True
+
+    def _seen(self, recno, testtime):
+        "Check a result against since, noting when the rest is known"
+        last, self._lastrecno = self._lastrecno, recno
+        if self.newest_first is None:
+            # the order shows in the first R, or failing that the second
+            if last is not None:
+                self.newest_first = last > recno
+            elif self.result_count > 1 and recno in (1, self.result_count):
+                self.newest_first = recno == self.result_count
+        if recno > self.since[0] or testtime[:12] > self._sincetime:
+            return False
+        self.skipped += 1
+        self._skippedrecno = recno
+        # Known results from here on if the meter sends the newest first,
+        # or this is the newest one
+        if self.newest_first or recno == self.result_count:
+            self.caught_up = True
+        # Drop the O record that went with it
+        if self._pending is not None and self._pending.recno == recno:
+            self._pending = None
+        return True
+
+    def record_R(self, rec):
+        recno = rec.recno
+        if self.since is not None and self._seen(recno, rec.testtime):
+            return
+        self._skippedrecno = None
+        result = self._pending
+        if result is None or result.recno != recno or result.value is not None:
+            self.flush()
+            result = self._pending = Result(recno)
+
+        result.meastype = rec.meastype
+        result.value = rec.value
+        result.unit = rec.unit
+        result.reference = rec.reference
+        result.flags = rec.flags
+        result.time = store.parsetime(rec.testtime) + self.clock_offset
+
+    def record_L(self, rec):
+        if rec.code == 'N':
             self.results = True
@@ -0,0 +1,339 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Long running daemon that keeps the meters open
+
+Every attached Contour is opened (interface claimed, endpoints looked
+up) once when it shows up and closed when it goes away, both on the
+loop's executor threads. Clients talk to
+the daemon over a Unix socket, one JSON request per line:
+
+  {"op": "list"}
+  {"op": "sync", "meter": <id or serial>}
+  {"op": "command", "meter": <id or serial>, "commands": [...]}
+
+and get newline delimited JSON back. A sync answers with a header, the
+results and {"type": "end"}, like mux.RecordMux.
+
+The socket is only accessible to its owner, and by default lives in a
+private directory (under $XDG_RUNTIME_DIR when set).
+"""
+
+import errno
+import json
+import os
+import socket
+import stat
+import sys
+import tempfile
+import threading
+
+import usbcomm
+import contourusb
+import fleet
+import loop as _loop
+import tracing
+from mux import Subscriber, DISCONNECT
+from fleet import device_id
+
+def _rundir():
+    rundir = os.environ.get('XDG_RUNTIME_DIR')
+    if rundir:
+        return os.path.join(rundir, 'glucodump')
+    return os.path.join(tempfile.gettempdir(), 'glucodump-%d' % os.getuid())
+
+_default_path = os.path.join(_rundir(), 'daemon.sock')
+
+class DaemonError(Exception):
+    pass
+
+def _privatedir(path):
+    "Create the directory path, or check that an existing one is ours only"
+    try:
+        os.mkdir(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        raise DaemonError("Not a directory: %s" % path)
+    if st.st_uid != os.getuid():
+        raise DaemonError("%s is owned by someone else" % path)
+    if st.st_mode & 077:
+        raise DaemonError("%s is accessible to others" % path)
+
+class Meter(object):
+    """
+    An open meter
+
+    Requests are run on executor threads; the lock keeps them from
+    interleaving on the wire.
+    """
+    def __init__(self, ident, comm, trace=None):
+        self.ident = ident
+        self.comm = comm
+        self.trace = trace
+        self.serial = None
+        self.lock = threading.Lock()
+        self.bc = contourusb.BayerCOMM(comm, trace=trace)
+
+    def sync(self):
+        "Download the meter, returns its ContourUSB"
+        with self.lock:
+            self.bc.state = self.bc.mode_establish
+            cu = contourusb.ContourUSB(trace=self.trace)
+            for text in self.bc.sync():
+                cu.record(text)
+            cu.flush()
+            self.serial = getattr(cu, 'meter_serial', self.serial)
+            return cu
+
+    def commands(self, commands):
+        with self.lock:
+            return self.bc.commands(commands)
+
+    def close(self):
+        with self.lock:
+            self.comm.close()
+
+class Daemon(object):
+    """
+    Serve the attached meters on a Unix socket
+
+    The device list is rescanned every scan seconds. finder returns the
+    attached devices and opener opens one, by default as a USBComm.
+    """
+    def __init__(self, path=_default_path, loop=None, scan=5.0,
+                 finder=fleet.contours, opener=None, trace=None):
+        self.path = path
+        self.loop = loop or _loop.EventLoop()
+        self.scan = scan
+        self.finder = finder
+        self.opener = opener or (lambda dev: usbcomm.USBComm(dev=dev,
+                                                             trace=trace))
+        self.trace = trace or tracing.null
+        self.meters = {}
+        self._opening = set()
+        self.clients = []
+        self.server = None
+        self._timer = None
+        self._done = None
+
+    def _claim(self):
+        "Make room for the socket, refusing to replace a live daemon"
+        if self.path == _default_path:
+            _privatedir(os.path.dirname(self.path))
+        if not os.path.exists(self.path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except socket.error:
+            # left behind by a daemon that is gone
+            os.unlink(self.path)
+        else:
+            raise DaemonError("A daemon is already listening on %s"
+                              % self.path)
+        finally:
+            probe.close()
+
+    def start(self):
+        self._claim()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.setblocking(0)
+        umask = os.umask(0177)
+        try:
+            self.server.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.server.listen(16)
+        self.loop.add_reader(self.server, self._accept)
+        self.hotplug()
+        self._done = _loop.Future(self.loop)
+        return self._done
+
+    def stop(self):
+        if self._timer is not None:
+            self.loop.cancel_timer(self._timer)
+        for client in list(self.clients):
+            self.remove(client, 'shutting down')
+        if self.server is not None:
+            self.loop.remove_reader(self.server)
+            self.server.close()
+            self.server = None
+            os.unlink(self.path)
+        for meter in self.meters.values():
+            self._close(meter)
+        self.meters = {}
+        if self._done is not None:
+            self._done.set_result(None)
+
+    def hotplug(self):
+        "Open new devices and forget removed ones"
+        present = {}
+        for dev in self.finder():
+            present[device_id(dev)] = dev
+        for ident in set(self.meters) - set(present):
+            self.trace.log('DAEMON > Meter %s removed' % ident)
+            self._close(self.meters.pop(ident))
+        for ident in set(present) - set(self.meters) - self._opening:
+            self.trace.log('DAEMON > Meter %s added' % ident)
+            # opening claims the device, keep it off the loop
+            self._opening.add(ident)
+            opened = self.loop.run_in_executor(self.opener, present[ident])
+            opened.add_done_callback(lambda f, ident=ident:
+                                     self._opened(ident, f))
+        self._timer = self.loop.call_later(self.scan, self.hotplug)
+
+    def _opened(self, ident, fut):
+        self._opening.discard(ident)
+        exc = fut.exception()
+        if exc is not None:
+            self.trace.log('DAEMON > Opening %s: %s' % (ident, exc))
+            return
+        meter = Meter(ident, fut.result(), self.trace)
+        if self.server is None:
+            # stopped while opening
+            self._close(meter)
+            return
+        self.meters[ident] = meter
+
+    def _close(self, meter):
+        # closing waits for a running request, keep it off the loop
+        closed = self.loop.run_in_executor(meter.close)
+        closed.add_done_callback(self._closed)
+
+    def _closed(self, fut):
+        exc = fut.exception()
+        if exc is not None:
+            self.trace.log('DAEMON > Closing meter: %s' % exc)
+
+    def find(self, name):
+        "Return the meter with the given id or serial"
+        if name is None and len(self.meters) == 1:
+            return self.meters.values()[0]
+        if name in self.meters:
+            return self.meters[name]
+        for meter in self.meters.values():
+            if meter.serial == name:
+                return meter
+        return None
+
+    def _accept(self):
+        try:
+            sock, addr = self.server.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        sock.setblocking(0)
+        client = Subscriber(self, sock, 16 << 20, DISCONNECT)
+        client.name = 'client %d' % sock.fileno()
+        self.clients.append(client)
+        self.loop.add_reader(sock, self._recv, client)
+
+    def remove(self, client, why='?'):
+        if client.closed:
+            return
+        self.trace.log('DAEMON > Closing %s: %s' % (client.name, why))
+        self.clients.remove(client)
+        client.close()
+
+    def _recv(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        if not data:
+            self.remove(client, 'Got no data')
+            return
+        lines = (client.pending + data).split('\n')
+        client.pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                self.loop.create_task(self.handle(client, line))
+
+    def reply(self, client, msg):
+        client.send(json.dumps(msg, sort_keys=True) + '\n')
+
+    def handle(self, client, line):
+        try:
+            request = json.loads(line)
+            op = request.get('op')
+            if op == 'list':
+                self.reply(client, {'type': 'meters', 'meters': [
+                    {'id': m.ident, 'serial': m.serial}
+                    for m in self.meters.values()]})
+                return
+            meter = self.find(request.get('meter'))
+            if meter is None:
+                raise KeyError('No such meter: %s' % request.get('meter'))
+            if op == 'sync':
+                cu = yield self.loop.run_in_executor(meter.sync)
+                msg = cu.header()
+                msg['type'] = 'header'
+                self.reply(client, msg)
+                for result in cu.result.values():
+                    msg = result.asdict()
+                    msg['type'] = 'result'
+                    self.reply(client, msg)
+                self.reply(client, {'type': 'end'})
+            elif op == 'command':
+                replies = yield self.loop.run_in_executor(
+                    meter.commands, request['commands'])
+                self.reply(client, {'type': 'replies', 'replies': replies})
+            else:
+                raise ValueError('Unknown op: %r' % op)
+        except Exception, e:
+            self.reply(client, {'type': 'error', 'error': str(e)})
+
+    def run(self):
+        done = self.start()
+        print >>sys.stderr, 'DAEMON > Listening on %s' % self.path
+        try:
+            self.loop.run_until_complete(done)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+def request(msg, path=_default_path):
+    """
+    Send a request to a running daemon, yields the replies
+
+    Stops after the end of a sync, or after the single reply of any
+    other request.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    try:
+        sock.sendall(json.dumps(msg) + '\n')
+        f = sock.makefile('r')
+        for line in f:
+            reply = json.loads(line)
+            yield reply
+            if reply['type'] not in ('header', 'result'):
+                break
+    finally:
+        sock.close()
+
+def main(argv):
+    path = argv[1] if len(argv) > 1 else _default_path
+    Daemon(path).run()
+
+if __name__ == '__main__':
+    main(sys.argv)
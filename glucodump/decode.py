@@ -0,0 +1,133 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Offline decoding of raw meter logs
+
+FrameDecoder takes everything the meter sent, in chunks of any size,
+and returns the frame texts BayerCOMM.sync() would have yielded. Frame
+boundaries, checksums and the recno sequence are checked per chunk in
+bulk rather than per dev.read().
+"""
+
+import re
+
+from contourusb import FrameError
+import capture
+
+import lazy
+
+numpy = lazy.optional('numpy')
+
+framere = re.compile('\x02(?P<check>(?P<recno>[0-7])(?P<text>[^\x0d\x02]*)'
+                     '\x0d(?P<end>[\x03\x17]))'
+                     '(?P<checksum>[0-9A-F][0-9A-F])\x0d\x0a')
+
+def checksums(data, starts, ends):
+    "Return the frame checksums of data[start:end] for all the spans"
+    if numpy is not None and len(starts) > 8:
+        buf = numpy.frombuffer(data, numpy.uint8)
+        # uint8 wraps, so differences of the running sum are mod 256
+        running = numpy.zeros(len(buf) + 1, numpy.uint8)
+        numpy.cumsum(buf, dtype=numpy.uint8, out=running[1:])
+        return (running[numpy.array(ends)] -
+                running[numpy.array(starts)]).tolist()
+    return [sum(bytearray(data[s:e])) & 0xff for s, e in zip(starts, ends)]
+
+class FrameDecoder(object):
+    """
+    Decode data frames from a raw byte log
+
+    Frames with a bad checksum are dropped (the meter retransmits them
+    after our <NAK>), as are retransmissions of an already accepted
+    frame. A gap in the recno sequence is recorded in errors, or raised
+    as FrameError if strict is set. An <EOT> between frames ends the
+    transfer, and the next one may start at any recno.
+    """
+    def __init__(self, strict=False):
+        self.strict = strict
+        self.currecno = None
+        self.errors = []
+        self.offset = 0
+        self._tail = ''
+
+    def feed(self, data):
+        "Decode the complete frames in data, returns their texts"
+        data = self._tail + data
+        base = self.offset - len(self._tail)
+        matches = list(framere.finditer(data))
+
+        end = matches[-1].end() if matches else 0
+        stx = data.rfind('\x02', end)
+        self._tail = data[stx:] if stx != -1 else ''
+        self.offset = base + len(data)
+
+        if not matches:
+            if '\x04' in data[:stx if stx != -1 else len(data)]:
+                self.currecno = None
+            return []
+
+        sums = checksums(data, [m.start('check') for m in matches],
+                         [m.end('check') for m in matches])
+
+        result = []
+        currecno = self.currecno
+        gap = 0
+        for match, checksum in zip(matches, sums):
+            if data.find('\x04', gap, match.start()) != -1:
+                currecno = None
+            gap = match.end()
+            if checksum != int(match.group('checksum'), 16):
+                self.errors.append((base + match.start(), "Checksum error"))
+                continue
+            recno = int(match.group('recno'))
+            if currecno is not None and recno != currecno:
+                if (recno + 1) % 8 == currecno:
+                    continue # retransmission
+                msg = "Bad recno, got %r expected %r" % (recno, currecno)
+                if self.strict:
+                    raise FrameError(msg, match.group(0))
+                self.errors.append((base + match.start(), msg))
+            currecno = (recno + 1) % 8
+            result.append(match.group('text'))
+        if data.find('\x04', gap, stx if stx != -1 else len(data)) != -1:
+            currecno = None
+        self.currecno = currecno
+        return result
+
+    def decode(self, chunks):
+        "Yield frame texts from an iterable of chunks"
+        for chunk in chunks:
+            for text in self.feed(chunk):
+                yield text
+
+def decode(data, strict=False):
+    "Return the frame texts in a complete raw log"
+    return FrameDecoder(strict).feed(data)
+
+def decode_file(f, strict=False, chunksize=1 << 20):
+    "Yield the frame texts in a raw log file, f is a file or a path"
+    if isinstance(f, basestring):
+        with open(f, 'rb') as f:
+            for text in decode_file(f, strict, chunksize):
+                yield text
+        return
+    chunks = iter(lambda: f.read(chunksize), '')
+    for text in FrameDecoder(strict).decode(chunks):
+        yield text
+
+def decode_capture(f, strict=False):
+    "Return the frame texts the meter sent in a capture file"
+    messages = capture.ReplayDevice.messages(f)
+    return decode(''.join(data for delay, data in messages), strict)
@@ -0,0 +1,122 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Download every attached meter at once
+
+Each meter gets its own USBComm, BayerCOMM and ContourUSB and is synced
+on a worker thread; the USB transfers release the GIL, so the meters
+download in parallel.
+"""
+
+import sys
+from multiprocessing.pool import ThreadPool
+
+import usbcomm, contourusb, incremental
+
+def contours():
+    "Return all attached Bayer Contour meters"
+    return usbcomm.find_all(idVendor=usbcomm.ids.Bayer,
+                            idProduct=usbcomm.ids.Bayer.Contour)
+
+def device_id(dev):
+    "Stable name of an attached device"
+    return '%s:%s' % (getattr(dev, 'bus', None), getattr(dev, 'address', None))
+
+def open_device(dev, trace=None):
+    return usbcomm.USBComm(dev=dev, trace=trace)
+
+def sync_meter(dev, opener=open_device, trace=None, state=None):
+    """
+    Download one meter, returns its ContourUSB
+
+    opener(dev, trace) opens the device. With an incremental.SyncState
+    only the new results are downloaded.
+    """
+    comm = opener(dev, trace=trace)
+    try:
+        if state is not None:
+            return incremental.sync(comm, state, trace=trace)
+        bc = contourusb.BayerCOMM(comm, trace=trace)
+        cu = contourusb.ContourUSB(trace=trace)
+        for text in bc.sync():
+            cu.record(text)
+        cu.flush()
+        return cu
+    finally:
+        comm.close()
+
+class Fleet(object):
+    """
+    Sync several meters concurrently
+
+    After sync(), meters maps meter_serial to the ContourUSB of that
+    meter and errors lists (device, exception) for the ones that failed.
+    """
+    def __init__(self, devices=None, opener=open_device, workers=None,
+                 trace=None, state=None):
+        if devices is None:
+            devices = contours()
+        self.devices = devices
+        self.opener = opener
+        self.workers = workers or max(1, len(devices))
+        self.trace = trace
+        self.state = state
+        self.meters = {}
+        self.errors = []
+
+    def _sync(self, dev):
+        try:
+            return dev, sync_meter(dev, self.opener, self.trace,
+                                   self.state), None
+        except Exception, e:
+            return dev, None, e
+
+    def sync(self):
+        if not self.devices:
+            return self.meters
+        pool = ThreadPool(min(self.workers, len(self.devices)))
+        try:
+            for dev, cu, exc in pool.imap_unordered(self._sync, self.devices):
+                if exc is not None:
+                    self.errors.append((dev, exc))
+                    continue
+                self.merge(cu)
+        finally:
+            pool.close()
+            pool.join()
+        return self.meters
+
+    def merge(self, cu):
+        "Add the results of a synced meter, keyed by its serial"
+        serial = getattr(cu, 'meter_serial', None)
+        known = self.meters.get(serial)
+        if known is None:
+            self.meters[serial] = cu
+            return
+        for recno, result in cu.result.items():
+            known.result.add(result)
+
+def main(argv):
+    fleet = Fleet()
+    for serial, cu in sorted(fleet.sync().items()):
+        for res in cu.result.values():
+            print '%s %s: %s %.1f %s %s' % (serial, res.recno, res.testtime,
+                                            res.value, res.unit,
+                                            ', '.join(res.resultflags))
+    for dev, exc in fleet.errors:
+        print >>sys.stderr, 'Failed to sync %s: %s' % (dev, exc)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,89 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Incremental sync
+
+SyncState remembers, per meter_serial, the (recno, testtime) of the
+newest result downloaded so far. sync() hands it to ContourUSB as
+known, so results already seen are skipped, and interrupts the
+transfer once the meter has nothing new left to send;
+until_caught_up() does that for any loop feeding a ContourUSB.
+"""
+
+import json
+import os
+
+import contourusb
+
+class SyncState(object):
+    "The newest known result of each meter, kept in a JSON file"
+
+    def __init__(self, path=None):
+        self.path = path
+        self.marks = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.marks = dict((serial, tuple(mark))
+                                  for serial, mark in json.load(f).items())
+
+    def get(self, serial, default=None):
+        return self.marks.get(serial, default)
+
+    def __contains__(self, serial):
+        return serial in self.marks
+
+    def update(self, cu):
+        "Remember the newest result of a synced meter"
+        serial = getattr(cu, 'meter_serial', None)
+        if serial is not None and cu.newest is not None:
+            self.marks[serial] = cu.newest
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.marks, f, sort_keys=True)
+        os.rename(tmp, self.path)
+
+def until_caught_up(bc, cu, frames):
+    """
+    Pass on frames, interrupting bc once cu is caught up
+
+    cu is checked after each frame has been parsed, so a transfer ends
+    as soon as the known results start, not at the next new result.
+    """
+    for text in frames:
+        yield text
+        if cu.caught_up and not bc.interrupted:
+            bc.interrupt()
+
+def sync(comm, state, on_result=None, keep=True, trace=None):
+    """
+    Download the results a meter got since the last sync
+
+    Returns the ContourUSB, which only holds the new results. state is
+    updated but not saved.
+    """
+    bc = contourusb.BayerCOMM(comm, trace=trace)
+    cu = contourusb.ContourUSB(on_result=on_result, keep=keep, trace=trace,
+                               known=state)
+    for text in until_caught_up(bc, cu, bc.sync()):
+        cu.record(text)
+    cu.flush()
+    state.update(cu)
+    if trace is not None and trace.enabled:
+        trace.count('sync.skipped', cu.skipped)
+    return cu
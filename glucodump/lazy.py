@@ -0,0 +1,56 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Import modules when they are first used
+
+pyusb (and with it libusb) and NumPy take longer to import than most
+commands take to run, so modules that only need them for some calls
+hold a LazyModule instead.
+"""
+
+import imp
+
+class LazyModule(object):
+    "Stands in for a module, importing it on first attribute access"
+
+    def __init__(self, name, submodules=()):
+        self.__dict__['_name'] = name
+        self.__dict__['_submodules'] = submodules
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            module = __import__(self._name)
+            for sub in self._submodules:
+                __import__('%s.%s' % (self._name, sub))
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return '<lazy module %r>' % self._name
+
+def optional(name, submodules=()):
+    "A LazyModule for name if it is installed, else None"
+    try:
+        f, path, desc = imp.find_module(name)
+    except ImportError:
+        return None
+    if f is not None:
+        f.close()
+    return LazyModule(name, submodules)
@@ -0,0 +1,362 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Single threaded event loop
+
+A small poll() based loop in the spirit of asyncio: fd readers and
+writers, timers, futures, generator based tasks and a thread pool for
+blocking calls such as USB transfers.
+"""
+
+import errno
+import fcntl
+import heapq
+import math
+import os
+import select
+import threading
+import time
+import Queue
+
+_READ = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+_WRITE = select.POLLOUT
+
+class CancelledError(Exception):
+    pass
+
+class Return(Exception):
+    "Raise from a task generator to give the task a result"
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+class Future(object):
+    "Result of an operation that completes later, on the loop"
+
+    _pending = object()
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._result = self._pending
+        self._exc = None
+        self._callbacks = []
+
+    def done(self):
+        return self._result is not self._pending or self._exc is not None
+
+    def result(self):
+        if self._exc is not None:
+            raise self._exc
+        if self._result is self._pending:
+            raise RuntimeError("Result is not ready")
+        return self._result
+
+    def exception(self):
+        return self._exc
+
+    def set_result(self, result):
+        if self.done():
+            return
+        self._result = result
+        self._schedule()
+
+    def set_exception(self, exc):
+        if self.done():
+            return
+        self._exc = exc
+        self._schedule()
+
+    def cancel(self):
+        self.set_exception(CancelledError())
+
+    def add_done_callback(self, fn):
+        if self.done():
+            self.loop.call_soon(fn, self)
+        else:
+            self._callbacks.append(fn)
+
+    def _schedule(self):
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            self.loop.call_soon(fn, self)
+
+class Task(Future):
+    """
+    Run a generator on the loop
+
+    The generator yields futures and is resumed with their result (or
+    has their exception thrown into it).
+    """
+    def __init__(self, loop, gen):
+        Future.__init__(self, loop)
+        self.gen = gen
+        loop.call_soon(self._step, None, None)
+
+    def _step(self, value, exc):
+        try:
+            if exc is not None:
+                fut = self.gen.throw(exc)
+            else:
+                fut = self.gen.send(value)
+        except StopIteration:
+            self.set_result(None)
+        except Return, r:
+            self.set_result(r.value)
+        except Exception, e:
+            self.set_exception(e)
+        else:
+            fut.add_done_callback(self._wakeup)
+
+    def _wakeup(self, fut):
+        exc = fut.exception()
+        if exc is not None:
+            self._step(None, exc)
+        else:
+            self._step(fut.result(), None)
+
+class ThreadExecutor(object):
+    "Run blocking calls on a pool of worker threads"
+
+    def __init__(self, workers=16):
+        self.workers = workers
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def submit(self, loop, fn, *args):
+        fut = Future(loop)
+        with self._lock:
+            # only grow the pool when no worker is waiting for work
+            if self._idle <= self._queue.qsize() and \
+                    len(self._threads) < self.workers:
+                self._spawn()
+        self._queue.put((loop, fut, fn, args))
+        return fut
+
+    def _spawn(self):
+        t = threading.Thread(target=self._work)
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+
+    def _work(self):
+        with self._lock:
+            self._idle += 1
+        while True:
+            item = self._queue.get()
+            with self._lock:
+                self._idle -= 1
+            if item is None:
+                return
+            loop, fut, fn, args = item
+            try:
+                result = fn(*args)
+            except Exception, e:
+                done, result = fut.set_exception, e
+            else:
+                done = fut.set_result
+            # idle again before the caller can hand out more work
+            with self._lock:
+                self._idle += 1
+            loop.call_soon_threadsafe(done, result)
+
+    def shutdown(self, wait=True):
+        "Stop the workers, waiting for running calls with wait"
+        threads, self._threads = self._threads, []
+        for t in threads:
+            self._queue.put(None)
+        if wait:
+            for t in threads:
+                if t is not threading.current_thread():
+                    t.join()
+
+class EventLoop(object):
+    def __init__(self, executor=None):
+        self._poller = select.poll()
+        self._readers = {}
+        self._writers = {}
+        self._ready = []
+        self._timers = []
+        self._lock = threading.Lock()
+        self._running = False
+        self._closed = False
+        self.executor = executor
+        self._wakein, self._wakeout = os.pipe()
+        for fd in self._wakein, self._wakeout:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.add_reader(self._wakein, self._drain)
+
+    def time(self):
+        return time.time()
+
+    def call_soon(self, fn, *args):
+        self._ready.append((fn, args))
+
+    def call_soon_threadsafe(self, fn, *args):
+        with self._lock:
+            # late callbacks from threads outliving close() are dropped
+            if self._closed:
+                return
+            self._ready.append((fn, args))
+            try:
+                os.write(self._wakeout, 'x')
+            except OSError, e:
+                # a full pipe will wake the loop anyway
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def call_later(self, delay, fn, *args):
+        timer = [self.time() + delay, fn, args]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel_timer(self, timer):
+        timer[1] = None
+
+    def _drain(self):
+        try:
+            os.read(self._wakein, 4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _update(self, fd):
+        mask = 0
+        if fd in self._readers:
+            mask |= _READ
+        if fd in self._writers:
+            mask |= _WRITE
+        if mask:
+            self._poller.register(fd, mask)
+        else:
+            try:
+                self._poller.unregister(fd)
+            except KeyError:
+                pass
+
+    def add_reader(self, fd, fn, *args):
+        fd = getattr(fd, 'fileno', lambda: fd)()
+        self._readers[fd] = (fn, args)
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        fd = getattr(fd, 'fileno', lambda: fd)()
+        self._readers.pop(fd, None)
+        self._update(fd)
+
+    def add_writer(self, fd, fn, *args):
+        fd = getattr(fd, 'fileno', lambda: fd)()
+        self._writers[fd] = (fn, args)
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        fd = getattr(fd, 'fileno', lambda: fd)()
+        self._writers.pop(fd, None)
+        self._update(fd)
+
+    def run_in_executor(self, fn, *args):
+        if self.executor is None:
+            self.executor = ThreadExecutor()
+        return self.executor.submit(self, fn, *args)
+
+    def create_task(self, gen):
+        return Task(self, gen)
+
+    def _run_once(self):
+        timeout = None
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, int(math.ceil(
+                (self._timers[0][0] - self.time()) * 1000)))
+
+        try:
+            events = self._poller.poll(timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+
+        for fd, flag in events:
+            # Look the handlers up as we go, an earlier one may have
+            # removed them
+            if flag & _READ and fd in self._readers:
+                fn, args = self._readers[fd]
+                fn(*args)
+            if flag & _WRITE and fd in self._writers:
+                fn, args = self._writers[fd]
+                fn(*args)
+
+        now = self.time()
+        while self._timers and self._timers[0][0] <= now:
+            when, fn, args = heapq.heappop(self._timers)
+            if fn is not None:
+                self.call_soon(fn, *args)
+
+        with self._lock:
+            ready, self._ready = self._ready, []
+        for fn, args in ready:
+            fn(*args)
+
+    def run_forever(self):
+        self._running = True
+        while self._running:
+            self._run_once()
+
+    def run_until_complete(self, fut):
+        if not isinstance(fut, Future):
+            fut = self.create_task(fut)
+        fut.add_done_callback(lambda f: self.stop())
+        self.run_forever()
+        return fut.result()
+
+    def stop(self):
+        self._running = False
+
+    def close(self, wait=True):
+        """
+        Stop the executor, waiting for its running calls with wait, and
+        close the loop
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait)
+        with self._lock:
+            self._closed = True
+            os.close(self._wakein)
+            os.close(self._wakeout)
+
+def gather(loop, *futures):
+    "Return a future for the list of results of futures"
+    result = Future(loop)
+    values = [None] * len(futures)
+    pending = [len(futures)]
+
+    def done(i, fut):
+        exc = fut.exception()
+        if exc is not None:
+            result.set_exception(exc)
+            return
+        values[i] = fut.result()
+        pending[0] -= 1
+        if not pending[0]:
+            result.set_result(values)
+
+    if not futures:
+        result.set_result(values)
+    for i, fut in enumerate(futures):
+        fut.add_done_callback(lambda f, i=i: done(i, f))
+    return result
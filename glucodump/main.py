@@ -1,21 +1,192 @@
 #!/usr/bin/env python
+"""glucodump command line
 
-import usbcomm, contourusb
+  sync    download the attached meter
+  decode  decode saved captures and raw logs, no USB needed
+  export  print readings from an archive as CSV or JSON
+  serve   share the meter(s) over TCP or a Unix socket
 
-def main(argv):
+Modules are imported by the command that needs them, so the offline
+commands never load pyusb, and only load NumPy when they use it.
+"""
+
+import sys
+import argparse
+
+def print_result(res, prefix=''):
+    print '%s%s: %s %.1f %s %s' % (prefix, res.recno, res.testtime, res.value,
+                                   res.unit, ', '.join(res.resultflags))
+
+def sync(args):
+    import usbcomm, contourusb, tracing, incremental
+
+    trace = tracing.Tracer() if args.trace else None
+    db = log = None
+    if args.archive:
+        import archive
+        db = archive.Archive(args.archive)
+    if args.log:
+        import readinglog
+        log = readinglog.ReadingLog(args.log)
     uc = usbcomm.USBComm(idVendor=usbcomm.ids.Bayer,
-                         idProduct=usbcomm.ids.Bayer.Contour)
-    bc = contourusb.BayerCOMM(uc)
-    cu = contourusb.ContourUSB()
+                         idProduct=usbcomm.ids.Bayer.Contour,
+                         capture=args.capture, trace=trace)
+    wakeups = None
+    if args.wakeup:
+        import wakeup
+        wakeups = wakeup.WakeupCache(args.wakeup)
+        model = wakeup.model(uc)
+    bc = contourusb.BayerCOMM(uc, trace=trace,
+                              wakeup=wakeups and wakeups.get(model),
+                              probe_timeout=args.probe_timeout)
+    state = incremental.SyncState(args.state) if args.state else None
+    cu = contourusb.ContourUSB(keep=db is not None or log is not None,
+                               trace=trace, known=state)
+
+    try:
+        frames = incremental.until_caught_up(bc, cu, bc.sync(args.pipeline))
+        for res in cu.iterresults(frames):
+            print_result(res)
+    finally:
+        uc.close( )
+    if wakeups is not None:
+        wakeups.remember(bc, model, getattr(cu, 'meter_serial', None))
+        wakeups.save()
+    if state is not None:
+        state.update(cu)
+        state.save()
+    if db is not None:
+        db.ingest(cu)
+        db.close()
+    if log is not None:
+        log.ingest(cu)
+    if trace is not None:
+        trace.dump(sys.stderr)
+
+def decode(args):
+    import batch
+
+    if args.jobs != 1:
+        chunks = batch.decode_files(batch.paths(args.files), args.jobs or None)
+    else:
+        chunks = (chunk for path in batch.paths(args.files)
+                  for chunk in batch.decode_path(path))
+    db = None
+    if args.archive:
+        import archive
+        db = archive.Archive(args.archive)
+    failed = 0
+    for chunk in chunks:
+        if chunk.error is not None:
+            failed += 1
+            print >>sys.stderr, '%s: %s' % (chunk.path, chunk.error)
+            continue
+        for offset, msg in chunk.errors:
+            print >>sys.stderr, '%s@%d: %s' % (chunk.path, offset, msg)
+        results = chunk.store()
+        for res in results.values():
+            print_result(res, '%s %s ' % (chunk.path, chunk.serial))
+        if db is not None:
+            db.add(chunk.serial, results.values())
+    if db is not None:
+        db.close()
+    return 1 if failed else 0
 
-    for rec in bc.sync():
-        cu.record(rec)
+def export(args):
+    import archive, store
 
-    for resno, res in cu.result.items():
-        print '%s: %s %.1f %s %s' % (resno, res.testtime, res.value, res.unit,
-                               ', '.join(res.resultflags))
-    uc.close( )
+    db = archive.Archive(args.archive)
+    start = store.parsetime(args.start) if args.start else None
+    end = store.parsetime(args.end) if args.end else None
+    readings = db.readings(args.serial, start, end)
+    if args.format == 'json':
+        import json
+        for r in readings:
+            print json.dumps(r.asdict(), sort_keys=True)
+    else:
+        import csv
+        out = csv.writer(sys.stdout)
+        out.writerow(['meter_serial', 'recno', 'testtime', 'value', 'unit',
+                      'method', 'flags', 'control'])
+        for r in readings:
+            out.writerow([r.meter_serial, r.recno, r.testtime, r.value, r.unit,
+                          r.method, '/'.join(r.flagcodes), int(r.is_control)])
+    db.close()
+
+def serve(args):
+    if args.daemon:
+        import daemon
+        daemon.Daemon(args.daemon).run()
+    elif args.multi:
+        import multimux
+        multimux.MultiMux(records=args.records, policy=args.policy).run()
+    else:
+        import usbcomm, mux
+        uc = usbcomm.USBComm(idVendor=usbcomm.ids.Bayer,
+                             idProduct=usbcomm.ids.Bayer.Contour)
+        if args.records:
+            mux.RecordMux(uc).run()
+        else:
+            mux.Mux(uc, policy=args.policy).run()
+
+def parser():
+    p = argparse.ArgumentParser(prog='glucodump')
+    commands = p.add_subparsers(dest='command')
+
+    s = commands.add_parser('sync', help='download the attached meter')
+    s.add_argument('--trace', action='store_true',
+                   help='dump timings and counters as JSON on stderr')
+    s.add_argument('--archive', metavar='PATH',
+                   help='also store the results in an SQLite archive')
+    s.add_argument('--log', metavar='PATH',
+                   help='append the results to a binary reading log')
+    s.add_argument('--state', metavar='PATH',
+                   help='only download results newer than in the state file')
+    s.add_argument('--capture', metavar='PATH',
+                   help='write the USB traffic to a capture file')
+    s.add_argument('--pipeline', action='store_const', const=1024, default=0,
+                   help='run the meter link on its own thread')
+    s.add_argument('--wakeup', metavar='PATH',
+                   help='remember the byte that wakes the meter in PATH')
+    s.add_argument('--probe-timeout', metavar='MS', type=int,
+                   help='give up on a handshake read after MS milliseconds')
+    s.set_defaults(func=sync)
+
+    s = commands.add_parser('decode', help='decode captures and raw logs')
+    s.add_argument('files', nargs='+', metavar='FILE-OR-DIR')
+    s.add_argument('-j', '--jobs', type=int, default=1,
+                   help='worker processes, 0 for one per core')
+    s.add_argument('--archive', metavar='PATH',
+                   help='store the results in an SQLite archive')
+    s.set_defaults(func=decode)
+
+    s = commands.add_parser('export', help='print readings from an archive')
+    s.add_argument('archive', metavar='ARCHIVE')
+    s.add_argument('--serial')
+    s.add_argument('--start', metavar='YYYYMMDDHHMM')
+    s.add_argument('--end', metavar='YYYYMMDDHHMM')
+    s.add_argument('--format', choices=['csv', 'json'], default='csv')
+    s.set_defaults(func=export)
+
+    s = commands.add_parser('serve', help='share the meters')
+    s.add_argument('--records', action='store_true',
+                   help='publish decoded results as JSON lines')
+    s.add_argument('--multi', action='store_true',
+                   help='serve every attached meter')
+    s.add_argument('--daemon', metavar='SOCKET',
+                   help='run the device daemon on a Unix socket')
+    s.add_argument('--policy', choices=['drop', 'disconnect', 'coalesce'],
+                   default='drop', help='what to do with slow clients')
+    s.set_defaults(func=serve)
+    return p
+
+def main(argv):
+    args = argv[1:]
+    # no command (or just options) syncs, as before
+    if not args or args[0].startswith('-') and args[0] not in ('-h', '--help'):
+        args = ['sync'] + args
+    args = parser().parse_args(args)
+    return args.func(args)
 
 if __name__ == '__main__':
-    import sys
-    main(sys.argv)
+    sys.exit(main(sys.argv))
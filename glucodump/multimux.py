@@ -0,0 +1,249 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Serve every attached meter from one process and one loop
+
+Each meter gets a channel, a mux.Mux (or mux.RecordMux) of its own
+sharing the loop. A client connecting to the hub port sends one line
+naming the meter, by USB serial number or bus:address, and is then
+handed over to that meter's channel; a channel can also be given a
+port of its own, in which case no handshake is needed there.
+
+Meters are picked up and dropped as they are plugged in and out. They
+are opened on the loop's executor, which gets threads_per_channel more
+workers for each channel, so the blocking USB calls of one meter never
+wait for a thread held by another.
+"""
+
+import errno
+import socket
+import sys
+
+import usbcomm
+import fleet
+import mux
+import loop as _loop
+import tracing
+from stream import _default_host, _default_port
+
+def device_serial(dev):
+    "The USB serial number string of dev, None if it has none"
+    try:
+        return dev.serial_number
+    except Exception:
+        return None
+
+class MultiMux(object):
+    """
+    Channels for all attached meters
+
+    finder returns the attached devices and opener opens one, by
+    default as a USBComm. ports maps a meter serial or bus:address to
+    a port its channel listens on. Other keyword arguments are passed
+    on to the channels.
+    """
+    # a blocking read and a write
+    threads_per_channel = 2
+
+    def __init__(self, loop=None, host=_default_host, port=_default_port,
+                 finder=fleet.contours, opener=None, scan=5.0, ports=None,
+                 records=False, trace=None, **kw):
+        self.loop = loop or _loop.EventLoop()
+        if self.loop.executor is None:
+            self.loop.executor = _loop.ThreadExecutor()
+        self.host = host
+        self.port = port
+        self.finder = finder
+        self.opener = opener or (lambda dev: usbcomm.USBComm(dev=dev,
+                                                             trace=trace))
+        self.scan = scan
+        self.ports = ports or {}
+        self.channel_class = mux.RecordMux if records else mux.Mux
+        self.trace = trace or tracing.null
+        self.kw = kw
+        self.channels = {}
+        self._opening = set()
+        self.server = None
+        self._handshakes = {}
+        self._timer = None
+        self._done = None
+
+    def start(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.setblocking(0)
+        self.server.bind((self.host, self.port))
+        self.server.listen(128)
+        self.port = self.server.getsockname()[1]
+        self.loop.add_reader(self.server, self._accept)
+        self._done = _loop.Future(self.loop)
+        self.hotplug()
+        return self._done
+
+    def stop(self):
+        if self._timer is not None:
+            self.loop.cancel_timer(self._timer)
+            self._timer = None
+        for sock, data in self._handshakes.values():
+            self._drop(sock)
+        for ident in list(self.channels):
+            self.detach(ident)
+        if self.server is not None:
+            self.loop.remove_reader(self.server)
+            self.server.close()
+            self.server = None
+        if self._done is not None:
+            self._done.set_result(None)
+
+    def hotplug(self):
+        "Add channels for new meters and drop those of removed ones"
+        present = {}
+        for dev in self.finder():
+            present[fleet.device_id(dev)] = dev
+        for ident in set(self.channels) - set(present):
+            self.detach(ident)
+        for ident in set(present) - set(self.channels) - self._opening:
+            # opening talks to the device, keep it off the loop
+            self._opening.add(ident)
+            opened = self.loop.run_in_executor(self._open, present[ident])
+            opened.add_done_callback(lambda f, ident=ident:
+                                     self._opened(ident, f))
+        self._timer = self.loop.call_later(self.scan, self.hotplug)
+
+    def _open(self, dev):
+        return self.opener(dev), device_serial(dev)
+
+    def _opened(self, ident, fut):
+        self._opening.discard(ident)
+        exc = fut.exception()
+        if exc is not None:
+            self.trace.log('HUB > Opening %s: %s' % (ident, exc))
+            return
+        comm, serial = fut.result()
+        if self.server is None:
+            # stopped while opening
+            comm.close()
+            return
+        try:
+            self.attach(ident, comm, serial)
+        except Exception, e:
+            self.trace.log('HUB > Opening %s: %s' % (ident, e))
+            comm.close()
+
+    def attach(self, ident, comm, serial=None):
+        "Start the channel of an opened meter"
+        channel = self.channel_class(comm, loop=self.loop, trace=self.trace,
+                                     **self.kw)
+        channel.ident = ident
+        channel.serial = serial
+        port = self.ports.get(channel.serial, self.ports.get(ident))
+        if port is not None:
+            channel.host = self.host
+            channel.port = port
+            done = channel.start()
+        else:
+            channel.running = True
+            done = channel.serve()
+        # Let go of the device once the channel is done with it, which
+        # is after its last USB call has returned
+        done.add_done_callback(lambda f: comm.close())
+        self.loop.executor.workers += self.threads_per_channel
+        self.channels[ident] = channel
+        self.trace.log('HUB > Meter %s (%s) attached' % (ident,
+                                                         channel.serial))
+        return channel
+
+    def detach(self, ident):
+        channel = self.channels.pop(ident)
+        self.trace.log('HUB > Meter %s detached' % ident)
+        channel.stop()
+        self.loop.executor.workers -= self.threads_per_channel
+
+    def find(self, name):
+        "Return the channel of the meter with the given serial or id"
+        if name in self.channels:
+            return self.channels[name]
+        for channel in self.channels.values():
+            if channel.serial == name:
+                return channel
+        return None
+
+    def _accept(self):
+        try:
+            sock, addr = self.server.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        sock.setblocking(0)
+        self._handshakes[sock.fileno()] = (sock, '')
+        self.loop.add_reader(sock, self._handshake, sock)
+
+    def _drop(self, sock):
+        self._handshakes.pop(sock.fileno(), None)
+        self.loop.remove_reader(sock)
+        sock.close()
+
+    def _handshake(self, sock):
+        "Read the meter name line and hand the client to its channel"
+        try:
+            data = sock.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        if not data:
+            self._drop(sock)
+            return
+        data = self._handshakes[sock.fileno()][1] + data
+        if '\n' not in data:
+            if len(data) > 256:
+                self._drop(sock)
+            else:
+                self._handshakes[sock.fileno()] = (sock, data)
+            return
+        name, rest = data.split('\n', 1)
+        channel = self.find(name.strip())
+        if channel is None:
+            try:
+                sock.send('ERROR no meter %s\n' % name.strip())
+            except socket.error:
+                pass
+            self._drop(sock)
+            return
+        del self._handshakes[sock.fileno()]
+        self.loop.remove_reader(sock)
+        client = channel.attach(sock)
+        if rest:
+            channel.received(client, rest)
+
+    def run(self):
+        done = self.start()
+        print >>sys.stderr, 'HUB > Server: %s:%d' % (self.host, self.port)
+        try:
+            self.loop.run_until_complete(done)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+def main(argv):
+    # usage: multimux [--records] [SERIAL=PORT ...]
+    ports = dict((a.split('=', 1)[0], int(a.split('=', 1)[1]))
+                 for a in argv[1:] if '=' in a)
+    MultiMux(ports=ports, records='--records' in argv[1:]).run()
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,407 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Event loop based mux between the meter and TCP clients
+
+Like stream.Stream, but every client has a bounded outgoing buffer and
+is written to only when its socket is writable, so a slow client can't
+stall the meter or the other clients. What happens to a client whose
+buffer is full is decided by the overflow policy:
+
+  drop        new data is dropped for that client
+  disconnect  the client is disconnected
+  coalesce    the oldest buffered data is dropped to make room
+"""
+
+import collections
+import errno
+import json
+import socket
+import sys
+
+import usbcomm
+import contourusb
+import loop as _loop
+import tracing
+from stream import _default_host, _default_port
+
+DROP = 'drop'
+DISCONNECT = 'disconnect'
+COALESCE = 'coalesce'
+
+class Subscriber(object):
+    "A client socket with a bounded outgoing buffer"
+
+    def __init__(self, mux, sock, maxbuffer, policy):
+        self.mux = mux
+        self.sock = sock
+        self.maxbuffer = maxbuffer
+        self.policy = policy
+        self.queue = collections.deque()
+        self.buffered = 0
+        self.dropped = 0
+        self.closed = False
+        # received data up to the end of the last full line
+        self.pending = ''
+        try:
+            self.name = sock.getpeername()
+        except socket.error:
+            self.name = 'client %d' % sock.fileno()
+
+    def send(self, data, exempt=False):
+        """
+        Queue data for the client, applying the overflow policy
+
+        exempt data is always queued, it still counts towards the
+        buffer size for later sends.
+        """
+        if self.closed:
+            return
+        if not exempt and self.buffered + len(data) > self.maxbuffer:
+            if self.policy == DISCONNECT:
+                self.mux.remove(self, 'buffer full')
+                return
+            if self.policy == COALESCE:
+                while self.queue and \
+                        self.buffered + len(data) > self.maxbuffer:
+                    old = self.queue.popleft()
+                    self.buffered -= len(old)
+                    self.dropped += len(old)
+                data = data[-self.maxbuffer:]
+            else:
+                self.dropped += len(data)
+                return
+        wasempty = not self.queue
+        self.queue.append(data)
+        self.buffered += len(data)
+        if wasempty:
+            self.flush()
+
+    def flush(self):
+        "Send as much as the socket takes"
+        if self.closed:
+            return
+        while self.queue:
+            data = self.queue[0]
+            try:
+                sent = self.sock.send(data)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self.mux.remove(self, 'send failed: %s' % e)
+                return
+            self.buffered -= sent
+            if sent < len(data):
+                self.queue[0] = data[sent:]
+                break
+            self.queue.popleft()
+        if self.queue:
+            self.mux.loop.add_writer(self.sock, self.flush)
+        else:
+            self.mux.loop.remove_writer(self.sock)
+
+    def close(self):
+        self.closed = True
+        self.mux.loop.remove_reader(self.sock)
+        self.mux.loop.remove_writer(self.sock)
+        self.sock.close()
+
+class Mux(object):
+    """
+    Forward meter data to any number of TCP clients
+
+    Data from clients is written to the meter; USB reads and writes run
+    in the loop's executor. maxbuffer is the per client outgoing buffer
+    size in bytes, policy one of DROP, DISCONNECT and COALESCE. If a
+    write to the meter fails the clients are disconnected and the future
+    of serve() fails with the error.
+    """
+    def __init__(self, usb, loop=None, host=_default_host, port=_default_port,
+                 maxbuffer=64 * 1024, policy=DROP, readtimeout=500,
+                 trace=None):
+        if policy not in (DROP, DISCONNECT, COALESCE):
+            raise ValueError("Unknown overflow policy", policy)
+        self.usb = usb
+        self.loop = loop or _loop.EventLoop()
+        self.host = host
+        self.port = port
+        self.maxbuffer = maxbuffer
+        self.policy = policy
+        self.readtimeout = readtimeout
+        self.trace = trace or tracing.null
+        self.clients = []
+        self.server = None
+        self.running = False
+        self.error = None
+        self._writes = collections.deque()
+        self._writing = False
+
+    def start(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.setblocking(0)
+        self.server.bind((self.host, self.port))
+        self.server.listen(128)
+        self.port = self.server.getsockname()[1]
+        self.loop.add_reader(self.server, self._accept)
+        self.running = True
+        return self.serve()
+
+    def serve(self):
+        "Start talking to the meter, returns a future done when finished"
+        return self.loop.create_task(self._read_usb())
+
+    def stop(self):
+        self.running = False
+        for client in list(self.clients):
+            self.remove(client, 'shutting down')
+        if self.server is not None:
+            self.loop.remove_reader(self.server)
+            self.server.close()
+            self.server = None
+
+    def _accept(self):
+        try:
+            sock, addr = self.server.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        self.attach(sock)
+
+    def attach(self, sock):
+        "Serve a connected client socket, returns its Subscriber"
+        sock.setblocking(0)
+        client = Subscriber(self, sock, self.maxbuffer, self.policy)
+        self.clients.append(client)
+        self.loop.add_reader(sock, self._recv, client)
+        self.trace.log('MUX > New connection from', client.name)
+        self.added(client)
+        return client
+
+    def added(self, client):
+        "Called for each new client, override to greet it"
+        pass
+
+    def remove(self, client, why='?'):
+        if client.closed:
+            return
+        self.trace.log('MUX > Closing %s: %s' % (client.name, why))
+        if self.trace.enabled:
+            self.trace.count('mux.disconnects')
+        self.clients.remove(client)
+        client.close()
+
+    def _recv(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        if not data:
+            self.remove(client, 'Got no data')
+            return
+        self.received(client, data)
+
+    def received(self, client, data):
+        "Data from a client, goes to the meter"
+        self._writes.append(data)
+        if not self._writing:
+            self._writing = True
+            self.loop.create_task(self._write_usb())
+
+    def _write_usb(self):
+        try:
+            while self._writes:
+                yield self.loop.run_in_executor(self.usb.write,
+                                                self._writes.popleft())
+        except Exception, e:
+            self.failed(e)
+        finally:
+            self._writing = False
+
+    def failed(self, exc):
+        "The meter link broke, close the channel"
+        self.trace.log('MUX > Meter failed: %s' % exc)
+        self.error = exc
+        self._writes.clear()
+        for client in list(self.clients):
+            self.remove(client, 'meter failed: %s' % exc)
+        self.stop()
+
+    def _read_usb(self):
+        while self.running:
+            try:
+                data = yield self.loop.run_in_executor(self.usb.read,
+                                                       self.readtimeout)
+            except usbcomm.usb.core.USBError, e:
+                if e.errno != errno.ETIMEDOUT:
+                    raise
+                continue
+            if data:
+                self.broadcast(data)
+        if self.error is not None:
+            raise self.error
+
+    def broadcast(self, data):
+        "Send data to every client"
+        if self.trace.enabled:
+            self.trace.count('mux.bytes_in', len(data))
+        for client in list(self.clients):
+            before = client.dropped
+            client.send(data)
+            if self.trace.enabled and client.dropped != before:
+                self.trace.count('mux.bytes_dropped', client.dropped - before)
+
+    def run(self):
+        done = self.start()
+        print >>sys.stderr, 'MUX > Server: %s:%d' % (self.host, self.port)
+        try:
+            self.loop.run_until_complete(done)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            self.usb.close()
+
+class RecordMux(Mux):
+    """
+    Run the meter protocol in the mux and publish decoded records
+
+    Subscribers get newline delimited JSON objects: a header, one
+    result per reading and an end marker. The last complete dump of
+    each meter is kept, keyed by meter_serial and header_datetime, and
+    sent to new subscribers straight away; a meter transfer is only
+    started when there is no dump yet or a subscriber sends a "sync"
+    line. Subscribers can't write to the meter; other lines are answered
+    with an error.
+    """
+    def __init__(self, usb, maxbuffer=4 << 20, **kw):
+        # room for a whole live transfer; the replay of the last dump to
+        # a new subscriber is exempt from the limit
+        Mux.__init__(self, usb, maxbuffer=maxbuffer, **kw)
+        self.dumps = {}
+        self.last = None
+        self.current = None
+        self._bc = None
+        self._done = None
+
+    def serve(self):
+        self._done = _loop.Future(self.loop)
+        self.sync()
+        return self._done
+
+    def stop(self):
+        Mux.stop(self)
+        if self.current is not None:
+            # done once the transfer has ended and the meter is idle
+            self._bc.interrupt()
+        elif self._done is not None:
+            self._done.set_result(None)
+
+    def sync(self):
+        "Start a meter transfer unless one is running"
+        if self.current is not None:
+            return
+        self.current = []
+        bc = self._bc = contourusb.AsyncBayerCOMM(self.usb, self.loop,
+                                                  trace=self.trace)
+        cu = contourusb.ContourUSB(keep=False, trace=self.trace,
+                                   on_result=self._result)
+
+        def frame(text):
+            cu.record(text)
+            if text[0] == 'H':
+                msg = cu.header()
+                msg['type'] = 'header'
+                self.publish(msg)
+
+        task = bc.sync(frame)
+        task.add_done_callback(lambda t: self._synced(t, cu))
+
+    def _result(self, result):
+        msg = result.asdict()
+        msg['type'] = 'result'
+        self.publish(msg)
+
+    def _synced(self, task, cu):
+        lines, self.current = self.current, None
+        if not self.running:
+            self._done.set_result(None)
+            return
+        exc = task.exception()
+        if exc is not None:
+            self.trace.log('MUX > Sync failed: %s' % exc)
+            self.broadcast(self.encode({'type': 'error',
+                                        'error': str(exc)}))
+            return
+        cu.flush()
+        end = self.encode({'type': 'end'})
+        lines.append(end)
+        self.broadcast(end)
+        key = (getattr(cu, 'meter_serial', None),
+               getattr(cu, 'header_datetime', None))
+        for old in [k for k in self.dumps if k[0] == key[0]]:
+            del self.dumps[old]
+        self.dumps[key] = lines
+        self.last = key
+
+    def encode(self, msg):
+        return json.dumps(msg, sort_keys=True) + '\n'
+
+    def publish(self, msg):
+        line = self.encode(msg)
+        self.current.append(line)
+        self.broadcast(line)
+
+    def added(self, client):
+        if self.current is not None:
+            # a transfer is running, catch up with it
+            lines = self.current
+        elif self.last is not None:
+            lines = self.dumps[self.last]
+        else:
+            self.sync()
+            return
+        # the replay may be larger than the buffer, don't drop it
+        client.send(''.join(lines), exempt=True)
+
+    def received(self, client, data):
+        lines = (client.pending + data).split('\n')
+        client.pending = lines.pop()
+        if len(client.pending) > 256:
+            self.remove(client, 'line too long')
+            return
+        for line in lines:
+            command = line.strip()
+            if command == 'sync':
+                self.sync()
+            elif command:
+                client.send(self.encode({'type': 'error', 'error':
+                                         'Unknown command: %r' % command}))
+
+def main(argv):
+    args = [a for a in argv[1:] if not a.startswith('--')]
+    policy = args[0] if args else DROP
+    uc = usbcomm.USBComm(idVendor=usbcomm.ids.Bayer,
+                         idProduct=usbcomm.ids.Bayer.Contour)
+    if '--records' in argv[1:]:
+        RecordMux(uc).run()
+    else:
+        Mux(uc, policy=policy).run()
+
+if __name__ == '__main__':
+    main(sys.argv)
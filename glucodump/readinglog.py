@@ -0,0 +1,269 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Append-only binary log of readings
+
+A header followed by fixed width records:
+
+  serial id  uint32   index into the serials file next to the log
+  minute     uint32   epoch time in minutes
+  value      float64
+  recno      uint32
+  unit       uint8    store.ResultStore unit code
+  method     uint8    index into store.METHODS
+  flags      uint32   store.FLAGBITS, CONTROL for control results
+
+Records are kept in time order, so a time range is found by bisecting
+the minute column of the mmapped log; to_numpy() gives a zero-copy
+structured array for analytics. Appending only writes what is new:
+results already logged for the meter, by recno and minute, are skipped,
+and results older than the end of the log (another meter, or one with
+its clock set back) are merged into its tail.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+
+import lazy
+import store
+import contourusb
+
+numpy = lazy.optional('numpy')
+
+MAGIC = 'GDLOG\x02'
+_header = struct.Struct('<6s2x')
+_record = struct.Struct('<IIdIBBI')
+
+# Stored in the flags of control results
+CONTROL = 1 << 31
+
+UNITS = ['mg/dL', 'mmol/L']
+
+# The NumPy dtype of a record
+DTYPE = [('serial', '<u4'), ('minute', '<u4'), ('value', '<f8'),
+         ('recno', '<u4'), ('unit', 'u1'), ('method', 'u1'), ('flags', '<u4')]
+
+class LogError(Exception):
+    pass
+
+class Reading(store.ResultFields):
+    "A record of the log"
+    __slots__ = ('meter_serial', 'recno', 'time', 'value', 'unit',
+                 'reference', 'meastype', 'flags', 'is_control')
+
+    flagmap = contourusb.resultflagmap
+    methodmap = contourusb.referencemap
+
+    def __init__(self, serial, minute, value, recno, unit, method, flags):
+        self.meter_serial = serial
+        self.recno = recno
+        self.time = minute * 60
+        self.value = value
+        self.unit = None if unit == store.NOCODE else UNITS[unit]
+        self.reference = None if method == store.NOCODE \
+            else store.METHODS[method]
+        self.meastype = 'Glucose'
+        self.flags = flags & ~CONTROL
+        self.is_control = bool(flags & CONTROL)
+
+class _Minutes(object):
+    "The minute column of a mapped log, as a sequence for bisect"
+    def __init__(self, buf, count):
+        self.buf = buf
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return struct.unpack_from('<I', self.buf,
+                                  _header.size + i * _record.size + 4)[0]
+
+class ReadingLog(object):
+    """
+    Append results to, and query, a reading log
+
+    path is created if missing.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.serialpath = path + '.serials'
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(_header.pack(MAGIC))
+        with open(path, 'rb') as f:
+            magic, = _header.unpack(f.read(_header.size))
+        if magic != MAGIC:
+            raise LogError("Not a reading log", path)
+        self.serials = []
+        if os.path.exists(self.serialpath):
+            with open(self.serialpath) as f:
+                self.serials = f.read().splitlines()
+        self._serialids = dict((s, i) for i, s in enumerate(self.serials))
+        self._file = None
+        self._map = None
+
+    def _serialid(self, serial):
+        try:
+            return self._serialids[serial]
+        except KeyError:
+            with open(self.serialpath, 'a') as f:
+                f.write(serial + '\n')
+            self._serialids[serial] = len(self.serials)
+            self.serials.append(serial)
+            return self._serialids[serial]
+
+    def _logged(self, minutes, sid, minute, recno):
+        "Is there a record of serial id sid with recno at minute?"
+        i = bisect.bisect_left(minutes, minute)
+        unpack = _record.unpack_from
+        while i < len(minutes):
+            rec = unpack(self._map, _header.size + i * _record.size)
+            if rec[1] != minute:
+                return False
+            if rec[0] == sid and rec[3] == recno:
+                return True
+            i += 1
+        return False
+
+    def append(self, serial, results):
+        """
+        Append the new results of meter serial, returns the number written
+
+        Results of serial already in the log are skipped, so a meter's
+        whole memory can be appended every sync. They are looked up by
+        bisecting the log, only for results no newer than its end.
+        """
+        sid = self._serialid(serial)
+        n = len(self)
+        minutes = _Minutes(self._map, n)
+        last = minutes[n - 1] if n else -1
+        pack = _record.pack
+        records = []
+        keys = set()
+        for r in sorted((r for r in results if r.value is not None
+                         and r.time is not None and r.time != store.NOTIME),
+                        key=lambda r: (r.time, r.recno)):
+            minute = r.time // 60
+            key = minute, r.recno
+            if key in keys or minute <= last and \
+                    self._logged(minutes, sid, minute, r.recno):
+                continue
+            flags = r.flags | (CONTROL if r.is_control else 0)
+            unit = store.NOCODE if r.unit is None else UNITS.index(r.unit)
+            method = store.NOCODE if r.reference is None \
+                else store.METHODS.index(r.reference)
+            keys.add(key)
+            records.append((minute, pack(sid, minute, r.value, r.recno,
+                                         unit, method, flags)))
+        if not records:
+            return 0
+        added = len(records)
+        # Records older than the end of the log are merged into the tail
+        first = n
+        if records[0][0] < last:
+            first = bisect.bisect_right(minutes, records[0][0])
+        if first < n:
+            size = _record.size
+            tail = self._map[_header.size + first * size:]
+            old = [(struct.unpack_from('<I', tail, i + 4)[0],
+                    tail[i:i + size]) for i in xrange(0, len(tail), size)]
+            records = sorted(old + records, key=lambda rec: rec[0])
+        self.close()
+        with open(self.path, 'r+b') as f:
+            f.seek(_header.size + first * _record.size)
+            f.write(''.join(rec for minute, rec in records))
+        return added
+
+    def ingest(self, cu):
+        "Append the results of a synced ContourUSB"
+        return self.append(cu.meter_serial, cu.result.values())
+
+    def _mapped(self):
+        "Return the mapped log, None while it has no records"
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+            size = os.fstat(self._file.fileno()).st_size
+            if size > _header.size:
+                self._map = mmap.mmap(self._file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+        return self._map
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        buf = self._mapped()
+        if buf is None:
+            return 0
+        return (len(buf) - _header.size) // _record.size
+
+    def __getitem__(self, i):
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError(i)
+        rec = _record.unpack_from(self._map, _header.size + i * _record.size)
+        return Reading(self.serials[rec[0]], *rec[1:])
+
+    def span(self, start=None, end=None):
+        "Return the (first, stop) record indices of [start, end)"
+        n = len(self)
+        minutes = _Minutes(self._map, n)
+        first = 0 if start is None else \
+            bisect.bisect_left(minutes, (start + 59) // 60)
+        stop = len(minutes) if end is None else \
+            bisect.bisect_left(minutes, (end + 59) // 60)
+        return first, stop
+
+    def readings(self, start=None, end=None, serial=None):
+        "Iterate over the readings in [start, end) of epoch seconds"
+        sid = None
+        if serial is not None:
+            sid = self._serialids.get(serial)
+            if sid is None:
+                return
+        first, stop = self.span(start, end)
+        buf = self._map
+        unpack = _record.unpack_from
+        for i in xrange(first, stop):
+            rec = unpack(buf, _header.size + i * _record.size)
+            if sid is not None and rec[0] != sid:
+                continue
+            yield Reading(self.serials[rec[0]], *rec[1:])
+
+    def to_numpy(self, start=None, end=None):
+        """
+        Return the records in [start, end) as a structured NumPy array
+
+        The array shares memory with the mapped file, it is read only and
+        valid until the next append() or close().
+        """
+        if numpy is None:
+            raise ImportError("NumPy is needed for to_numpy()")
+        n = len(self)
+        if not n:
+            return numpy.zeros(0, DTYPE)
+        first, stop = self.span(start, end)
+        return numpy.frombuffer(self._map, DTYPE, stop - first,
+                                _header.size + first * _record.size)
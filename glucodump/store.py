@@ -0,0 +1,397 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Compact columnar storage of meter results
+
+Each column is an array; unit, method and measurement type are small
+int codes and the result flags a bitmask. ResultStore behaves like the
+recno -> Result dict it replaces, handing out light ResultView objects
+that read and write the columns of one row.
+"""
+
+import array
+import bisect
+import calendar
+import time
+
+import lazy
+
+numpy = lazy.optional('numpy')
+
+# Flag codes in bit order
+FLAGS = ['<', '>', 'C', 'B', 'A', 'D', 'I', 'S', 'X',
+         'Z1', 'Z2', 'Z3', 'Z4', 'Z5', 'Z6', 'Z7', 'Z8', 'Z9', 'ZA', 'ZB', 'ZC']
+FLAGBITS = dict((f, 1 << i) for i, f in enumerate(FLAGS))
+
+# Reference method codes
+METHODS = ['B', 'P', 'C', 'D']
+
+NOTIME = -1
+NOCODE = 255
+
+# Epoch time of the start of YYYYMMDD, results come a few a day
+_days = {}
+
+def _day(date):
+    try:
+        return _days[date]
+    except KeyError:
+        if len(_days) > 4096:
+            _days.clear()
+        t = _days[date] = calendar.timegm((int(date[0:4]), int(date[4:6]),
+                                           int(date[6:8]), 0, 0, 0, 0, 0, 0))
+        return t
+
+def parsetime(testtime):
+    "Return the epoch time of a YYYYMMDDHHMM or YYYYMMDDHHMMSS string"
+    t = _day(testtime[:8]) + int(testtime[8:10]) * 3600 + \
+        int(testtime[10:12]) * 60
+    if len(testtime) > 12:
+        t += int(testtime[12:14])
+    return t
+
+def _checktime(testtime):
+    if len(testtime) < 12 or not testtime[:12].isdigit():
+        raise ValueError("Not a YYYYMMDDHHMM time", testtime)
+    return testtime
+
+def parsetimes(testtimes):
+    """
+    Return the epoch times of a sequence of YYYYMMDDHHMM strings
+
+    Seconds, if any, are ignored. With NumPy the digits are decoded for
+    the whole column at once and an int64 array returned, otherwise an
+    array('l'). Raises ValueError for a string that doesn't start with
+    12 digits.
+    """
+    if numpy is None:
+        return array.array('l', (_day(t[:8]) + int(t[8:10]) * 3600 +
+                                 int(t[10:12]) * 60
+                                 for t in map(_checktime, testtimes)))
+    # shorter strings are padded with NULs, which fail the digit check
+    digits = numpy.array(testtimes, 'S12').view('u1').reshape(-1, 12)
+    digits = digits.astype('i8') - ord('0')
+    bad = ((digits < 0) | (digits > 9)).any(axis=1)
+    if bad.any():
+        _checktime(testtimes[int(bad.argmax())])
+    scale = 10 ** numpy.arange(7, -1, -1)
+    dates, index = numpy.unique(digits[:, :8].dot(scale),
+                                return_inverse=True)
+    days = numpy.array([_day(str(d)) for d in dates], 'i8')
+    return days[index] + \
+        (digits[:, 8] * 10 + digits[:, 9]) * 3600 + \
+        (digits[:, 10] * 10 + digits[:, 11]) * 60
+
+def formattime(t):
+    "Return the YYYYMMDDHHMM string of an epoch time"
+    return time.strftime('%Y%m%d%H%M', time.gmtime(t))
+
+def flagbits(flags):
+    "Return the bitmask of a sequence of flag codes"
+    bits = 0
+    for f in flags:
+        bits |= FLAGBITS[f]
+    return bits
+
+class _Codes(object):
+    "Map strings to small int codes and back"
+    def __init__(self, names=()):
+        self.names = list(names)
+        self.codes = dict((n, i) for i, n in enumerate(self.names))
+
+    def code(self, name):
+        try:
+            return self.codes[name]
+        except KeyError:
+            if len(self.names) >= NOCODE:
+                raise ValueError("Too many distinct values", name)
+            self.codes[name] = len(self.names)
+            self.names.append(name)
+            return self.codes[name]
+
+    def name(self, code):
+        if code == NOCODE:
+            return None
+        return self.names[code]
+
+class ResultFields(object):
+    """
+    Fields of a result derived from its stored ones
+
+    Subclasses provide recno, time, value, unit, reference, meastype,
+    flags and is_control.
+    """
+    __slots__ = ()
+
+    flagmap = {}
+    methodmap = {}
+
+    @property
+    def method(self):
+        return self.methodmap.get(self.reference)
+
+    @property
+    def flagcodes(self):
+        bits = self.flags
+        return [f for f in FLAGS if bits & FLAGBITS[f]]
+
+    @property
+    def resultflags(self):
+        flagmap = self.flagmap
+        return [flagmap.get(f, f) for f in self.flagcodes]
+
+    @property
+    def testtime(self):
+        t = self.time
+        return None if t is None or t == NOTIME else formattime(t)
+
+    @testtime.setter
+    def testtime(self, value):
+        self.time = parsetime(value)
+
+    def asdict(self):
+        "Return the result as a dict of plain values, for JSON and the like"
+        t = self.time
+        return {
+            'recno': self.recno,
+            'time': None if t is None or t == NOTIME else t,
+            'testtime': self.testtime,
+            'value': self.value,
+            'unit': self.unit,
+            'method': self.method,
+            'meastype': self.meastype,
+            'flags': self.flagcodes,
+            'control': self.is_control,
+            }
+
+    def __repr__(self):
+        return '<%s %d: %s %r %s>' % (self.__class__.__name__, self.recno,
+                                      self.testtime, self.value, self.unit)
+
+class ResultView(ResultFields):
+    "One row of a ResultStore, looks like a contourusb.Result"
+
+    __slots__ = ('store', 'row')
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    def _get(name):
+        return lambda self: getattr(self.store, name)[self.row]
+
+    def _set(name):
+        def setter(self, value):
+            getattr(self.store, name)[self.row] = value
+        return setter
+
+    recno = property(_get('recno'))
+    time = property(_get('time'), _set('time'))
+    value = property(_get('value'), _set('value'))
+    flags = property(_get('flags'), _set('flags'))
+
+    del _get, _set
+
+    flagmap = property(lambda self: self.store.flagmap)
+    methodmap = property(lambda self: self.store.methodmap)
+
+    @property
+    def is_control(self):
+        return bool(self.store.control[self.row])
+
+    @is_control.setter
+    def is_control(self, value):
+        self.store.control[self.row] = bool(value)
+
+    @property
+    def unit(self):
+        return self.store.units.name(self.store.unit[self.row])
+
+    @unit.setter
+    def unit(self, value):
+        self.store.unit[self.row] = self.store.units.code(value)
+
+    @property
+    def meastype(self):
+        return self.store.meastypes.name(self.store.meastype[self.row])
+
+    @meastype.setter
+    def meastype(self, value):
+        self.store.meastype[self.row] = self.store.meastypes.code(value)
+
+    @property
+    def reference(self):
+        "The reference method code, B, P, C or D"
+        code = self.store.method[self.row]
+        return None if code == NOCODE else METHODS[code]
+
+    @reference.setter
+    def reference(self, value):
+        self.store.method[self.row] = METHODS.index(value)
+
+class ResultStore(object):
+    """
+    Columnar store of results, keyed by recno
+
+    Rows are appended in arrival order. As long as recnos arrive in
+    increasing order (as the meter sends them) lookups bisect the recno
+    column, otherwise a dict index is built.
+    """
+    columns = (('recno', 'i'), ('time', 'l'), ('value', 'd'),
+               ('unit', 'B'), ('method', 'B'), ('meastype', 'B'),
+               ('flags', 'I'), ('control', 'B'))
+
+    def __init__(self, flagmap=None, methodmap=None):
+        for name, typecode in self.columns:
+            setattr(self, name, array.array(typecode))
+        self.flagmap = flagmap or {}
+        self.methodmap = methodmap or {}
+        self.units = _Codes(['mg/dL', 'mmol/L'])
+        self.meastypes = _Codes(['Glucose'])
+        self._index = None
+
+    @classmethod
+    def fromstrings(cls, columns, units, meastypes, flagmap=None,
+                    methodmap=None):
+        """
+        Build a store from packed columns, as from array.tostring()
+
+        units and meastypes are the names of the codes used in them.
+        """
+        self = cls(flagmap, methodmap)
+        for name, typecode in self.columns:
+            getattr(self, name).fromstring(columns.get(name, ''))
+        self.units = _Codes(units)
+        self.meastypes = _Codes(meastypes)
+        recno = self.recno
+        if any(recno[i] >= recno[i+1] for i in xrange(len(recno) - 1)):
+            self._index = dict((r, i) for i, r in enumerate(recno))
+        return self
+
+    def __len__(self):
+        return len(self.recno)
+
+    def _row(self, recno):
+        if self._index is not None:
+            return self._index.get(recno)
+        row = bisect.bisect_left(self.recno, recno)
+        if row < len(self.recno) and self.recno[row] == recno:
+            return row
+        return None
+
+    def append(self, recno, time=NOTIME, value=float('nan'), unit=None,
+               reference=None, meastype=None, flags=0, control=False):
+        "Add a row for a new recno, returns its view"
+        row = len(self.recno)
+        if self._index is None and row and recno <= self.recno[-1]:
+            self._index = dict((r, i) for i, r in enumerate(self.recno))
+        if self._index is not None:
+            if recno in self._index:
+                raise KeyError("Duplicate recno", recno)
+            self._index[recno] = row
+        self.recno.append(recno)
+        self.time.append(time)
+        self.value.append(value)
+        self.unit.append(NOCODE if unit is None else self.units.code(unit))
+        self.method.append(NOCODE if reference is None
+                           else METHODS.index(reference))
+        self.meastype.append(NOCODE if meastype is None
+                             else self.meastypes.code(meastype))
+        self.flags.append(flags)
+        self.control.append(bool(control))
+        return ResultView(self, row)
+
+    def add(self, result):
+        """
+        Add a Result-like object, returns its view
+
+        If the recno is already stored (say from an earlier O record)
+        the row is updated instead.
+        """
+        row = self._row(result.recno)
+        if row is None:
+            return self.append(result.recno,
+                               NOTIME if result.time is None else result.time,
+                               float('nan') if result.value is None
+                               else result.value,
+                               result.unit, result.reference, result.meastype,
+                               result.flags, result.is_control)
+        view = ResultView(self, row)
+        if result.value is not None:
+            view.value = result.value
+            view.time = NOTIME if result.time is None else result.time
+            view.unit = result.unit
+            view.reference = result.reference
+            view.meastype = result.meastype
+            view.flags = result.flags
+        if result.is_control:
+            view.is_control = True
+        return view
+
+    def __getitem__(self, recno):
+        row = self._row(recno)
+        if row is None:
+            raise KeyError(recno)
+        return ResultView(self, row)
+
+    def __contains__(self, recno):
+        return self._row(recno) is not None
+
+    def get(self, recno, default=None):
+        row = self._row(recno)
+        return default if row is None else ResultView(self, row)
+
+    def setdefault(self, recno):
+        "Return the view of recno, adding an empty row if needed"
+        row = self._row(recno)
+        if row is None:
+            return self.append(recno)
+        return ResultView(self, row)
+
+    def __iter__(self):
+        return iter(self.recno)
+
+    def keys(self):
+        return self.recno.tolist()
+
+    def values(self):
+        return [ResultView(self, row) for row in range(len(self.recno))]
+
+    def items(self):
+        return [(recno, ResultView(self, row))
+                for row, recno in enumerate(self.recno)]
+
+    def nbytes(self):
+        "Memory used by the columns"
+        return sum(getattr(self, name).itemsize * len(self.recno)
+                   for name, typecode in self.columns)
+
+    def to_numpy(self):
+        """
+        Return the columns as NumPy arrays sharing memory with the store
+
+        The arrays are only valid until the store grows; copy them if
+        more results will be added.
+        """
+        if numpy is None:
+            raise ImportError("NumPy is needed for to_numpy()")
+        result = {}
+        for name, typecode in self.columns:
+            col = getattr(self, name)
+            if len(col):
+                result[name] = numpy.frombuffer(col, col.typecode)
+            else:
+                result[name] = numpy.zeros(0, col.typecode)
+        return result
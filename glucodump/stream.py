@@ -1,23 +1,128 @@
 #!/usr/bin/python
 import sys, os
+import errno, fcntl, threading
 import select, socket
 
 import usbcomm
-import usb
+import tracing
 
 _default_host = 'localhost'
 _default_port = 23200
 
 _READ_ONLY = select.POLLIN | select.POLLPRI
 
+class RingBuffer(object):
+  """
+  Byte ring buffer between one writer and one reader thread
+
+  The lock is only held to move the indices; the data is copied
+  outside it. A writer finding the buffer full waits for the reader.
+  """
+  def __init__(self, size=64 * 1024):
+    self.buf = bytearray(size)
+    self.size = size
+    self.head = 0 # total bytes written
+    self.tail = 0 # total bytes read
+    self.cond = threading.Condition()
+
+  def __len__(self):
+    return self.head - self.tail
+
+  def write(self, data):
+    pos = 0
+    while pos < len(data):
+      with self.cond:
+        while self.head - self.tail == self.size:
+          self.cond.wait()
+        free = self.size - (self.head - self.tail)
+        head = self.head
+      count = min(free, len(data) - pos)
+      start = head % self.size
+      first = min(count, self.size - start)
+      self.buf[start:start+first] = buffer(data, pos, first)
+      if count > first:
+        self.buf[0:count-first] = buffer(data, pos + first, count - first)
+      with self.cond:
+        self.head += count
+      pos += count
+
+  def read(self):
+    "Return everything buffered, '' if nothing is"
+    with self.cond:
+      count = self.head - self.tail
+      tail = self.tail
+    if not count:
+      return ''
+    start = tail % self.size
+    first = min(count, self.size - start)
+    data = str(buffer(self.buf, start, first))
+    if count > first:
+      data += str(buffer(self.buf, 0, count - first))
+    with self.cond:
+      self.tail += count
+      self.cond.notify()
+    return data
+
+class USBReader(threading.Thread):
+  """
+  Read the meter into a RingBuffer, waking the poll loop through a pipe
+
+  USB timeouts just mean no data; any other error is kept in error and
+  the loop woken so it can raise it.
+  """
+  def __init__(self, device, ring, wakefd, timeout=100):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.device = device
+    self.ring = ring
+    self.wakefd = wakefd
+    self.timeout = timeout
+    self.error = None
+    self.stopped = False
+
+  def wake(self):
+    try:
+      os.write(self.wakefd, 'x')
+    except OSError, e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def run(self):
+    while not self.stopped:
+      try:
+        data = self.device.read(self.timeout)
+      except usbcomm.usb.core.USBError, e:
+        if e.errno == errno.ETIMEDOUT:
+          continue
+        self.error = e
+        self.wake()
+        return
+      if data:
+        self.ring.write(data)
+        self.wake()
+
+  def stop(self):
+    self.stopped = True
+
 class Stream(object):
   def __init__(self,
         host=_default_host,
-        port=_default_port):
+        port=_default_port,
+        trace=None,
+        device=None):
 
     self.host = host
     self.port = port
-    self.usb = usbcomm.USBComm(idVendor=usbcomm.ids.Bayer, idProduct=usbcomm.ids.Bayer.Contour)
+    self.trace = trace or tracing.null
+    if device is None:
+      device = usbcomm.USBComm(idVendor=usbcomm.ids.Bayer, idProduct=usbcomm.ids.Bayer.Contour)
+    self.usb = device
+
+    self.ring = RingBuffer()
+    self.wakein, self.wakeout = os.pipe()
+    for fd in self.wakein, self.wakeout:
+      fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    self.reader = USBReader(self.usb, self.ring, self.wakeout)
 
     self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     self.server.setblocking(0)
@@ -32,8 +137,13 @@ class Stream(object):
 
     for client in self.clients:
       client.close()
+    self.reader.stop()
+    if self.reader.is_alive():
+      self.reader.join(1)
     self.usb.close()
     self.server.close()
+    os.close(self.wakein)
+    os.close(self.wakeout)
 
     print >>sys.stderr, 'MUX > Done! =)'
 
@@ -55,80 +165,88 @@ class Stream(object):
     client.close()
 
   def read(self):
-    self.sink = None
     try:
-      data = self.usb.read( )
-      self.sink = data
-    except usb.core.USBError, e:
-      if e.errno != 110:
-        print e, dir(e), e.backend_error_code, e.errno
+      os.read(self.wakein, 4096)
+    except OSError, e:
+      if e.errno != errno.EAGAIN:
         raise
+    if self.reader.error is not None:
+      raise self.reader.error
+    self.sink = self.ring.read() or None
     return self.sink is not None
 
   def flush(self):
     if self.sink is not None:
+      if self.trace.enabled:
+        self.trace.count('mux.bytes_out', len(self.sink) * len(self.clients))
       for client in self.clients:
         client.send(self.sink)
     self.sink = None
 
+  def start(self):
+    # USB reads happen on self.reader, which wakes the poll loop
+    # through a pipe whenever it has put data in self.ring
+    self.poller.register(self.wakein, _READ_ONLY)
+    self.fd_to_socket[self.wakein] = self.reader
+
+    self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.server.bind((self.host, self.port))
+    self.server.listen(5)
+    self.poller.register(self.server, _READ_ONLY)
+    self.fd_to_socket[self.server.fileno()] = self.server
+    self.reader.start()
+
+  def run_once(self, timeout=None):
+    events = self.poller.poll(timeout)
+
+    for fd, flag in events:
+      # Get socket from fd
+      s = self.fd_to_socket[fd]
+      if self.trace.enabled:
+        self.trace.log(fd, flag, s)
+
+      if flag & select.POLLHUP:
+        self.remove_client(s, 'HUP')
+
+      elif flag & select.POLLERR:
+        self.remove_client(s, 'Received error')
+
+      elif flag & (_READ_ONLY):
+        # A readable server socket is ready to accept a connection
+        if s is self.server:
+          connection, client_address = s.accept()
+          self.add_client(connection)
+
+        # Data from the meter
+        elif s is self.reader:
+          if self.read( ):
+            self.flush( )
+
+        # Data from client
+        else:
+          data = s.recv(80)
+
+          # Client has data
+          if self.trace.enabled:
+            self.trace.log("send to usb")
+          if data: self.usb.write(data)
+
+          # Interpret empty result as closed connection
+          else: self.remove_client(s, 'Got no data')
+
   def run(self):
     try:
-      # self.tty.setTimeout(0) # Non-blocking
-      # self.tty.flushInput()
-      # self.tty.flushOutput()
-      # self.poller.register(self.usb.epout.bEndpointAddress, _READ_ONLY)
-      # self.fd_to_socket[self.usb.epout.bEndpointAddress] = self.usb
-      # print >>sys.stderr, 'MUX > Serial port: %s @ %s' % (self.device, self.baudrate)
       print >>sys.stderr, 'MUX > usb port: %s' % (self.usb)
 
-      self.server.bind((self.host, self.port))
-      self.server.listen(5)
-      self.poller.register(self.server, _READ_ONLY)
-      self.fd_to_socket[self.server.fileno()] = self.server
+      self.start()
       print >>sys.stderr, 'MUX > Server: %s:%d' % self.server.getsockname()
 
       print >>sys.stderr, 'MUX > Use ctrl+c to stop...\n'
 
       while True:
-        events = self.poller.poll(500)
-        if self.read( ):
-          self.flush( )
-          
-        for fd, flag in events:
-          # Get socket from fd
-          s = self.fd_to_socket[fd]
-          print fd, flag, s
-
-          if flag & select.POLLHUP:
-            self.remove_client(s, 'HUP')
-
-          elif flag & select.POLLERR:
-            self.remove_client(s, 'Received error')
-
-          elif flag & (_READ_ONLY):
-            # A readable server socket is ready to accept a connection
-            if s is self.server:
-              connection, client_address = s.accept()
-              self.add_client(connection)
-
-            # Data from serial port
-            elif s is self.usb:
-              data = s.read( )
-              for client in self.clients:
-                client.send(data)
-
-            # Data from client
-            else:
-              data = s.recv(80)
-
-              # Client has data
-              print "send to usb"
-              if data: self.usb.write(data)
-
-              # Interpret empty result as closed connection
-              else: self.remove_client(s, 'Got no data')
-
-    except usb.core.USBError, e:
+        self.run_once()
+
+    except usbcomm.usb.core.USBError, e:
       print >>sys.stderr, '\nMUX > USB error: "%s". Closing...' % e
 
     except socket.error, e:
@@ -0,0 +1,128 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test the glycemic statistics"
+
+import math
+import os
+import shutil
+import tempfile
+from .. import analytics, store, readinglog
+from ..bench import meter
+
+def close(a, b):
+    return abs(a - b) < 1e-9 * max(1.0, abs(b))
+
+class TestStats(object):
+    def test_stats(self):
+        s = analytics.Stats()
+        assert s.mean is None and s.sd is None and s.cv is None
+        s.add(3, 6.0, 14.0)
+        assert s.mean == 2.0
+        assert s.sd == 1.0
+        assert s.cv == 50.0
+
+class TestAnalytics(object):
+    def test_store(self):
+        cu = meter.synced(300)
+        a = analytics.Analytics()
+        a.add_store(cu.result)
+        values = [r.value for r in cu.result.values() if not r.is_control]
+        assert len(values) < 300
+        n = len(values)
+        mean = sum(values) / n
+        sd = math.sqrt(sum((v - mean) ** 2 for v in values) / (n - 1))
+        stats = a.stats()
+        assert stats.n == n
+        assert close(stats.mean, mean)
+        assert close(stats.sd, sd)
+        assert close(a.a1c(), (mean + 46.7) / 28.7)
+        tir = a.time_in_range()
+        assert close(tir['in'], len([v for v in values
+                                     if 70 <= v <= 180]) / float(n))
+        assert close(sum(tir.values()), 1.0)
+
+    def test_bins(self):
+        cu = meter.synced(300)
+        a = analytics.Analytics()
+        a.add_store(cu.result)
+        results = [r for r in cu.result.values() if not r.is_control]
+        daily = a.daily()
+        assert sum(s.n for day, s in daily) == len(results)
+        day, s = daily[1]
+        values = [r.value for r in results if day <= r.time < day + 86400]
+        assert s.n == len(values)
+        assert close(s.mean, sum(values) / len(values))
+        hourly = a.hourly()
+        assert len(hourly) == 24
+        assert hourly[4].n == len([r for r in results
+                                   if r.time % 86400 // 3600 == 4])
+
+    def test_meals(self):
+        cu = meter.synced(300)
+        a = analytics.Analytics()
+        a.add_store(cu.result)
+        meals = a.meal()
+        results = [r for r in cu.result.values() if not r.is_control]
+        before = [r for r in results if 'B' in r.flagcodes]
+        after = [r for r in results if 'B' not in r.flagcodes and
+                 ('A' in r.flagcodes or
+                  any(f.startswith('Z') for f in r.flagcodes))]
+        assert meals['before'].n == len(before)
+        assert meals['after'].n == len(after)
+        assert meals['other'].n == len(results) - len(before) - len(after)
+
+    def test_incremental(self):
+        whole = analytics.Analytics()
+        whole.add_store(meter.synced(200).result)
+        a = analytics.Analytics()
+        meter.synced(200, keep=False, on_result=a.add_result)
+        assert a.stats().n == whole.stats().n
+        assert close(a.stats().sd, whole.stats().sd)
+        assert [(d, s.n) for d, s in a.daily()] == \
+            [(d, s.n) for d, s in whole.daily()]
+
+    def test_log(self):
+        d = tempfile.mkdtemp()
+        try:
+            log = readinglog.ReadingLog(os.path.join(d, 'readings'))
+            cu = meter.synced(300)
+            log.ingest(cu)
+            a, b = analytics.Analytics(), analytics.Analytics()
+            a.add_log(log.to_numpy())
+            b.add_store(cu.result)
+            assert a.stats().n == b.stats().n
+            assert close(a.stats().mean, b.stats().mean)
+            log.close()
+        finally:
+            shutil.rmtree(d)
+
+    def test_units(self):
+        a = analytics.Analytics(utcoffset=3600)
+        a.add([0, 60, 120, store.NOTIME], [5.0, 90.0, 100.0, 80.0],
+              [analytics.MMOL, analytics.MGDL, analytics.MGDL,
+               analytics.MGDL])
+        assert a.stats().n == 3
+        assert close(a.stats().mean, 280 / 3.0)
+        assert a.hourly()[1].n == 3
+        assert a.time_in_range() == {'below': 0.0, 'in': 1.0, 'above': 0.0}
+
+    def test_empty(self):
+        a = analytics.Analytics()
+        a.add([], [])
+        assert a.time_in_range() is None
+        assert a.a1c() is None
+        assert a.daily() == []
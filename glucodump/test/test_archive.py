@@ -0,0 +1,72 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test the SQLite archive"
+
+from .. import archive
+from ..bench import meter
+
+class TestArchive(object):
+    def setup_method(self, method):
+        self.db = archive.Archive(':memory:')
+
+    def teardown_method(self, method):
+        self.db.close()
+
+    def test_ingest(self):
+        cu = meter.synced(10, serial='7390-1')
+        assert self.db.ingest(cu) == 10
+        assert len(self.db) == 10
+        readings = list(self.db.readings())
+        assert [r.recno for r in readings] == range(1, 11)
+        r, orig = readings[3], cu.result[4]
+        assert r.meter_serial == '7390-1'
+        assert (r.time, r.value, r.unit, r.flags, r.is_control) == \
+            (orig.time, orig.value, orig.unit, orig.flags, orig.is_control)
+        assert r.resultflags == orig.resultflags
+        assert r.asdict()['meter_serial'] == '7390-1'
+
+    def test_dedup(self):
+        self.db.ingest(meter.synced(10, serial='7390-1'))
+        assert self.db.ingest(meter.synced(12, serial='7390-1')) == 2
+        assert self.db.ingest(meter.synced(12, serial='7390-2')) == 12
+        assert len(self.db) == 24
+        assert self.db.serials() == ['7390-1', '7390-2']
+
+    def test_no_reading(self):
+        # an O record whose R never came is not a reading
+        cu = meter.synced(3, serial='7390-1')
+        cu.record('O|4||||||||||Q')
+        cu.flush()
+        assert 4 in cu.result
+        assert self.db.ingest(cu) == 3
+        assert [r.recno for r in self.db.readings()] == [1, 2, 3]
+
+    def test_window(self):
+        self.db.ingest(meter.synced(30, serial='7390-1'))
+        self.db.ingest(meter.synced(30, serial='7390-2'))
+        cu = meter.synced(30, serial='7390-1')
+        start, end = cu.result[5].time, cu.result[9].time
+        got = list(self.db.readings('7390-1', start, end))
+        assert [r.recno for r in got] == [5, 6, 7, 8]
+        assert len(list(self.db.readings(start=start, end=end))) == 8
+        assert len(list(self.db.readings('7390-2', start=cu.result[29].time))) == 2
+
+    def test_newest(self):
+        assert self.db.newest('7390-1') is None
+        cu = meter.synced(7, serial='7390-1')
+        self.db.ingest(cu)
+        assert self.db.newest('7390-1') == (7, cu.result[7].time)
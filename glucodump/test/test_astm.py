@@ -0,0 +1,101 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test the ASTM record decoder"
+
+from .. import astm, contourusb, store
+from ..bench import meter
+
+HEADER = 'H|\\^&||uvmjq4|Bayer7390^01.20\\01.04\\04.02.19^7390-1163170' \
+    '^7396-|A=1^C=63^G=1^I=0200^R=0^S=1^U=1^V=10600^X=07007007009' \
+    '9180135180248^Y=360126090050099050300089^Z=1|209||||||1|2011' \
+    '02142249'
+
+class TestDecoder(object):
+    def test_header(self):
+        h = astm.Decoder().decode(HEADER)
+        assert isinstance(h, astm.HeaderRecord)
+        assert h.password == 'uvmjq4'
+        assert h.product == 'Bayer7390'
+        assert h.versions == ['01.20', '01.04', '04.02.19']
+        assert h.serial == '7390-1163170'
+        assert h.sku == '7396-'
+        assert h.device_info['V'] == '10600'
+        assert h.result_count == 209
+        assert h.processing_id == ''
+        assert h.spec_version == '1'
+        assert h.datetime == '201102142249'
+        assert h.time == store.parsetime('201102142249')
+
+    def test_result(self):
+        r = astm.Decoder().decode('R|8|^^^Glucose|5.5|mmol/L^P||A/Z2||'
+                                  '201012142048')
+        assert r._fields is None
+        assert r.value == 5.5
+        assert r._fields is not None
+        assert r.recno == 8
+        assert r.meastype == 'Glucose'
+        assert (r.unit, r.reference) == ('mmol/L', 'P')
+        assert r.flagcodes == ['A', 'Z2']
+        assert r.flags == store.flagbits(['A', 'Z2'])
+        assert r.time == store.parsetime('201012142048')
+
+    def test_types(self):
+        d = astm.Decoder()
+        texts = ['P|1', 'O|1||||||||||Q', 'C|1|I|low battery|G', 'M|1|x',
+                 'Q|1|ALL', 'S|1', 'L|1||N', 'X|1']
+        records = [d.decode(t) for t in texts]
+        assert [type(r) for r in records] == [
+            astm.PatientRecord, astm.OrderRecord, astm.CommentRecord,
+            astm.ManufacturerRecord, astm.RequestRecord,
+            astm.ScientificRecord, astm.TerminatorRecord, astm.Record]
+        assert records[1].is_control
+        assert records[2].comment == 'low battery'
+        assert records[4].start == 'ALL'
+        assert records[6].code == 'N'
+        assert records[7].field(1) == '1'
+        assert records[7].field(5) == ''
+
+    def test_separators(self):
+        d = astm.Decoder()
+        recs = list(d.records(['H!@#$%!!pw!P#1@2#S#K',
+                               'R!1!###Glucose!90!mg/dL#B!!!!201012142048'],
+                              types='R'))
+        assert d.seps.field == '!'
+        assert d.seps.component == '#'
+        assert recs[0].value == 90.0
+        assert recs[0].unit == 'mg/dL'
+        assert recs[0].meastype == 'Glucose'
+        h = d.decode('H!@#$%!!pw!P#1@2#S#K')
+        assert h.serial == 'S' and h.versions == ['1', '2']
+
+    def test_stream(self):
+        recs = meter.records(50)
+        results = list(astm.Decoder().records(recs, types='R'))
+        cu = contourusb.ContourUSB()
+        for text in recs:
+            cu.record(text)
+        assert [(r.time, r.value) for r in results] == \
+            [(r.time, r.value) for r in cu.result.values()]
+
+class TestContourUSBDispatch(object):
+    def test_unknown(self):
+        cu = contourusb.ContourUSB()
+        for text in ['C|1|I|comment|G', 'M|1|x', 'S|1', 'X|what']:
+            cu.record(text)
+        cu.record('R|1|^^^Glucose|5.5|mmol/L^P||||201012142048')
+        cu.flush()
+        assert cu.result.keys() == [1]
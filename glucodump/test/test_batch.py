@@ -0,0 +1,109 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test the batch decoder"
+
+import os
+import shutil
+import tempfile
+from .. import batch, store
+from ..bench import meter
+
+class TestBatch(object):
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, 'site'))
+        for i in range(3):
+            path = os.path.join(self.dir, 'site', 'meter%d.cap' % i)
+            with open(path, 'wb') as f:
+                meter.write_capture(f, meter.records(10 + i,
+                                                     serial='7390-%d' % i))
+        with open(os.path.join(self.dir, 'raw.log'), 'wb') as f:
+            f.write('\x04\x05' + ''.join(
+                meter.frames(meter.records(25, serial='7390-9'))) + '\x04')
+        with open(os.path.join(self.dir, 'junk'), 'wb') as f:
+            f.write('\x021R|x\r\x1700\r\n')
+        with open(os.path.join(self.dir, 'bad'), 'wb') as f:
+            f.write(''.join(meter.frames(['R|x'])))
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.dir)
+
+    def test_paths(self):
+        files = list(batch.paths([self.dir]))
+        assert [os.path.basename(p) for p in files] == [
+            'bad', 'junk', 'raw.log', 'meter0.cap', 'meter1.cap', 'meter2.cap']
+
+    def test_decode_path(self):
+        path = os.path.join(self.dir, 'raw.log')
+        chunks = list(batch.decode_path(path, chunksize=10))
+        assert [len(c) for c in chunks] == [10, 10, 5]
+        assert set(c.serial for c in chunks) == set(['7390-9'])
+        results = chunks[1].store()
+        assert results.keys() == range(11, 21)
+        assert results[11].unit == 'mg/dL'
+        assert results[11].resultflags is not None
+
+    def test_errors(self):
+        chunks = list(batch.decode_path(os.path.join(self.dir, 'junk')))
+        assert chunks[0].error is None
+        assert len(chunks[0]) == 0
+        assert chunks[0].errors == [(0, 'Checksum error')]
+        chunks = list(batch.decode_path(os.path.join(self.dir, 'bad')))
+        assert chunks[0].error.startswith('ValueError')
+        chunks = list(batch.decode_path(os.path.join(self.dir, 'missing')))
+        assert chunks[0].error.startswith('IOError')
+
+    def test_decode_files(self):
+        chunks = list(batch.decode_files(batch.paths([self.dir]),
+                                         processes=2))
+        bypath = dict((os.path.basename(c.path), c) for c in chunks)
+        assert sorted(bypath) == ['bad', 'junk', 'meter0.cap', 'meter1.cap',
+                                  'meter2.cap', 'raw.log']
+        assert bypath['bad'].error is not None
+        assert bypath['junk'].errors
+        assert len(bypath['meter2.cap']) == 12
+        assert bypath['meter2.cap'].serial == '7390-2'
+        assert len(bypath['raw.log']) == 25
+
+    def test_chunks_in_order(self):
+        path = os.path.join(self.dir, 'raw.log')
+        chunks = list(batch.decode_files([path, path], processes=2,
+                                         chunksize=10))
+        assert sorted(len(c) for c in chunks) == [5, 5, 10, 10, 10, 10]
+        recnos = [c.store().keys()[0] for c in chunks]
+        assert sorted(recnos) == [1, 1, 11, 11, 21, 21]
+        assert recnos.index(21) > recnos.index(11) > recnos.index(1)
+
+    def test_decode_path_lazy(self):
+        # the first chunk is out before the rest of the file is decoded
+        path = os.path.join(self.dir, 'raw.log')
+        chunks = batch.decode_path(path, chunksize=10)
+        assert len(chunks.next()) == 10
+        chunks.close()
+
+class TestFromStrings(object):
+    def test_unsorted(self):
+        s = store.ResultStore()
+        for recno in (3, 1, 2):
+            s.append(recno, value=recno, unit='mmol/L')
+        cols = dict((name, getattr(s, name).tostring())
+                    for name, typecode in s.columns)
+        t = store.ResultStore.fromstrings(cols, s.units.names,
+                                          s.meastypes.names)
+        assert t.keys() == [3, 1, 2]
+        assert t[1].value == 1
+        assert t[2].unit == 'mmol/L'
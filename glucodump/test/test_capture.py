@@ -0,0 +1,80 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test capture and replay"
+
+import StringIO
+from .. import capture, contourusb
+from ..bench import meter
+
+class TestCapture(object):
+    def test_roundtrip(self):
+        f = StringIO.StringIO()
+        w = capture.CaptureWriter(f)
+        w.report(capture.WRITE, '\0\0\0\x01\x04', 1.5)
+        w.report(capture.READ, 'ABC\x02\x04\x05' + '\0' * 58, 1.75)
+        w.close()
+
+        r = capture.CaptureReader(StringIO.StringIO(f.getvalue()))
+        assert list(r) == [(1.5, capture.WRITE, '\0\0\0\x01\x04'),
+                           (1.75, capture.READ, 'ABC\x02\x04\x05' + '\0' * 58)]
+
+    def test_badmagic(self):
+        try:
+            capture.CaptureReader(StringIO.StringIO('garbage'))
+        except capture.CaptureError:
+            pass
+        else:
+            assert False, 'expected CaptureError'
+
+    def test_messages(self):
+        f = StringIO.StringIO()
+        w = capture.CaptureWriter(f)
+        w.report(capture.WRITE, '\0\0\0\x01\x04', 1.0)
+        for i, report in enumerate(meter.reports('x' * 130)):
+            w.report(capture.READ, report, 1.25 + i)
+        w.close()
+
+        msgs = capture.ReplayDevice.messages(StringIO.StringIO(f.getvalue()))
+        assert msgs == [(0.25, 'x' * 130)]
+
+    def test_replay_sync(self):
+        f = StringIO.StringIO()
+        recs = meter.records(20)
+        meter.write_capture(f, recs)
+
+        dev = capture.ReplayDevice(StringIO.StringIO(f.getvalue()))
+        bc = contourusb.BayerCOMM(dev)
+        assert list(bc.sync()) == recs
+        assert dev.written == ['\x04'] + ['\x06'] * (len(recs) + 1)
+
+        try:
+            dev.read()
+        except capture.ReplayExhausted:
+            pass
+        else:
+            assert False, 'expected ReplayExhausted'
+
+    def test_realtime(self):
+        f = StringIO.StringIO()
+        meter.write_capture(f, meter.records(1), latency=0.5)
+        slept = []
+        dev = capture.ReplayDevice(StringIO.StringIO(f.getvalue()),
+                                   realtime=True, sleep=slept.append,
+                                   clock=lambda: 100.0)
+        dev.write('\x04')
+        assert dev.read() == '\x04\x05'
+        assert slept == [0.5]
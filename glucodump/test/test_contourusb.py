@@ -16,8 +16,12 @@
 
 "test contour usb interface"
 
+import errno
+import threading
+import time
 import StringIO
-from .. import contourusb
+from .. import contourusb, loop, store, tracing
+from ..bench import meter
 
 class FakeMeter(object):
     def __init__(self, read=[], write=None):
@@ -26,7 +30,7 @@ class FakeMeter(object):
             write = []
         self._write = write
 
-    def read(self):
+    def read(self, timeout=None):
         return self._read.pop(0)
 
     def write(self, data):
@@ -147,7 +151,243 @@ class TestBayerCOMM(object):
 
         res = bc.command('M|')
         assert res == 'D|0|\r\n'
+
+    def test_commands(self):
+        f = FakeMeter(read=['\x04', '\x06', '\x15', 'D|0|\r\n\x06', '\x06'])
+        bc = contourusb.BayerCOMM(f)
+
+        res = bc.commands(['R|', 'M|', 'W|'])
+        assert res == [None, 'D|0|\r\n', '']
+        assert f._write == ['\x15', '\x05', 'R|', 'M|', 'W|']
         
+class TestBayerProtocol(object):
+    def test_receive(self):
+        bp = contourusb.BayerProtocol()
+        assert bp.initiate() == '\x04'
+        assert bp.receive('\x15') == ('\x00', None)
+        assert bp.receive('\x15') == ('\x01', None)
+        assert bp.receive('\x04\x05') == ('\x06', None)
+        assert bp.state == bp.mode_establish
+
+        assert bp.receive('\x021G\r\x179C\r\n') == ('\x06', 'G')
+        assert bp.state == bp.mode_data
+        # retransmission of the same frame is ACKed but not returned
+        assert bp.receive('\x021G\r\x179C\r\n') == ('\x06', None)
+        assert bp.receive('\x022F\r\x1700\r\n') == ('\x15', None)
+        assert bp.receive('garbage') == ('\x15', None)
+        assert bp.receive('\x04') == (None, None)
+        assert bp.state == bp.mode_precommand
+
+class TestPipelinedSync(object):
+    def transfer(self, results):
+        return meter.replay(meter.records(results))
+
+    def test_sync(self):
+        dev = self.transfer(20)
+        plain = list(contourusb.BayerCOMM(dev).sync())
+        dev.rewind()
+        frames = list(contourusb.BayerCOMM(dev).sync(pipeline=8))
+        assert frames == plain
+
+    def test_ahead(self):
+        # the link is done before the consumer has looked at a frame
+        dev = self.transfer(20)
+        n = len(list(contourusb.BayerCOMM(dev).sync()))
+        writes = len(dev.written)
+        dev.rewind()
+        frames = contourusb.BayerCOMM(dev).sync(pipeline=100)
+        first = frames.next()
+        for i in range(500):
+            if len(dev.written) == writes:
+                break
+            time.sleep(0.01)
+        assert len(dev.written) == writes
+        assert len([first] + list(frames)) == n
+
+    def test_bounded(self):
+        dev = self.transfer(20)
+        frames = contourusb.BayerCOMM(dev).sync(pipeline=2)
+        frames.next()
+        time.sleep(0.1)
+        # one handed over, two queued and one waiting to be queued
+        assert len(dev.written) <= 6
+        frames.close()
+
+    def test_abandoned(self):
+        dev = self.transfer(20)
+        threads = threading.active_count()
+        bc = contourusb.BayerCOMM(dev)
+        frames = bc.sync(pipeline=2)
+        frames.next()
+        frames.close()
+        # the link was ended with <EOT> and read to its end
+        assert bc.interrupted
+        assert dev.written[-1] == '\x04'
+        assert bc.state == bc.mode_precommand
+        assert threading.active_count() == threads
+
+    def test_error(self):
+        f = FakeMeter(read=['\x04\x05'])
+        frames = contourusb.BayerCOMM(f).sync(pipeline=2)
+        try:
+            list(frames)
+        except IndexError:
+            pass
+        else:
+            assert False, 'expected the IndexError of the producer'
+
+class Timeout(IOError):
+    def __init__(self):
+        IOError.__init__(self, errno.ETIMEDOUT, 'timed out')
+
+class SleepyMeter(object):
+    "NAKs (or, with a timeout, stays silent) until sent wakeup"
+    def __init__(self, wakeup, frames, silent=False):
+        self.wakeup = wakeup
+        self.frames = list(frames) + ['\x04']
+        self.silent = silent
+        self.awake = False
+        self.reads = 0
+        self._write = []
+
+    def read(self, timeout=None):
+        self.reads += 1
+        if self.awake:
+            return self.frames.pop(0)
+        if self._write[-1] == self.wakeup:
+            self.awake = True
+            return '\x05'
+        if self.silent and timeout is not None:
+            raise Timeout()
+        return '\x15'
+
+    def write(self, data):
+        self._write.append(data)
+
+class TestHandshake(object):
+    frames = ['\x021G\r\x179C\r\n']
+
+    def test_probe(self):
+        f = SleepyMeter('\x03', self.frames)
+        bc = contourusb.BayerCOMM(f)
+        assert list(bc.sync()) == ['G']
+        assert f._write[:5] == ['\x04', '\x00', '\x01', '\x02', '\x03']
+        assert bc.probes == 4
+        assert bc.wakeup_used == bc.wakeup == '\x03'
+        assert bc.handshake_time is not None
+        assert bc.first_frame_time >= bc.handshake_time
+
+    def test_wakeup(self):
+        f = SleepyMeter('\x42', self.frames)
+        bc = contourusb.BayerCOMM(f, wakeup='\x42')
+        assert list(bc.sync()) == ['G']
+        assert f._write[:2] == ['\x04', '\x42']
+        assert bc.probes == 1
+        # <EOT>, wakeup, then the frame and the final <EOT>
+        assert f.reads == 4
+
+    def test_remembered(self):
+        f = SleepyMeter('\x10', self.frames)
+        bc = contourusb.BayerCOMM(f)
+        list(bc.sync())
+        assert bc.probes == 17
+        f = SleepyMeter('\x10', self.frames)
+        bc.dev = f
+        bc.state = bc.mode_establish
+        list(bc.sync())
+        assert bc.probes == 1
+
+    def test_stale_wakeup(self):
+        # the remembered byte is tried first and not again
+        f = SleepyMeter('\x01', self.frames)
+        bc = contourusb.BayerCOMM(f, wakeup='\x00')
+        assert list(bc.sync()) == ['G']
+        assert f._write[:4] == ['\x04', '\x00', '\x01', '\x06']
+        assert bc.wakeup == '\x01'
+
+    def test_timeout(self):
+        f = SleepyMeter('\x02', self.frames, silent=True)
+        bc = contourusb.BayerCOMM(f, probe_timeout=50)
+        assert list(bc.sync()) == ['G']
+        assert bc.probes == 3
+
+    def test_error(self):
+        class Broken(SleepyMeter):
+            def read(self, timeout=None):
+                raise IOError(errno.EIO, 'gone')
+        bc = contourusb.BayerCOMM(Broken('\x00', []), probe_timeout=50)
+        try:
+            list(bc.sync())
+        except IOError, e:
+            assert e.errno == errno.EIO
+        else:
+            assert False, 'expected the IOError'
+
+    def test_traced(self):
+        f = SleepyMeter('\x01', self.frames)
+        trace = tracing.Tracer()
+        bc = contourusb.BayerCOMM(f, trace=trace)
+        assert list(bc.sync()) == ['G']
+        assert bc.probes == 2
+        assert bc.first_frame_time >= bc.handshake_time
+        s = trace.summary()['histograms']
+        assert s['sync.handshake']['count'] == 1
+        assert s['sync.first_frame']['count'] == 1
+
+    def test_replay(self):
+        dev = meter.replay(meter.records(5))
+        plain = list(contourusb.BayerCOMM(dev).sync())
+        dev.rewind()
+        bc = contourusb.BayerCOMM(dev, probe_timeout=50)
+        assert list(bc.sync()) == plain
+        assert bc.handshake_time is not None
+
+    def test_pipelined(self):
+        f = SleepyMeter('\x07', self.frames, silent=True)
+        bc = contourusb.BayerCOMM(f, wakeup='\x07', probe_timeout=50)
+        assert list(bc.sync(pipeline=4)) == ['G']
+        assert bc.probes == 1
+
+    def test_async(self):
+        l = loop.EventLoop()
+        f = SleepyMeter('\x02', self.frames, silent=True)
+        bc = contourusb.AsyncBayerCOMM(f, l, probe_timeout=50)
+        assert l.run_until_complete(bc.sync()) == ['G']
+        assert bc.probes == 3
+        f = SleepyMeter('\x02', self.frames, silent=True)
+        bc.dev = f
+        bc.state = bc.mode_establish
+        assert l.run_until_complete(bc.sync()) == ['G']
+        assert bc.probes == 1
+        l.close()
+
+class TestAsyncBayerCOMM(object):
+    dataread = [ '\x04\x05',
+                 '\x021G\r\x179C\r\n',
+                 '\x022F\r\x179C\r\n',
+                 '\x04'
+                 ]
+
+    def test_sync(self):
+        l = loop.EventLoop()
+        f = FakeMeter(read=list(self.dataread))
+        bc = contourusb.AsyncBayerCOMM(f, l)
+        results = l.run_until_complete(bc.sync())
+        l.close()
+        assert results == ['G', 'F']
+        assert f._write == ['\x04', '\x06', '\x06', '\x06']
+        assert bc.state == bc.mode_precommand
+
+    def test_callback(self):
+        l = loop.EventLoop()
+        meters = [FakeMeter(read=list(self.dataread)) for i in range(3)]
+        frames = []
+        tasks = [contourusb.AsyncBayerCOMM(f, l).sync(frames.append)
+                 for f in meters]
+        l.run_until_complete(loop.gather(l, *tasks))
+        l.close()
+        assert sorted(frames) == ['F', 'F', 'F', 'G', 'G', 'G']
+
 class TestContourUSB(object):
     def test_H(self):
         data = 'H|\\^&||uvmjq4|Bayer7390^01.20\\01.04\\04.02.19^7390-1163170'\
@@ -178,6 +418,19 @@ class TestContourUSB(object):
         assert cu.processing_id == ''
         assert cu.spec_version == '1'
         assert cu.header_datetime == '201102142249'
+        assert cu.header_time == store.parsetime('201102142249')
+        assert cu.clock_offset == 0
+
+    def test_clock_offset(self):
+        # meter clock 1h 2m 10s slow
+        now = store.parsetime('201102142249') + 3730
+        cu = contourusb.ContourUSB(clock=lambda: now)
+        cu.record('H|\\^&||uvmjq4|Bayer7390^01.20^7390-1^7396-|A=1|2||||||1|'
+                  '201102142249')
+        assert cu.clock_offset == 3720
+        cu.record('R|1|^^^Glucose|5.5|mmol/L^P||||201102142000')
+        assert cu.result[1].time == store.parsetime('201102142102')
+        assert cu.header()['clock_offset'] == 3720
                                    
     def test_P(self):
         cu = contourusb.ContourUSB()
@@ -217,3 +470,65 @@ class TestContourUSB(object):
         assert cu.results == False
         cu.record('L|1||N')
         assert cu.results == True
+
+    def test_iterresults(self):
+        records = ['H|\\^&||uvmjq4|Bayer7390^01.20\\01.04\\04.02.19^7390-1163170'
+                   '^7396-|A=1^C=63^G=1^I=0200^R=0^S=1^U=1^V=10600^X=07007007009'
+                   '9180135180248^Y=360126090050099050300089^Z=1|209||||||1|2011'
+                   '02142249',
+                   'P|1',
+                   'R|1|^^^Glucose|2.8|mmol/L^P||B||201012142048',
+                   'O|2||||||||||Q',
+                   'R|2|^^^Glucose|10.1|mmol/L^P||||201011131409',
+                   'R|3|^^^Glucose|11.5|mmol/L^P||A/Z1||201012272001',
+                   'O|3||||||||||Q',
+                   'L|1||N']
+        seen = []
+        cu = contourusb.ContourUSB(keep=False)
+        for res in cu.iterresults(iter(records)):
+            seen.append((res.recno, res.is_control))
+            # completed as soon as the following record is parsed
+            assert len(seen) == res.recno
+
+        assert seen == [(1, False), (2, True), (3, True)]
+        assert len(cu.result) == 0
+        assert cu.results
+
+    def test_on_result(self):
+        seen = []
+        cu = contourusb.ContourUSB(on_result=seen.append)
+        cu.record('R|1|^^^Glucose|2.8|mmol/L^P||B||201012142048')
+        assert seen == []
+        cu.record('R|2|^^^Glucose|10.1|mmol/L^P||||201011131409')
+        assert [r.recno for r in seen] == [1]
+        assert cu.result[2].value == 10.1
+        assert [r.recno for r in seen] == [1]
+        cu.flush()
+        assert cu.result[2].value == 10.1
+        assert [r.recno for r in seen] == [1, 2]
+
+    def test_separators(self):
+        # the separators of the H record apply to the records after it
+        cu = contourusb.ContourUSB()
+        cu.record('H!\\~&!!pw!Bayer7390~01.20~7390-1~7396-!A=1!5!!!!!!1!'
+                  '201102142249')
+        assert cu.comp_sep == '~'
+        assert cu.meter_serial == '7390-1'
+        cu.record('R!1!~~~Glucose!5.5!mmol/L~P!!B!!201012142048')
+        assert cu.result[1].unit == 'mmol/L'
+        assert cu.result[1].method == 'plasma'
+
+    def test_result_mid_stream(self):
+        # looking at result does not complete the result in flight
+        seen = []
+        cu = contourusb.ContourUSB(on_result=seen.append)
+        cu.record('R|3|^^^Glucose|50|mg/dL^P||||201012142048')
+        assert cu.result[3].value == 50 and cu.result.keys() == [3]
+        assert seen == []
+        cu.record('O|3||||||||||Q')
+        cu.record('L|1||N')
+        assert len(seen) == 1
+        assert seen[0].is_control
+        assert cu.result[3].is_control and len(cu.result) == 1
+        assert seen[0].testtime == '201012142048'
+        assert seen[0].method == 'plasma'
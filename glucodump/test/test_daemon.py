@@ -0,0 +1,197 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test the device daemon"
+
+import json
+import os
+import socket
+import StringIO
+import tempfile
+import threading
+from .. import daemon, loop, capture
+from ..bench import meter
+
+class FakeDev(object):
+    def __init__(self, bus, address, serial, results):
+        self.bus = bus
+        self.address = address
+        self.capture = meter.capture_data(meter.records(results,
+                                                        serial=serial))
+
+def opener(dev):
+    return capture.ReplayDevice(StringIO.StringIO(dev.capture))
+
+def run_until(l, cond, limit=500):
+    for i in range(limit):
+        if cond():
+            return
+        l.call_later(0.01, lambda: None)
+        l._run_once()
+    raise AssertionError('condition never became true')
+
+class Client(object):
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.sock.setblocking(0)
+        self.data = ''
+
+    def send(self, msg):
+        self.sock.sendall(json.dumps(msg) + '\n')
+
+    def poll(self):
+        try:
+            self.data += self.sock.recv(65536)
+        except socket.error:
+            pass
+        return self.data
+
+    def replies(self):
+        return [json.loads(line) for line in self.data.splitlines()]
+
+class TestDaemon(object):
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'sock')
+        self.devices = [FakeDev(1, 2, '7390-1', 5)]
+        self.loop = loop.EventLoop()
+        self.d = daemon.Daemon(self.path, self.loop, scan=0.05,
+                               finder=lambda: self.devices, opener=opener)
+        self.d.start()
+        run_until(self.loop, lambda: self.d.meters)
+
+    def teardown_method(self, method):
+        self.d.stop()
+        self.loop.close()
+        os.rmdir(self.dir)
+
+    def test_hotplug(self):
+        assert self.d.meters.keys() == ['1:2']
+        opened = self.d.meters['1:2']
+        self.devices = self.devices + [FakeDev(1, 3, '7390-2', 3)]
+        run_until(self.loop, lambda: len(self.d.meters) == 2)
+        assert self.d.meters['1:2'] is opened
+        self.devices = self.devices[1:]
+        run_until(self.loop, lambda: len(self.d.meters) == 1)
+        assert self.d.meters.keys() == ['1:3']
+
+    def test_removed_while_busy(self):
+        meter = self.d.meters['1:2']
+        closed = []
+        meter.comm.close = lambda: closed.append(True)
+        meter.lock.acquire()
+        self.devices = []
+        # the loop keeps running while the sync holds the meter
+        run_until(self.loop, lambda: not self.d.meters)
+        assert not closed
+        meter.lock.release()
+        run_until(self.loop, lambda: closed)
+
+    def test_stop_while_busy(self):
+        meter = self.d.meters['1:2']
+        closed = []
+        meter.comm.close = lambda: closed.append(True)
+        meter.lock.acquire()
+        self.d.stop()
+        assert not self.d.meters and not closed
+        meter.lock.release()
+        run_until(self.loop, lambda: closed)
+        self.d.start()
+
+    def test_open_off_loop(self):
+        opened = threading.Event()
+        def slow(dev):
+            opened.wait(5)
+            return opener(dev)
+        self.d.opener = slow
+        self.devices = self.devices + [FakeDev(1, 3, '7390-2', 3)]
+        run_until(self.loop, lambda: self.d._opening)
+        assert len(self.d.meters) == 1
+        opened.set()
+        run_until(self.loop, lambda: len(self.d.meters) == 2)
+
+    def test_private_dir(self):
+        rundir = os.path.join(self.dir, 'run')
+        daemon._privatedir(rundir)
+        assert os.stat(rundir).st_mode & 0777 == 0700
+        daemon._privatedir(rundir)
+        os.chmod(rundir, 0755)
+        link = os.path.join(self.dir, 'link')
+        os.symlink(rundir, link)
+        try:
+            for path in (rundir, link):
+                try:
+                    daemon._privatedir(path)
+                except daemon.DaemonError:
+                    pass
+                else:
+                    assert False, 'expected DaemonError for %s' % path
+        finally:
+            os.unlink(link)
+            os.rmdir(rundir)
+
+    def test_socket(self):
+        assert os.stat(self.path).st_mode & 0777 == 0600
+        other = daemon.Daemon(self.path, self.loop,
+                              finder=lambda: [], opener=opener)
+        try:
+            other.start()
+        except daemon.DaemonError:
+            pass
+        else:
+            assert False, 'expected DaemonError'
+        assert os.path.exists(self.path)
+        Client(self.path)
+
+    def test_stale_socket(self):
+        self.d.stop()
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        self.d.start()
+        Client(self.path)
+
+    def test_list(self):
+        c = Client(self.path)
+        c.send({'op': 'list'})
+        run_until(self.loop, lambda: c.poll().endswith('\n'))
+        assert c.replies() == [{'type': 'meters',
+                                'meters': [{'id': '1:2', 'serial': None}]}]
+
+    def test_sync(self):
+        c = Client(self.path)
+        c.send({'op': 'sync', 'meter': '1:2'})
+        run_until(self.loop, lambda: '"end"' in c.poll())
+        replies = c.replies()
+        assert replies[0]['type'] == 'header'
+        assert replies[0]['meter_serial'] == '7390-1'
+        assert [r['type'] for r in replies[1:]] == ['result'] * 5 + ['end']
+        assert self.d.find('7390-1') is self.d.meters['1:2']
+
+        # the meter stays open between requests
+        self.d.meters['1:2'].comm.rewind()
+        c.data = ''
+        c.send({'op': 'sync', 'meter': '7390-1'})
+        run_until(self.loop, lambda: '"end"' in c.poll())
+        assert len(c.replies()) == 7
+
+    def test_errors(self):
+        c = Client(self.path)
+        c.send({'op': 'sync', 'meter': 'nope'})
+        c.send({'op': 'frobnicate', 'meter': '1:2'})
+        run_until(self.loop, lambda: c.poll().count('\n') == 2)
+        assert [r['type'] for r in c.replies()] == ['error', 'error']
@@ -0,0 +1,87 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test offline frame decoding"
+
+import StringIO
+from .. import decode, contourusb
+from ..bench import meter
+
+class TestFrameDecoder(object):
+    recs = meter.records(30)
+    log = '\x04\x05' + ''.join(meter.frames(recs)) + '\x04'
+
+    def test_decode(self):
+        assert decode.decode(self.log) == self.recs
+
+    def test_nonumpy(self):
+        numpy, decode.numpy = decode.numpy, None
+        try:
+            assert decode.decode(self.log) == self.recs
+        finally:
+            decode.numpy = numpy
+
+    def test_split(self):
+        for size in (1, 7, 64, 1000):
+            chunks = [self.log[i:i+size] for i in range(0, len(self.log), size)]
+            fd = decode.FrameDecoder(strict=True)
+            assert list(fd.decode(chunks)) == self.recs
+            assert fd.offset == len(self.log)
+
+    def test_checksum_error(self):
+        frames = meter.frames(self.recs[:3])
+        bad = frames[1][:-4] + '00\r\n'
+        log = frames[0] + bad + frames[1] + frames[1] + frames[2]
+        fd = decode.FrameDecoder()
+        assert fd.feed(log) == self.recs[:3]
+        assert fd.errors == [(len(frames[0]), "Checksum error")]
+
+    def test_gap(self):
+        frames = meter.frames(self.recs[:3])
+        fd = decode.FrameDecoder()
+        assert fd.feed(frames[0] + frames[2]) == [self.recs[0], self.recs[2]]
+        assert len(fd.errors) == 1
+
+        try:
+            decode.decode(frames[0] + frames[2], strict=True)
+        except contourusb.FrameError:
+            pass
+        else:
+            assert False, 'expected FrameError'
+
+    def test_transfers(self):
+        assert decode.decode(self.log + self.log, strict=True) == \
+            self.recs + self.recs
+
+    def test_capture(self):
+        f = StringIO.StringIO()
+        meter.write_capture(f, self.recs)
+        f.seek(0)
+        assert decode.decode_capture(f) == self.recs
+
+    def test_file(self, tmpdir):
+        path = tmpdir.join('log')
+        path.write(self.log, 'wb')
+        assert list(decode.decode_file(str(path), chunksize=100)) == self.recs
+        f = StringIO.StringIO(self.log)
+        assert list(decode.decode_file(f)) == self.recs
+        assert not f.closed
+
+    def test_checksum(self):
+        bp = contourusb.BayerProtocol()
+        assert bp.checksum('1R|67|^^^Glucose|7.9|mmol/L^P||B||201011281949'
+                           '\r\x17') == '04'
+        assert bp.checksum('\x01') == '01'
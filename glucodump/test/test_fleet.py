@@ -0,0 +1,62 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test syncing several meters"
+
+import StringIO
+from .. import fleet, capture, tracing
+from ..bench import meter
+
+def transfer(serial, results):
+    return StringIO.StringIO(meter.capture_data(meter.records(results,
+                                                              serial=serial)))
+
+def replay(f, trace=None):
+    return capture.ReplayDevice(f)
+
+class TestFleet(object):
+    def test_sync(self):
+        devices = [transfer('7390-%d' % i, 10 + i) for i in range(4)]
+        f = fleet.Fleet(devices, opener=replay)
+        meters = f.sync()
+        assert sorted(meters) == ['7390-0', '7390-1', '7390-2', '7390-3']
+        assert len(meters['7390-2'].result) == 12
+        assert f.errors == []
+
+    def test_errors(self):
+        bad = StringIO.StringIO('not a capture')
+        devices = [transfer('7390-1', 5), bad]
+        f = fleet.Fleet(devices, opener=replay, workers=1)
+        meters = f.sync()
+        assert meters.keys() == ['7390-1']
+        assert [dev for dev, exc in f.errors] == [bad]
+
+    def test_merge(self):
+        devices = [transfer('7390-1', 5), transfer('7390-1', 8)]
+        meters = fleet.Fleet(devices, opener=replay).sync()
+        assert len(meters['7390-1'].result) == 8
+
+    def test_trace(self):
+        traces = []
+        def opener(f, trace=None):
+            traces.append(trace)
+            return capture.ReplayDevice(f)
+        t = tracing.Tracer()
+        fleet.Fleet([transfer('7390-1', 5)], opener=opener, trace=t).sync()
+        assert traces == [t]
+
+    def test_empty(self):
+        assert fleet.Fleet([]).sync() == {}
@@ -0,0 +1,185 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test incremental sync"
+
+import os
+import tempfile
+from .. import incremental, contourusb, store
+from ..bench import meter
+
+class TalkingMeter(object):
+    """
+    Answers the host like a meter, honouring receiver interrupts
+
+    newest_first sends the results in reverse, as some meters do.
+    """
+    def __init__(self, recs, newest_first=False):
+        if newest_first:
+            head, body, tail = recs[:2], recs[2:-1], recs[-1:]
+            recs = head + meter_reversed(body) + tail
+        self.frames = meter.frames(recs)
+        self.sent = 0
+        self.reply = None
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+        if self.reply is None:
+            self.reply = '\x04\x05'
+        elif data == '\x06' and self.sent < len(self.frames):
+            self.reply = self.frames[self.sent]
+            self.sent += 1
+        else:
+            self.reply = '\x04'
+
+    def read(self, timeout=None):
+        return self.reply
+
+    def close(self):
+        pass
+
+def meter_reversed(body):
+    "Reverse the results, keeping each O record before its R"
+    results = []
+    for text in body:
+        if text.startswith('O') or not results or \
+                results[-1][-1].startswith('R'):
+            results.append([text])
+        else:
+            results[-1].append(text)
+    return [text for result in reversed(results) for text in result]
+
+class TestIncremental(object):
+    def test_first_sync(self):
+        state = incremental.SyncState()
+        cu = incremental.sync(TalkingMeter(meter.records(20)), state)
+        assert len(cu.result) == 20
+        assert cu.skipped == 0
+        assert state.get('7390-1163170') == (20, cu.result[20].time)
+
+    def test_oldest_first(self):
+        state = incremental.SyncState()
+        incremental.sync(TalkingMeter(meter.records(20)), state)
+        dev = TalkingMeter(meter.records(23))
+        cu = incremental.sync(dev, state)
+        assert cu.result.keys() == [21, 22, 23]
+        assert cu.skipped == 20
+        assert not cu.caught_up
+        assert state.get('7390-1163170')[0] == 23
+
+    def test_oldest_first_nothing_new(self):
+        state = incremental.SyncState()
+        incremental.sync(TalkingMeter(meter.records(20)), state)
+        dev = TalkingMeter(meter.records(20))
+        cu = incremental.sync(dev, state)
+        assert len(cu.result) == 0
+        assert cu.newest_first is False
+        assert cu.caught_up
+        assert dev.written[-1] == '\x04'
+
+    def test_newest_first_known(self):
+        # the first R is known, and shows the order by itself
+        recs = meter.records(20)
+        mark = (20, store.parsetime(recs[-2][-12:]))
+        cu = contourusb.ContourUSB(known={'7390-1163170': mark})
+        recs = recs[:2] + meter_reversed(recs[2:-1]) + recs[-1:]
+        for text in recs[:3]:
+            cu.record(text)
+        assert cu.newest_first
+        assert cu.caught_up
+
+    def test_clock_offset(self):
+        # the mark is in meter time, so a new offset changes nothing
+        recs = meter.records(5)
+        now = store.parsetime(recs[0].split('|')[-1])
+        cu = contourusb.ContourUSB(clock=lambda: now + 3600)
+        for text in recs:
+            cu.record(text)
+        cu.flush()
+        assert cu.newest == (5, store.parsetime(recs[-2][-12:]))
+        known = {'7390-1163170': cu.newest}
+        cu = contourusb.ContourUSB(known=known, clock=lambda: now - 7200)
+        for text in recs:
+            cu.record(text)
+        cu.flush()
+        assert len(cu.result) == 0
+        assert cu.skipped == 5
+
+    def test_newest_first(self):
+        state = incremental.SyncState()
+        incremental.sync(TalkingMeter(meter.records(20)), state)
+        dev = TalkingMeter(meter.records(23), newest_first=True)
+        cu = incremental.sync(dev, state)
+        assert sorted(cu.result.keys()) == [21, 22, 23]
+        assert cu.caught_up
+        # header, patient, three new, one known, then the interrupt
+        assert dev.sent < 10
+        assert dev.written[-1] == '\x04'
+        assert state.get('7390-1163170')[0] == 23
+
+    def test_nothing_new(self):
+        state = incremental.SyncState()
+        incremental.sync(TalkingMeter(meter.records(20)), state)
+        dev = TalkingMeter(meter.records(20), newest_first=True)
+        cu = incremental.sync(dev, state)
+        assert len(cu.result) == 0
+        assert dev.sent == 4
+
+    def test_memory_cleared(self):
+        # recnos start over, but the results are newer
+        state = incremental.SyncState()
+        state.marks['7390-1163170'] = (500, store.parsetime('201012010000'))
+        cu = incremental.sync(TalkingMeter(meter.records(5)), state)
+        assert len(cu.result) == 5
+        assert state.get('7390-1163170')[0] == 5
+
+    def test_control_skipped(self):
+        recs = meter.records(3)
+        recs.insert(2, 'O|1||||||||||Q')
+        state = incremental.SyncState()
+        state.marks['7390-1163170'] = (1, store.parsetime(recs[3][-12:]))
+        cu = incremental.sync(TalkingMeter(recs), state)
+        assert cu.result.keys() == [2, 3]
+
+    def test_control_after_skipped(self):
+        # an O record may also follow its R
+        recs = meter.records(3)
+        recs.insert(3, 'O|1||||||||||Q')
+        state = incremental.SyncState()
+        state.marks['7390-1163170'] = (1, store.parsetime(recs[2][-12:]))
+        cu = incremental.sync(TalkingMeter(recs), state)
+        assert cu.result.keys() == [2, 3]
+        assert not cu.result[2].is_control
+
+    def test_save(self):
+        path = os.path.join(tempfile.mkdtemp(), 'state.json')
+        state = incremental.SyncState(path)
+        incremental.sync(TalkingMeter(meter.records(4)), state)
+        state.save()
+        assert incremental.SyncState(path).marks == state.marks
+        os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+
+    def test_protocol_interrupt(self):
+        bc = contourusb.BayerProtocol()
+        frames = meter.frames(['P|1', 'L|1||N'])
+        bc.initiate()
+        assert bc.receive('\x04\x05') == ('\x06', None)
+        assert bc.receive(frames[0]) == ('\x06', 'P|1')
+        bc.interrupt()
+        assert bc.receive(frames[1]) == ('\x04', None)
+        assert bc.receive('\x04') == (None, None)
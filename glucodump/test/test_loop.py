@@ -0,0 +1,127 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test the event loop"
+
+import socket
+import threading
+from .. import loop
+
+class TestEventLoop(object):
+    def setup_method(self, method):
+        self.loop = loop.EventLoop()
+
+    def teardown_method(self, method):
+        self.loop.close()
+
+    def test_call_soon(self):
+        called = []
+        self.loop.call_soon(called.append, 1)
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+        assert called == [1]
+
+    def test_call_later(self):
+        called = []
+        self.loop.call_later(0.02, called.append, 2)
+        self.loop.call_later(0.01, called.append, 1)
+        t = self.loop.call_later(0.01, called.append, 3)
+        self.loop.cancel_timer(t)
+        self.loop.call_later(0.03, self.loop.stop)
+        self.loop.run_forever()
+        assert called == [1, 2]
+
+    def test_task(self):
+        def double(x):
+            return 2 * x
+
+        def task():
+            a = yield self.loop.run_in_executor(double, 2)
+            b = yield self.loop.run_in_executor(double, a)
+            raise loop.Return(b)
+
+        assert self.loop.run_until_complete(task()) == 8
+
+    def test_task_exception(self):
+        def fail():
+            raise ValueError('boom')
+
+        def task():
+            try:
+                yield self.loop.run_in_executor(fail)
+            except ValueError, e:
+                raise loop.Return(str(e))
+
+        assert self.loop.run_until_complete(task()) == 'boom'
+
+    def test_threadsafe(self):
+        fut = loop.Future(self.loop)
+        t = threading.Thread(target=self.loop.call_soon_threadsafe,
+                             args=(fut.set_result, 42))
+        t.start()
+        assert self.loop.run_until_complete(fut) == 42
+        t.join()
+
+    def test_reader_writer(self):
+        a, b = socket.socketpair()
+        received = []
+
+        def readable():
+            received.append(b.recv(100))
+            self.loop.remove_reader(b)
+            self.loop.stop()
+
+        def writable():
+            a.send('hello')
+            self.loop.remove_writer(a)
+
+        self.loop.add_reader(b, readable)
+        self.loop.add_writer(a, writable)
+        self.loop.run_forever()
+        a.close()
+        b.close()
+        assert received == ['hello']
+
+    def test_gather(self):
+        futs = [loop.Future(self.loop) for i in range(3)]
+        for i, f in enumerate(futs):
+            self.loop.call_later(0.001 * (3 - i), f.set_result, i)
+        result = self.loop.run_until_complete(loop.gather(self.loop, *futs))
+        assert result == [0, 1, 2]
+
+    def test_reuse_workers(self):
+        def task():
+            for i in range(5):
+                yield self.loop.run_in_executor(lambda: i)
+
+        self.loop.run_until_complete(task())
+        assert len(self.loop.executor._threads) == 1
+
+    def test_close(self):
+        started = threading.Event()
+        release = threading.Event()
+        def block():
+            started.set()
+            release.wait()
+
+        self.loop.run_in_executor(block)
+        started.wait()
+        threading.Timer(0.05, release.set).start()
+        self.loop.close()
+        # the worker was joined before the wake-up pipe was closed
+        assert not self.loop.executor._threads
+        self.loop.call_soon_threadsafe(lambda: None)
+        self.loop = loop.EventLoop()
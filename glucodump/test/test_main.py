@@ -0,0 +1,80 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test the command line"
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from .. import main, archive, usbcomm, incremental
+from ..bench import meter
+from .test_incremental import TalkingMeter
+
+class TestMain(object):
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        self.capture = os.path.join(self.dir, 'meter.cap')
+        with open(self.capture, 'wb') as f:
+            meter.write_capture(f, meter.records(5, serial='7390-5'))
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.dir)
+
+    def test_decode(self, capsys):
+        assert main.main(['glucodump', 'decode', self.capture]) == 0
+        lines = capsys.readouterr()[0].splitlines()
+        assert len(lines) == 5
+        assert lines[0].startswith('%s 7390-5 1: ' % self.capture)
+
+    def test_decode_archive_export(self, capsys):
+        db = os.path.join(self.dir, 'db')
+        main.main(['glucodump', 'decode', '-j', '2', '--archive', db,
+                   self.dir])
+        assert len(archive.Archive(db)) == 5
+        capsys.readouterr()
+        main.main(['glucodump', 'export', db, '--serial', '7390-5',
+                   '--start', '201101010800'])
+        lines = capsys.readouterr()[0].splitlines()
+        assert lines[0].startswith('meter_serial,recno,')
+        assert [l.split(',')[1] for l in lines[1:]] == ['2', '3', '4', '5']
+        main.main(['glucodump', 'export', db, '--format', 'json'])
+        assert len(capsys.readouterr()[0].splitlines()) == 5
+
+    def test_offline_imports(self):
+        # decoding never loads pyusb
+        code = ('import sys; from glucodump import main; '
+                'main.main(["glucodump", "decode", %r]); '
+                'sys.exit("usb" in sys.modules)' % self.capture)
+        with open(os.devnull, 'w') as devnull:
+            assert subprocess.call([sys.executable, '-c', code],
+                                   stdout=devnull) == 0
+
+    def test_sync_state(self, monkeypatch, capsys):
+        state = os.path.join(self.dir, 'state.json')
+        dev = TalkingMeter(meter.records(20))
+        monkeypatch.setattr(usbcomm, 'USBComm', lambda **kw: dev)
+        main.main(['glucodump', 'sync', '--state', state])
+        assert len(capsys.readouterr()[0].splitlines()) == 20
+        dev = TalkingMeter(meter.records(23), newest_first=True)
+        monkeypatch.setattr(usbcomm, 'USBComm', lambda **kw: dev)
+        main.main(['glucodump', 'sync', '--state', state])
+        lines = capsys.readouterr()[0].splitlines()
+        assert sorted(l.split(':')[0] for l in lines) == ['21', '22', '23']
+        # ended at the first known result, like incremental.sync
+        assert dev.sent < 10
+        assert incremental.SyncState(state).get('7390-1163170')[0] == 23
@@ -0,0 +1,159 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test the multi meter hub"
+
+import socket
+import threading
+from .. import multimux
+from .test_mux import FakeUSB, run_once
+
+class FakeDev(object):
+    def __init__(self, bus, address, serial):
+        self.bus = bus
+        self.address = address
+        self.serial_number = serial
+
+class ClosingUSB(FakeUSB):
+    def __init__(self):
+        FakeUSB.__init__(self)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+def recv(l, c, until):
+    c.setblocking(0)
+    data = ''
+    for i in range(500):
+        if until(data):
+            return data
+        run_once(l)
+        try:
+            data += c.recv(4096)
+        except socket.error:
+            pass
+    raise AssertionError('got %r' % data)
+
+class TestMultiMux(object):
+    def setup_method(self, method):
+        self.devices = [FakeDev(1, 2, 'A1'), FakeDev(1, 3, 'B2')]
+        self.usbs = {}
+        def opener(dev):
+            self.usbs[dev.serial_number] = ClosingUSB()
+            return self.usbs[dev.serial_number]
+        self.hub = multimux.MultiMux(port=0, finder=lambda: self.devices,
+                                     opener=opener, scan=0.02,
+                                     ports={'B2': 0}, readtimeout=10)
+        self.hub.start()
+        self.loop = self.hub.loop
+        # the meters are opened on the executor
+        while len(self.hub.channels) < 2:
+            run_once(self.loop)
+
+    def teardown_method(self, method):
+        self.hub.stop()
+        self.loop.close()
+
+    def test_channels(self):
+        assert sorted(self.hub.channels) == ['1:2', '1:3']
+        assert self.hub.find('A1') is self.hub.channels['1:2']
+        assert self.hub.find('1:3').serial == 'B2'
+        assert self.hub.find('nope') is None
+        # B2 has a port of its own, A1 only the handshake
+        assert self.hub.channels['1:3'].server is not None
+        assert self.hub.channels['1:2'].server is None
+
+    def test_handshake(self):
+        l = self.loop
+        a = socket.create_connection(('localhost', self.hub.port))
+        b = socket.create_connection(('localhost', self.hub.port))
+        a.sendall('A1\n\x06')
+        b.sendall('1:3\n')
+        ca, cb = self.hub.channels['1:2'], self.hub.channels['1:3']
+        while not (ca.clients and cb.clients):
+            run_once(l)
+        assert self.usbs['A1'].written.get(timeout=1) == '\x06'
+
+        self.usbs['A1'].incoming.put('from A')
+        self.usbs['B2'].incoming.put('from B')
+        assert recv(l, a, lambda d: d) == 'from A'
+        assert recv(l, b, lambda d: d) == 'from B'
+        a.close()
+        b.close()
+
+    def test_port(self):
+        l = self.loop
+        c = socket.create_connection(('localhost',
+                                      self.hub.channels['1:3'].port))
+        self.usbs['B2'].incoming.put('hello')
+        assert recv(l, c, lambda d: d) == 'hello'
+        c.close()
+
+    def test_unknown(self):
+        c = socket.create_connection(('localhost', self.hub.port))
+        c.sendall('Z9\n')
+        assert recv(self.loop, c, lambda d: d.endswith('\n')) == \
+            'ERROR no meter Z9\n'
+        c.close()
+
+    def test_hotplug(self):
+        l = self.loop
+        c = socket.create_connection(('localhost', self.hub.port))
+        c.sendall('A1\n')
+        while not self.hub.channels['1:2'].clients:
+            run_once(l)
+        usb = self.usbs['A1']
+        self.devices = self.devices[1:] + [FakeDev(2, 1, 'C3')]
+        while '2:1' not in self.hub.channels:
+            run_once(l)
+        assert '1:2' not in self.hub.channels
+        # the client of the removed meter is disconnected
+        c.setblocking(0)
+        for i in range(500):
+            run_once(l)
+            try:
+                if c.recv(4096) == '':
+                    break
+            except socket.error:
+                pass
+        else:
+            assert False, 'client was not disconnected'
+        while not usb.closed:
+            run_once(l)
+        c.close()
+
+    def test_executor(self):
+        # every channel has threads of its own on top of the base pool
+        assert self.loop.executor.workers == 16 + 2 * 2
+        self.devices = self.devices[1:]
+        while len(self.hub.channels) > 1:
+            run_once(self.loop)
+        assert self.loop.executor.workers == 16 + 2
+
+    def test_open_off_loop(self):
+        class AskingDev(object):
+            bus, address = 3, 1
+            @property
+            def serial_number(self):
+                threads.append(threading.current_thread())
+                return 'D4'
+        threads = []
+        self.devices = self.devices + [AskingDev()]
+        while '3:1' not in self.hub.channels:
+            run_once(self.loop)
+        assert self.hub.find('D4') is self.hub.channels['3:1']
+        assert threads and threading.current_thread() not in threads
@@ -0,0 +1,272 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test the event loop mux"
+
+import errno
+import json
+import socket
+import Queue
+import usb
+from .. import mux, loop
+from ..bench import meter
+
+class FakeUSB(object):
+    def __init__(self):
+        self.incoming = Queue.Queue()
+        self.written = Queue.Queue()
+
+    def read(self, timeout=None):
+        try:
+            return self.incoming.get(timeout=timeout / 1000.0)
+        except Queue.Empty:
+            raise usb.core.USBError('timeout', errno=errno.ETIMEDOUT)
+
+    def write(self, data):
+        self.written.put(data)
+
+    def close(self):
+        pass
+
+class FakeSocket(object):
+    "Takes at most room bytes, then would block"
+    def __init__(self, room):
+        self.room = room
+        self.sent = ''
+
+    def getpeername(self):
+        return ('fake', 0)
+
+    def fileno(self):
+        return 1000
+
+    def send(self, data):
+        if not self.room:
+            raise socket.error(errno.EAGAIN, 'would block')
+        data = data[:self.room]
+        self.room -= len(data)
+        self.sent += data
+        return len(data)
+
+    def close(self):
+        pass
+
+class FakeMux(object):
+    def __init__(self):
+        self.loop = loop.EventLoop()
+        self.removed = []
+
+    def remove(self, client, why):
+        self.removed.append(client)
+        client.closed = True
+
+class TestSubscriber(object):
+    def setup_method(self, method):
+        self.mux = FakeMux()
+
+    def teardown_method(self, method):
+        self.mux.loop.close()
+
+    def test_partial(self):
+        s = mux.Subscriber(self.mux, FakeSocket(3), 10, mux.DROP)
+        s.send('hello')
+        assert s.sock.sent == 'hel'
+        assert list(s.queue) == ['lo']
+        assert s.buffered == 2
+        s.sock.room = 100
+        s.flush()
+        assert s.sock.sent == 'hello'
+        assert s.buffered == 0
+
+    def test_drop(self):
+        s = mux.Subscriber(self.mux, FakeSocket(0), 10, mux.DROP)
+        s.send('12345678')
+        s.send('abcd')
+        assert list(s.queue) == ['12345678']
+        assert s.dropped == 4
+
+    def test_coalesce(self):
+        s = mux.Subscriber(self.mux, FakeSocket(0), 10, mux.COALESCE)
+        s.send('12345678')
+        s.send('abcd')
+        assert list(s.queue) == ['abcd']
+        assert s.dropped == 8
+        s.send('0123456789ABC')
+        assert list(s.queue) == ['3456789ABC']
+
+    def test_disconnect(self):
+        s = mux.Subscriber(self.mux, FakeSocket(0), 10, mux.DISCONNECT)
+        s.send('12345678')
+        s.send('abcd')
+        assert self.mux.removed == [s]
+        s.send('more')
+        assert list(s.queue) == ['12345678']
+
+class TestMux(object):
+    def test_forward(self):
+        dev = FakeUSB()
+        m = mux.Mux(dev, port=0, readtimeout=10)
+        m.start()
+        l = m.loop
+
+        clients = [socket.create_connection(('localhost', m.port))
+                   for i in range(3)]
+        while len(m.clients) < 3:
+            run_once(l)
+
+        dev.incoming.put('\x04\x05')
+        received = []
+        for c in clients:
+            while True:
+                run_once(l)
+                c.setblocking(0)
+                try:
+                    received.append(c.recv(100))
+                    break
+                except socket.error:
+                    pass
+        assert received == ['\x04\x05'] * 3
+
+        clients[0].sendall('\x06')
+        while dev.written.empty():
+            run_once(l)
+        assert dev.written.get() == '\x06'
+
+        clients[1].close()
+        while len(m.clients) > 2:
+            run_once(l)
+
+        m.stop()
+        for c in clients:
+            c.close()
+        l.close()
+
+    def test_write_error(self):
+        class BrokenUSB(FakeUSB):
+            def write(self, data):
+                raise IOError(errno.ENODEV, 'gone')
+        m = mux.Mux(BrokenUSB(), port=0, readtimeout=10)
+        done = m.start()
+        l = m.loop
+        c = socket.create_connection(('localhost', m.port))
+        while not m.clients:
+            run_once(l)
+        c.sendall('\x06')
+        while not done.done():
+            run_once(l)
+        assert isinstance(done.exception(), IOError)
+        assert not m.clients
+        assert c.recv(100) == ''
+        c.close()
+        l.close()
+
+def run_once(l):
+    "Run one loop iteration, without blocking for long"
+    l.call_later(0.01, lambda: None)
+    l._run_once()
+
+class TestRecordMux(object):
+    def read_lines(self, l, c, count):
+        c.setblocking(0)
+        data = ''
+        while data.count('\n') < count:
+            run_once(l)
+            try:
+                data += c.recv(65536)
+            except socket.error:
+                pass
+        return [json.loads(line) for line in data.splitlines()]
+
+    def test_dump(self):
+        dev = meter.replay(meter.records(5, serial='7390-42'))
+
+        m = mux.RecordMux(dev, port=0)
+        done = m.start()
+        l = m.loop
+        while m.last is None:
+            run_once(l)
+        assert m.last[0] == '7390-42'
+        assert len(m.dumps[m.last]) == 7
+
+        c = socket.create_connection(('localhost', m.port))
+        msgs = self.read_lines(l, c, 7)
+        assert msgs[0]['type'] == 'header'
+        assert msgs[0]['meter_serial'] == '7390-42'
+        assert [r['recno'] for r in msgs[1:6]] == [1, 2, 3, 4, 5]
+        assert msgs[1]['unit'] == 'mg/dL'
+        assert msgs[-1] == {'type': 'end'}
+
+        # a new transfer on request, broadcast live
+        dev.rewind()
+        c.sendall('sync\n')
+        assert self.read_lines(l, c, 7) == msgs
+
+        m.stop()
+        assert done.done()
+        c.close()
+        l.close()
+
+    def test_replay_exempt(self):
+        dev = meter.replay(meter.records(50))
+        m = mux.RecordMux(dev, port=0, maxbuffer=1024)
+        m.start()
+        l = m.loop
+        while m.last is None:
+            run_once(l)
+        assert len(''.join(m.dumps[m.last])) > 1024
+        c = socket.create_connection(('localhost', m.port))
+        msgs = self.read_lines(l, c, 52)
+        assert msgs[-1] == {'type': 'end'}
+        m.stop()
+        c.close()
+        l.close()
+
+    def test_commands(self):
+        dev = meter.replay(meter.records(3))
+        m = mux.RecordMux(dev, port=0)
+        m.start()
+        l = m.loop
+        while m.last is None:
+            run_once(l)
+        c = socket.create_connection(('localhost', m.port))
+        self.read_lines(l, c, 5)
+        synced = []
+        m.sync = lambda: synced.append(True)
+        c.sendall('async\nsy')
+        assert self.read_lines(l, c, 1) == [
+            {'type': 'error', 'error': "Unknown command: 'async'"}]
+        assert not synced
+        c.sendall('nc\n')
+        while not synced:
+            run_once(l)
+        m.stop()
+        c.close()
+        l.close()
+
+    def test_stop_during_sync(self):
+        dev = meter.replay(meter.records(50))
+        m = mux.RecordMux(dev, port=0)
+        done = m.start()
+        l = m.loop
+        while not m.current:
+            run_once(l)
+        m.stop()
+        # the meter is only let go of once the transfer has ended
+        assert not done.done()
+        while not done.done():
+            run_once(l)
+        assert dev.written[-1] == '\x04'
+        l.close()
@@ -0,0 +1,132 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test the binary reading log"
+
+import os
+import shutil
+import tempfile
+from .. import readinglog
+from ..bench import meter
+
+class TestReadingLog(object):
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'readings')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        log = readinglog.ReadingLog(self.path)
+        assert len(log) == 0
+        assert list(log.readings()) == []
+        cu = meter.synced(50, serial='7390-1')
+        assert log.ingest(cu) == 50
+        log = readinglog.ReadingLog(self.path)
+        assert len(log) == 50
+        assert os.path.getsize(self.path) == 8 + 50 * 26
+        for orig, r in zip(cu.result.values(), log.readings()):
+            assert r.meter_serial == '7390-1'
+            assert (r.recno, r.time, r.value, r.unit, r.reference,
+                    r.flags, r.is_control) == \
+                (orig.recno, orig.time, orig.value, orig.unit,
+                 orig.reference, orig.flags, orig.is_control)
+        assert log[-1].recno == 50
+
+    def test_range(self):
+        log = readinglog.ReadingLog(self.path)
+        log.ingest(meter.synced(50, serial='7390-1'))
+        log.ingest(meter.synced(50, serial='7390-2', start=1293840000 + 50 * 4 * 3600))
+        assert log.serials == ['7390-1', '7390-2']
+        cu = meter.synced(50, serial='7390-1')
+        start, end = cu.result[10].time, cu.result[20].time
+        assert log.span(start, end) == (9, 19)
+        assert [r.recno for r in log.readings(start, end)] == range(10, 20)
+        assert list(log.readings(start, end, serial='7390-2')) == []
+        assert len(list(log.readings(serial='7390-2'))) == 50
+        assert list(log.readings(serial='nope')) == []
+
+    def test_merge(self):
+        # an older meter appended later is merged in time order
+        log = readinglog.ReadingLog(self.path)
+        log.ingest(meter.synced(20, serial='7390-2', start=1293840000 + 50 * 4 * 3600))
+        log.ingest(meter.synced(50, serial='7390-1'))
+        log.ingest(meter.synced(20, serial='7390-3', start=1293840000 + 10 * 4 * 3600))
+        assert len(log) == 90
+        minutes = [r.time for r in readinglog.ReadingLog(self.path).readings()]
+        assert minutes == sorted(minutes)
+        cu = meter.synced(50, serial='7390-1')
+        start, end = cu.result[10].time, cu.result[20].time
+        assert [r.recno for r in log.readings(start, end, '7390-1')] == \
+            range(10, 20)
+        a = log.to_numpy(start, end)
+        assert list(a['recno']) == [r.recno for r in log.readings(start, end)]
+        assert len(a) > 10
+
+    def test_dedup(self):
+        log = readinglog.ReadingLog(self.path)
+        assert log.ingest(meter.synced(30, serial='7390-1')) == 30
+        assert log.ingest(meter.synced(30, serial='7390-1')) == 0
+        log = readinglog.ReadingLog(self.path)
+        assert log.ingest(meter.synced(40, serial='7390-1')) == 10
+        assert [r.recno for r in log.readings()] == range(1, 41)
+
+    def test_clock_set_back(self):
+        # readings after the meter clock was set back are still new
+        class Result(object):
+            value, unit, reference, flags, is_control = 100, 'mg/dL', None, 0, 0
+            def __init__(self, recno, minute):
+                self.recno, self.time = recno, minute * 60
+        log = readinglog.ReadingLog(self.path)
+        first = [Result(1, 21000000), Result(2, 21000060)]
+        assert log.append('7390-1', first) == 2
+        later = first + [Result(3, 20999000), Result(4, 20999060)]
+        log = readinglog.ReadingLog(self.path)
+        assert log.append('7390-1', later) == 2
+        assert log.append('7390-1', later) == 0
+        assert [r.recno for r in log.readings()] == [3, 4, 1, 2]
+
+    def test_recno(self):
+        log = readinglog.ReadingLog(self.path)
+        class Result(object):
+            value, unit, reference, flags, is_control = 100, 'mg/dL', None, 0, 0
+            def __init__(self, recno):
+                self.recno, self.time = recno, 1293840000 + recno * 60
+        log.append('7390-1', [Result(70000), Result(70001)])
+        assert [r.recno for r in log.readings()] == [70000, 70001]
+
+    def test_numpy(self):
+        log = readinglog.ReadingLog(self.path)
+        assert len(log.to_numpy()) == 0
+        cu = meter.synced(50, serial='7390-1')
+        log.ingest(cu)
+        a = log.to_numpy(cu.result[5].time, cu.result[15].time)
+        assert list(a['recno']) == range(5, 15)
+        assert list(a['value']) == [cu.result[i].value for i in range(5, 15)]
+        assert a.base is not None
+        assert list(a['minute'] * 60) == [cu.result[i].time
+                                          for i in range(5, 15)]
+
+    def test_bad_file(self):
+        with open(self.path, 'wb') as f:
+            f.write('not a log')
+        try:
+            readinglog.ReadingLog(self.path)
+        except readinglog.LogError:
+            pass
+        else:
+            assert False, 'expected LogError'
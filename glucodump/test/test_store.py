@@ -0,0 +1,123 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test the columnar result store"
+
+import math
+from .. import store, contourusb
+
+class TestResultStore(object):
+    def test_append(self):
+        s = store.ResultStore(flagmap=contourusb.ContourUSB.resultflagmap)
+        r = s.append(3, time=store.parsetime('201012142048'), value=5.5,
+                     unit='mmol/L', reference='P', meastype='Glucose',
+                     flags=store.flagbits(['A', 'Z1']))
+        assert r.recno == 3
+        assert r.testtime == '201012142048'
+        assert r.unit == 'mmol/L'
+        assert r.reference == 'P'
+        assert r.meastype == 'Glucose'
+        assert r.flagcodes == ['A', 'Z1']
+        assert r.resultflags == ['after food', '0.25 hours after food']
+        assert not r.is_control
+
+        assert 3 in s
+        assert 4 not in s
+        assert s[3].value == 5.5
+        assert s.get(4) is None
+        assert len(s) == 1
+
+    def test_setdefault(self):
+        s = store.ResultStore()
+        r = s.setdefault(1)
+        assert math.isnan(r.value)
+        assert r.testtime is None
+        assert r.unit is None
+        r.is_control = True
+        r.unit = 'mg/dL'
+        r.value = 120
+        assert s.setdefault(1).is_control
+        assert s[1].value == 120
+        assert len(s) == 1
+
+    def test_unordered(self):
+        s = store.ResultStore()
+        for recno in (5, 7, 2, 9, 1):
+            s.append(recno, value=recno * 10)
+        assert [(k, v.value) for k, v in s.items()] == \
+            [(5, 50), (7, 70), (2, 20), (9, 90), (1, 10)]
+        assert s[2].value == 20
+        try:
+            s.append(7)
+        except KeyError:
+            pass
+        else:
+            assert False, 'expected KeyError'
+
+    def test_codes(self):
+        s = store.ResultStore()
+        s.append(1, unit='mg/dL')
+        s.append(2, unit='mmol/L')
+        s.append(3, unit='furlongs')
+        assert [r.unit for r in s.values()] == ['mg/dL', 'mmol/L', 'furlongs']
+        assert s.unit.tolist() == [0, 1, 2]
+
+    def test_time(self):
+        assert store.parsetime('197001010001') == 60
+        assert store.formattime(store.parsetime('201102142249')) == \
+            '201102142249'
+        assert store.parsetime('20110214224930') == \
+            store.parsetime('201102142249') + 30
+        # cached date prefix
+        assert store.parsetime('201102140000') + 22 * 3600 + 49 * 60 == \
+            store.parsetime('201102142249')
+
+    def test_parsetimes(self):
+        texts = ['201102142249', '201102142250', '201012310000',
+                 '197001010001']
+        expect = [store.parsetime(t) for t in texts]
+        assert list(store.parsetimes(texts)) == expect
+        numpy, store.numpy = store.numpy, None
+        try:
+            assert list(store.parsetimes(texts)) == expect
+        finally:
+            store.numpy = numpy
+
+    def test_parsetimes_bad(self):
+        for texts in (['201102142249', '2011021422'], ['20110214224x'], ['']):
+            for numpy in (store.numpy, None):
+                saved, store.numpy = store.numpy, numpy
+                try:
+                    store.parsetimes(texts)
+                except ValueError:
+                    pass
+                else:
+                    assert False, 'expected ValueError for %r' % texts
+                finally:
+                    store.numpy = saved
+
+    def test_numpy(self):
+        s = store.ResultStore()
+        for recno in range(1, 11):
+            s.append(recno, value=recno / 2.0)
+        cols = s.to_numpy()
+        assert cols['recno'].tolist() == range(1, 11)
+        cols['value'][0] = 42
+        assert s[1].value == 42 # shares memory
+        assert s.nbytes() == 10 * sum(getattr(s, n).itemsize
+                                      for n, t in s.columns)
+
+        assert len(store.ResultStore().to_numpy()['value']) == 0
@@ -0,0 +1,67 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test the stream mux"
+
+import socket
+import threading
+from .. import stream
+from .test_mux import FakeUSB
+
+class TestRingBuffer(object):
+    def test_wrap(self):
+        r = stream.RingBuffer(8)
+        r.write('abcde')
+        assert r.read() == 'abcde'
+        r.write('fghijk')
+        assert len(r) == 6
+        assert r.read() == 'fghijk'
+        assert r.read() == ''
+
+    def test_full(self):
+        r = stream.RingBuffer(4)
+        data = ''.join(chr(i % 256) for i in range(1000))
+        t = threading.Thread(target=r.write, args=(data,))
+        t.start()
+        got = ''
+        while len(got) < len(data):
+            got += r.read()
+        t.join()
+        assert got == data
+
+class TestStream(object):
+    def test_forward(self):
+        dev = FakeUSB()
+        s = stream.Stream(port=0, device=dev)
+        s.reader.timeout = 10
+        s.start()
+        port = s.server.getsockname()[1]
+
+        c = socket.create_connection(('localhost', port))
+        while not s.clients:
+            s.run_once(100)
+
+        dev.incoming.put('\x04\x05')
+        s.run_once(1000)
+        assert c.recv(100) == '\x04\x05'
+
+        c.sendall('\x06')
+        s.run_once(1000)
+        assert dev.written.get(timeout=1) == '\x06'
+
+        c.close()
+        s.close()
+        assert not s.reader.is_alive()
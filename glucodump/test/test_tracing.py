@@ -0,0 +1,109 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"test tracing"
+
+import json
+import StringIO
+import threading
+from .. import tracing, contourusb
+from .test_contourusb import FakeMeter
+from ..bench import meter
+
+class TestTracer(object):
+    def test_histogram(self):
+        h = tracing.Histogram()
+        for v in (0, 0.5, 1, 3, 3, 100):
+            h.add(v)
+        s = h.summary()
+        assert s['count'] == 6
+        assert s['min'] == 0
+        assert s['max'] == 100
+        assert s['p50'] == 2.0 # 1 is in the [1, 2) bucket
+        assert s['p99'] == 100
+
+    def test_summary(self):
+        clock = iter([1.0, 1.25]).next
+        t = tracing.Tracer(clock=clock)
+        t.count('a')
+        t.count('a', 2)
+        with t.timer('b'):
+            pass
+        s = json.loads(t.to_json())
+        assert s['counters'] == {'a': 3}
+        assert s['histograms']['b']['sum'] == 0.25
+
+    def test_log(self):
+        f = StringIO.StringIO()
+        t = tracing.Tracer(log=f)
+        t.log('>>>', repr('\x04'))
+        assert f.getvalue() == ">>> '\\x04'\n"
+
+    def test_null(self):
+        assert not tracing.null.enabled
+        tracing.null.count('a')
+        with tracing.null.timer('b'):
+            pass
+        assert tracing.null.summary() == {'counters': {}, 'histograms': {}}
+
+    def test_sync(self):
+        p, l = meter.frames(['P|1', 'L|1||N'])
+        dataread = ['\x04\x05', p, p, l[:-4] + '00\r\n', l, '\x04']
+        size = sum(len(d) for d in dataread)
+        t = tracing.Tracer()
+        f = FakeMeter(read=dataread)
+        bc = contourusb.BayerCOMM(f, trace=t)
+        cu = contourusb.ContourUSB(trace=t)
+        for text in bc.sync():
+            cu.record(text)
+
+        s = t.summary()
+        assert s['counters']['sync.frames'] == 2
+        assert s['counters']['protocol.retransmit'] == 1
+        assert s['counters']['protocol.nak'] == 1
+        assert s['counters']['sync.bytes'] == size
+        assert s['histograms']['sync.frame_latency']['count'] == 2
+        assert s['histograms']['sync.handshake']['count'] == 1
+        assert s['histograms']['parse.record']['count'] == 2
+
+    def test_handshake(self):
+        # the handshake is timed to the <ENQ>, not the first frame
+        p, l = meter.frames(['P|1', 'L|1||N'])
+        times = iter([0.0, 0.0, 0.0, 0.0, 1.0, 1.0, 3.0] + [4.0] * 20).next
+        f = FakeMeter(read=['\x15', '\x04\x05', p, l, '\x04'])
+        t = tracing.Tracer()
+        bc = contourusb.BayerCOMM(f, trace=t)
+        bc.clock = times
+        list(bc.sync())
+        s = t.summary()['histograms']
+        assert s['sync.handshake']['sum'] == 1.0
+        assert s['sync.first_frame']['sum'] == 3.0
+        assert bc.handshake_time == 1.0
+
+    def test_threads(self):
+        t = tracing.Tracer()
+        def work():
+            for i in range(10000):
+                t.count('a')
+                t.observe('b', i)
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        s = t.summary()
+        assert s['counters']['a'] == 40000
+        assert s['histograms']['b']['count'] == 40000
@@ -16,9 +16,10 @@
 
 "test lowlevel communication"
 
-from .. import usbcomm
+from .. import usbcomm, capture
 import usb
 import array
+import StringIO
 
 class FakeDescriptor(object):
     def __init__(self, **kw):
@@ -39,13 +40,21 @@ class FakeDescriptor(object):
     def detach_kernel_driver(self, iface):
         pass
 
-    def read(self, size, timeout=None):
+    def set_altsetting(self):
+        pass
+
+    def read(self, size_or_buffer, timeout=None):
         data = self._readresult.pop(0)
-        assert size == len(data)
+        if isinstance(size_or_buffer, array.array):
+            assert len(size_or_buffer) >= len(data)
+            size_or_buffer[:len(data)] = array.array('B', data)
+            return len(data)
+        assert size_or_buffer == len(data)
         return array.array('B', data)
 
-    def write(self, data):
-        self._writeresult.append(data)
+    def write(self, data, timeout=None):
+        # pyusb copies the report into an array
+        self._writeresult.append(str(data))
 
 class FakeUSB(object):
     CLASS_HID = 3
@@ -65,6 +74,18 @@ class FakeUSB(object):
             kwd.update(kw)
             return FakeDescriptor(**kwd)
 
+        @staticmethod
+        def claim_interface(dev, interface):
+            pass
+
+        @staticmethod
+        def release_interface(dev, interface):
+            pass
+
+        @staticmethod
+        def dispose_resources(dev):
+            pass
+
 class TestUSBComm(object):
     usbdata = [
         'ABC\x3c\x04\x021H|\\^&||uv'
@@ -108,10 +129,40 @@ class TestUSBComm(object):
         assert uc
 
     def test_read(self):
-        uc = usbcomm.USBComm(read=self.usbdata)
+        uc = usbcomm.USBComm(read=list(self.usbdata))
         data = uc.read()
         assert data == self.dataread
 
+    def test_read_into(self):
+        uc = usbcomm.USBComm(read=list(self.usbdata))
+        buf = bytearray(256)
+        count = uc.read_into(buf)
+        assert str(buf[:count]) == self.dataread
+
+        uc = usbcomm.USBComm(read=list(self.usbdata))
+        try:
+            uc.read_into(bytearray(100))
+        except ValueError:
+            pass
+        else:
+            assert False, 'expected ValueError'
+
+    def test_read_grow(self):
+        uc = usbcomm.USBComm(read=list(self.usbdata) * 2)
+        uc._buf = bytearray(10)
+        assert uc.read() == self.dataread
+        assert uc.read() == self.dataread
+
+    def test_bad_report(self):
+        for report in ['', '\0\0\0', '\0\0\0\x05abc']:
+            uc = usbcomm.USBComm(read=[report])
+            try:
+                uc.read()
+            except usbcomm.ReportError:
+                pass
+            else:
+                assert False, 'expected ReportError for %r' % report
+
     def test_write(self):
         written = []
         expected = [
@@ -122,3 +173,33 @@ class TestUSBComm(object):
         uc = usbcomm.USBComm(write=written)
         count = uc.write('a'*70)
         assert written == expected
+
+    def test_capture(self):
+        f = StringIO.StringIO()
+        uc = usbcomm.USBComm(read=list(self.usbdata), write=[],
+                             capture=capture.CaptureWriter(f))
+        uc.write('\x04')
+        data = uc.read()
+
+        r = capture.CaptureReader(StringIO.StringIO(f.getvalue()))
+        reports = [(d, r) for t, d, r in r]
+        assert reports == [(capture.WRITE, '\0\0\0\x01\x04')] + \
+            [(capture.READ, r) for r in self.usbdata]
+
+        dev = capture.ReplayDevice(StringIO.StringIO(f.getvalue()))
+        assert dev.read() == data
+
+    def test_reports(self):
+        uc = usbcomm.USBComm()
+        reports = uc.reports('a' * 70)
+        assert [type(r) for r in reports] == [buffer, buffer]
+        assert [str(r) for r in reports] == ['\0\0\0\x3c' + 'a' * 60,
+                                             '\0\0\0\x0a' + 'a' * 10]
+
+    def test_writemany(self):
+        written = []
+        uc = usbcomm.USBComm(write=written)
+        uc.writemany(['a' * 60, 'b' * 61, ''])
+        assert written == ['\0\0\0\x3c' + 'a' * 60,
+                           '\0\0\0\x3c' + 'b' * 60,
+                           '\0\0\0\x01' + 'b']
@@ -0,0 +1,47 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"test remembered wake-up bytes"
+
+import os
+from .. import contourusb, wakeup
+
+class FakeComm(object):
+    vendor = 0x1a79
+    product = 0x6002
+
+class TestWakeupCache(object):
+    def test_model(self):
+        assert wakeup.model(FakeComm()) == '1a79:6002'
+        assert wakeup.model(object()) == ''
+
+    def test_remember(self, tmpdir):
+        path = str(tmpdir.join('wakeup.json'))
+        cache = wakeup.WakeupCache(path)
+        assert cache.get('1a79:6002') is None
+        bc = contourusb.BayerCOMM(None)
+        cache.remember(bc, '1a79:6002')
+        assert cache.get('1a79:6002') is None
+        bc.wakeup_used = '\x05'
+        cache.remember(bc, '1a79:6002', '7150-SAM2193', None)
+        cache.save()
+        assert not os.path.exists(path + '.tmp')
+
+        cache = wakeup.WakeupCache(path)
+        assert cache.get('1a79:6002') == '\x05'
+        assert cache.get(None, '7150-SAM2193') == '\x05'
+        assert cache.get('other') is None
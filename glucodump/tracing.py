@@ -0,0 +1,160 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Counters, histograms and debug logging for the transfer paths
+
+Objects that can be traced take a trace argument and default to
+null, whose enabled attribute is False. Hot paths test that before
+doing any work, so tracing costs one attribute check when it is off.
+"""
+
+import json
+import math
+import threading
+import time
+
+class Histogram(object):
+    "Count, sum, extremes and power of two buckets of observed values"
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        # bucket n holds values in [2**(n-1), 2**n)
+        bucket = math.frexp(value)[1] if value > 0 else None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def quantile(self, q):
+        "Upper bound of the bucket holding the q quantile"
+        if not self.count:
+            return None
+        seen = 0
+        for bucket in sorted(self.buckets, key=lambda b: (b is not None, b)):
+            seen += self.buckets[bucket]
+            if seen >= q * self.count:
+                return 0.0 if bucket is None else min(2.0 ** bucket, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            }
+
+class _Timer(object):
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.tracer.clock()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.observe(self.name, self.tracer.clock() - self.start)
+
+class Tracer(object):
+    """
+    Collect counters and histograms
+
+    If log is a file, debug messages are written to it as well. A
+    tracer can be shared by threads, such as those of fleet.Fleet.
+    """
+    enabled = True
+
+    def __init__(self, log=None, clock=time.time):
+        self.logfile = log
+        self.clock = clock
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self._lock:
+            try:
+                hist = self.histograms[name]
+            except KeyError:
+                hist = self.histograms[name] = Histogram()
+            hist.add(value)
+
+    def timer(self, name):
+        "Context manager observing the time spent in it"
+        return _Timer(self, name)
+
+    def log(self, *args):
+        if self.logfile is not None:
+            print >>self.logfile, ' '.join(str(a) for a in args)
+
+    def summary(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': dict((name, hist.summary()) for name, hist
+                                   in self.histograms.items()),
+                }
+
+    def to_json(self, **kw):
+        return json.dumps(self.summary(), sort_keys=True, **kw)
+
+    def dump(self, f):
+        f.write(self.to_json(indent=2))
+        f.write('\n')
+
+class NullTracer(object):
+    "A tracer that does nothing"
+    enabled = False
+
+    def count(self, name, n=1):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def timer(self, name):
+        return _NullTimer()
+
+    def log(self, *args):
+        pass
+
+    def summary(self):
+        return {'counters': {}, 'histograms': {}}
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+null = NullTracer()
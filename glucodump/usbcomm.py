@@ -15,7 +15,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 "Lowlevel communication with the meter"
 
-import usb
+import array
+from capture import CaptureWriter, READ, WRITE
+import lazy
+import tracing
+
+# pyusb is only imported once a device is opened
+usb = lazy.LazyModule('usb', ['core', 'util'])
 
 class _Vendor(int):
     def __new__(self, vid, **kw):
@@ -31,6 +37,13 @@ ids = _vidDb(
     Bayer = _Vendor(0x1a79, Contour=0x6002)
     )
 
+class ReportError(IOError):
+    "A HID report that doesn't hold what its header says"
+
+def find_all(**kw):
+    "Return all attached devices matching kw, see usb.core.find"
+    return list(usb.core.find(find_all=True, **kw))
+
 class USBComm(object):
     """
     Communicate with USB HID devices which use Interrupt transfers
@@ -38,14 +51,30 @@ class USBComm(object):
 
     It knows the low-level protocol used by the Bayer Contour USB
     glucose meter. If you need to talk some other protocol, refactor!
+
+    Pass capture (a file name or file object) to log every report read
+    and written, see capture.ReplayDevice to play it back. timeout (in
+    milliseconds) is the default for reads and writes, None leaves it to
+    pyusb.
     """
     blocksize = 64
+    capture = None
     
-    def __init__(self, **kw):
-        dev = usb.core.find(**kw)
+    def __init__(self, capture=None, timeout=None, trace=None, dev=None,
+                 **kw):
+        if dev is None:
+            dev = usb.core.find(**kw)
         self.dev = dev
-        self.product = kw['idProduct']
-        self.vendor = kw['idVendor']
+        self.timeout = timeout
+        self.trace = trace or tracing.null
+        self._report = array.array('B', '\0' * self.blocksize)
+        self._buf = bytearray(4096)
+        self.product = kw.get('idProduct', getattr(dev, 'idProduct', None))
+        self.vendor = kw.get('idVendor', getattr(dev, 'idVendor', None))
+        if capture is not None:
+            if not hasattr(capture, 'report'):
+                capture = CaptureWriter(capture)
+            self.capture = capture
         try:
             dev.set_configuration()
         except usb.core.USBError:
@@ -66,22 +95,92 @@ class USBComm(object):
     def close(self):
         usb.util.release_interface(self.dev, self.interface)
         usb.util.dispose_resources(self.dev)
-    def read(self):
-        result = []
+        if self.capture is not None:
+            self.capture.close()
+
+    def _read(self, buf, timeout, grow):
+        if timeout is None:
+            timeout = self.timeout
+        report = self._report
+        size = self.blocksize - 4
+        view = memoryview(buf)
+        pos = 0
         while True:
-            data = self.epin.read(self.blocksize)
-            dstr = data.tostring()
-            #assert dstr[:3] == 'ABC'
-            print '<<<', repr(dstr)
-            result.append(dstr[4:data[3]+4])
-            if data[3] != self.blocksize-4:
+            count = self.epin.read(report, timeout)
+            if self.capture is not None:
+                self.capture.report(READ, report[:count].tostring())
+            if self.trace.enabled:
+                self.trace.count('usb.reports_in')
+                self.trace.log('<<<', repr(report[:count].tostring()))
+            if count < 4:
+                raise ReportError("Short report, %d bytes" % count)
+            length = report[3]
+            if length > count - 4:
+                raise ReportError("Report of %d bytes claims %d bytes of data"
+                                  % (count, length))
+            if pos + length > len(view):
+                if not grow:
+                    raise ValueError("Message does not fit in buffer")
+                del view
+                buf.extend('\0' * max(len(buf), length))
+                view = memoryview(buf)
+            view[pos:pos+length] = buffer(report, 4, length)
+            pos += length
+            if length != size:
                 break
+        return pos
+
+    def read_into(self, buf, timeout=None):
+        """
+        Read one message into buf (a bytearray or memoryview)
+
+        Returns the length of the message. The HID reports are read into
+        a single reused buffer and only their payload is copied to buf.
+        """
+        return self._read(buf, timeout, False)
+
+    def read(self, timeout=None):
+        "Read one message"
+        length = self._read(self._buf, timeout, True)
+        return str(buffer(self._buf, 0, length))
+
+    def reports(self, data):
+        """
+        Return the HID reports that carry data
+
+        All reports are built in one preallocated buffer; the payload is
+        copied in without slicing data, and the reports are read-only
+        buffer slices of it, copied only by whoever writes them out.
+        """
+        size = self.blocksize - 4
+        count = (len(data) + size - 1) // size
+        wire = bytearray(len(data) + 4 * count)
+        view = memoryview(wire)
+        bounds = []
+        pos = 0
+        for off in xrange(0, len(data), size):
+            length = min(size, len(data) - off)
+            wire[pos+3] = length
+            view[pos+4:pos+4+length] = buffer(data, off, length)
+            bounds.append((pos, length + 4))
+            pos += length + 4
+        del view
+        return [buffer(wire, start, length) for start, length in bounds]
 
-        return ''.join(result)
+    def write(self, data, timeout=None):
+        self.writemany([data], timeout)
 
-    def write(self, data):
-        remain = data
-        while remain:
-            now = remain[:self.blocksize-4]
-            remain = remain[self.blocksize-4:]
-            self.epout.write('\0\0\0' + chr(len(now)) + now) # + ('\0' * (self.blocksize - 4 - len(now))))
+    def writemany(self, messages, timeout=None):
+        "Write several messages, back to back"
+        if timeout is None:
+            timeout = self.timeout
+        reports = []
+        for data in messages:
+            reports.extend(self.reports(data))
+        write = self.epout.write
+        for report in reports:
+            if self.capture is not None:
+                self.capture.report(WRITE, report)
+            write(report, timeout)
+        if self.trace.enabled:
+            self.trace.count('usb.reports_out', len(reports))
@@ -0,0 +1,66 @@
+#
+# Copyright (C) 2011 Anders Hammarquist <iko@iko.pp.se>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Remembered wake-up bytes
+
+A Contour in establish mode answers <NAK> until the host sends the
+byte it is waiting for. WakeupCache keeps the probe byte that got each
+meter going, by meter_serial and by USB model, so the next sync can
+send it first and normally reach <ENQ> on the first round-trip.
+"""
+
+import json
+import os
+
+def model(comm):
+    "Key for the USB model of comm, '' if unknown"
+    vendor = getattr(comm, 'vendor', None)
+    product = getattr(comm, 'product', None)
+    if vendor is None or product is None:
+        return ''
+    return '%04x:%04x' % (vendor, product)
+
+class WakeupCache(object):
+    "Wake-up bytes by meter serial or model, kept in a JSON file"
+
+    def __init__(self, path=None):
+        self.path = path
+        self.wakeups = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.wakeups = json.load(f)
+
+    def get(self, *keys):
+        "The wake-up byte of the first known key, or None"
+        for key in keys:
+            if key and key in self.wakeups:
+                return chr(self.wakeups[key])
+        return None
+
+    def remember(self, bc, *keys):
+        "Store the byte that woke the meter on BayerCOMM bc"
+        if bc.wakeup_used is None:
+            return
+        for key in keys:
+            if key:
+                self.wakeups[key] = ord(bc.wakeup_used)
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.wakeups, f, sort_keys=True)
+        os.rename(tmp, self.path)